@@ -0,0 +1,256 @@
+"""
+Storage representations of the 400 genre activations of each track in the genre predictions table.
+
+- float32: one dense activations matrix column, as written by earlier versions
+- float16: one dense activations matrix column in half precision, half the size
+- sparse: the top k activations of each track as (style index, value) pairs, with activations below a threshold dropped.
+  Most activations are close to zero, so little is lost and with the defaults this is 20 times smaller than float32
+
+GenreActivations reads any of the representations and gives the activations of one style over all tracks as a dense
+float32 column, so the Genre page of app.py can filter and rank by style without expanding the whole matrix.
+
+Running this script converts the genre predictions table to another representation and reports its size.
+
+"""
+
+import argparse
+import json
+from collections.abc import Mapping
+import numpy as np
+import store
+
+METADATA_FILE_PATH = 'metadata/discogs-effnet-bs64-1.json'
+
+REPRESENTATIONS = ['float32', 'float16', 'sparse']
+TOP_K = 20
+THRESHOLD = 0.01
+
+# Columns of each representation
+DENSE_COLUMN = 'activations'
+INDICES_COLUMN = 'activation_indices'
+VALUES_COLUMN = 'activation_values'
+
+
+def encode(activations, representation, top_k=TOP_K, threshold=THRESHOLD):
+    """
+    Encode genre activations in a storage representation
+
+    Parameters:
+    activations (np.array): The activations, one row per track, or the activations of one track
+    representation (str): One of REPRESENTATIONS
+    top_k (int): The number of activations kept per track by the sparse representation
+    threshold (float): Activations below this value are dropped by the sparse representation
+
+    Returns:
+    columns (dict): The columns of the representation, with one row per track or the values of the track
+    """
+    activations = np.asarray(activations, dtype=np.float32)
+    if representation == 'float32':
+        return {DENSE_COLUMN: activations}
+    if representation == 'float16':
+        return {DENSE_COLUMN: activations.astype(np.float16)}
+    if representation != 'sparse':
+        raise ValueError(f"Unknown genre activations representation '{representation}', expected one of {REPRESENTATIONS}")
+
+    rows = np.atleast_2d(activations)
+    top_k = min(top_k, rows.shape[1])
+    # Top k styles of each track in descending order, dropped activations have index -1 and value 0
+    indices = np.argpartition(-rows, top_k - 1, axis=1)[:, :top_k]
+    values = np.take_along_axis(rows, indices, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1).astype(np.int16)
+    values = np.take_along_axis(values, order, axis=1)
+    indices[values < threshold] = -1
+    values[values < threshold] = 0
+
+    columns = {INDICES_COLUMN: indices, VALUES_COLUMN: values.astype(np.float16)}
+
+    return columns if activations.ndim == 2 else {column: column_values[0] for column, column_values in columns.items()}
+
+
+def table_representation():
+    """
+    Get the representation of the genre activations in the genre predictions table
+
+    Parameters:
+    None
+
+    Returns:
+    representation (str): One of REPRESENTATIONS, None if the table does not exist
+    """
+    if not store.table_exists(store.GENRE_PREDICTIONS_TABLE):
+        return None
+
+    table = store.read_table(store.GENRE_PREDICTIONS_TABLE, mmap=True)
+    if INDICES_COLUMN in table:
+        return 'sparse'
+
+    return 'float16' if table[DENSE_COLUMN].dtype == np.float16 else 'float32'
+
+
+def convert(representation, top_k=TOP_K, threshold=THRESHOLD):
+    """
+    Rewrite the genre predictions table with the activations in another representation
+
+    Parameters:
+    representation (str): One of REPRESENTATIONS
+    top_k (int): The number of activations kept per track by the sparse representation
+    threshold (float): Activations below this value are dropped by the sparse representation
+
+    Returns:
+    None
+    """
+    table = store.read_table(store.GENRE_PREDICTIONS_TABLE)
+    activations = GenreActivations(table).dense()
+    for column in [DENSE_COLUMN, INDICES_COLUMN, VALUES_COLUMN]:
+        table.pop(column, None)
+    table.update(encode(activations, representation, top_k, threshold))
+    store.write_table(store.GENRE_PREDICTIONS_TABLE, table)
+
+
+class GenreActivations:
+    """
+    Genre activations of a genre predictions table in any representation
+    """
+
+    def __init__(self, table, styles=None):
+        """
+        Initialise the activations
+
+        Parameters:
+        table (dict): The columns of the genre predictions table, as returned by store.read_table
+        styles (int): The number of styles, read from the genre metadata if None and the activations are sparse
+
+        Returns:
+        None
+        """
+        self.dense_activations = table.get(DENSE_COLUMN)
+        self.indices = table.get(INDICES_COLUMN)
+        self.values = table.get(VALUES_COLUMN)
+        self.tracks = len(table[store.INDEX_COLUMN])
+        if self.dense_activations is not None:
+            self.styles = self.dense_activations.shape[1]
+        else:
+            self.styles = styles or len(load_styles())
+
+    @property
+    def nbytes(self):
+        if self.dense_activations is not None:
+            return self.dense_activations.nbytes
+
+        return self.indices.nbytes + self.values.nbytes
+
+    def column(self, style_index):
+        """
+        Get the activations of one style for all tracks
+
+        Parameters:
+        style_index (int): The index of the style
+
+        Returns:
+        column (np.array): The float32 activation of the style for each track, dropped activations are 0
+        """
+        if self.dense_activations is not None:
+            return self.dense_activations[:, style_index].astype(np.float32)
+
+        rows, positions = np.nonzero(self.indices == style_index)
+        column = np.zeros(self.tracks, dtype=np.float32)
+        column[rows] = self.values[rows, positions]
+
+        return column
+
+    def dense(self):
+        """
+        Expand the activations to a dense float32 matrix
+
+        Parameters:
+        None
+
+        Returns:
+        activations (np.array): The activations, one row per track
+        """
+        if self.dense_activations is not None:
+            return np.asarray(self.dense_activations, dtype=np.float32)
+
+        activations = np.zeros((self.tracks, self.styles), dtype=np.float32)
+        rows, positions = np.nonzero(self.indices >= 0)
+        activations[rows, self.indices[rows, positions]] = self.values[rows, positions]
+
+        return activations
+
+    def describe(self, style_names):
+        """
+        Compute statistics of the activations of each style without expanding sparse activations
+
+        Parameters:
+        style_names (list): The name of each style
+
+        Returns:
+        stats (pd.DataFrame): The number of tracks with a non-zero activation, mean, standard deviation and maximum of each style
+        """
+        if self.dense_activations is not None:
+            activations = self.dense()
+            counts, sums = (activations > 0).sum(axis=0), activations.sum(axis=0, dtype=np.float64)
+            squares, maxima = (activations.astype(np.float64) ** 2).sum(axis=0), activations.max(axis=0, initial=0)
+        else:
+            valid = self.indices >= 0
+            indices, values = self.indices[valid], self.values[valid].astype(np.float64)
+            counts = np.bincount(indices, minlength=self.styles)
+            sums = np.bincount(indices, weights=values, minlength=self.styles)
+            squares = np.bincount(indices, weights=values ** 2, minlength=self.styles)
+            maxima = np.zeros(self.styles)
+            np.maximum.at(maxima, indices, values)
+
+        # pandas is imported on first use, so that main.py starts faster
+        import pandas as pd
+
+        tracks = max(self.tracks, 1)
+        mean = sums / tracks
+        std = np.sqrt(np.maximum(squares / tracks - mean ** 2, 0))
+
+        return pd.DataFrame([counts, mean, std, maxima], index=['non-zero', 'mean', 'std', 'max'], columns=style_names)
+
+
+class StyleColumns(Mapping):
+    """
+    Read-only mapping from style name to the activations of the style, expanded on first use
+    """
+
+    def __init__(self, activations, style_names):
+        self.activations = activations
+        self.style_indices = {style: i for i, style in enumerate(style_names)}
+        self.expanded = {}
+
+    def __getitem__(self, style):
+        if style not in self.expanded:
+            self.expanded[style] = self.activations.column(self.style_indices[style])
+
+        return self.expanded[style]
+
+    def __iter__(self):
+        return iter(self.style_indices)
+
+    def __len__(self):
+        return len(self.style_indices)
+
+
+def load_styles(metadata_file=METADATA_FILE_PATH):
+    with open(metadata_file) as file:
+        return json.load(file)['classes']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the genre activations of the genre predictions table to another representation")
+    parser.add_argument('representation', choices=REPRESENTATIONS, help="Representation of the activations")
+    parser.add_argument('--top-k', type=int, default=TOP_K, help=f"Activations kept per track by the sparse representation (default: {TOP_K})")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help=f"Activations below this value are dropped by the sparse representation (default: {THRESHOLD})")
+    args = parser.parse_args()
+
+    before = GenreActivations(store.read_table(store.GENRE_PREDICTIONS_TABLE, mmap=True)).nbytes
+    convert(args.representation, args.top_k, args.threshold)
+    after = GenreActivations(store.read_table(store.GENRE_PREDICTIONS_TABLE, mmap=True)).nbytes
+    print(f"Genre activations converted to {args.representation}: {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
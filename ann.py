@@ -0,0 +1,411 @@
+"""
+Approximate nearest-neighbour indexes for the Discogs-EffNet and MusiCNN embeddings.
+
+ExactIndex scores every track against the query (see similarity.py). IVFIndex is an inverted file index: the normalized
+embeddings are clustered with spherical k-means, and a query only scores the tracks in the nprobe clusters whose
+centroids are closest to it. Both indexes have the same search method, so the similarity app can use either.
+
+Running this script builds an IVF index for each embeddings table, saves it next to the embeddings in the store and
+reports its recall@10 against the exact cosine similarity. With --quantize it also saves the normalized embeddings as
+float16 or int8 (see similarity.QuantizedEmbeddings) and reports their memory, and the recall@10 and query time of
+searching them against the float32 embeddings.
+load_embeddings then loads the quantized embeddings instead of the float32 embeddings, and both indexes search them.
+
+The embeddings are stored normalized (see main.write_results), so read_normalized serves them memory-mapped without
+copying them, also while appended rows are not compacted yet (see store.read_column). Tables written by earlier
+versions are normalized in the store by running store.py, until then they are normalized in memory when read.
+
+update brings the saved index and quantized embeddings of a table up to date after tracks were analyzed, e.g. by the
+analysis worker (see worker.py). Only the appended tracks are assigned and quantized: they are inserted at the ends of
+the inverted lists of their closest clusters, without training the clusters again, and their codes are appended with
+the saved int8 scale.
+
+"""
+
+import argparse
+import hashlib
+import os
+import time
+import numpy as np
+import similarity
+import store
+
+INDEX_FILE = 'ivf.npz'
+NPROBE = 8
+EMBEDDINGS_TABLES = store.EMBEDDINGS_TABLES
+
+
+def index_path(name):
+    return os.path.join(store.table_path(name), INDEX_FILE)
+
+
+def quantized_path(name, quantization):
+    return os.path.join(store.table_path(name), f'embedding-{quantization}.npz')
+
+
+def _tracks_hash(name, tracks=None, snapshot=None):
+    """
+    Hash the track index of a table, so that an ANN index is only used with the embeddings it was built from
+
+    Parameters:
+    name (str): The name of the embeddings table
+    tracks (np.array): The tracks to hash instead of the track index of the table, e.g. its first rows
+    snapshot (dict): The store snapshot to read the track index from, None to read the current one
+
+    Returns:
+    tracks_hash (str): The hash of the track index
+    """
+    if tracks is None:
+        tracks = store.read_table(name, columns=[], snapshot=snapshot)[store.INDEX_COLUMN]
+
+    return hashlib.sha1('\n'.join(tracks).encode()).hexdigest()
+
+
+class ExactIndex:
+    """
+    Brute-force index that scores every track
+    """
+
+    def __init__(self, normalized):
+        # The normalized float32 embeddings, or similarity.QuantizedEmbeddings
+        self.normalized = normalized
+
+    def search(self, vector, k=10, exclude=None):
+        """
+        Find the tracks most similar to a normalized query vector
+
+        Parameters:
+        vector (np.array): The normalized query embedding
+        k (int): The number of similar tracks to return
+        exclude (int): The index of a track to leave out, e.g. the query track
+
+        Returns:
+        indices (np.array): The indices of the most similar tracks
+        similarities (np.array): The cosine similarities of these tracks to the query
+        """
+        return similarity.top_k(self.normalized @ vector, k, exclude=exclude)
+
+
+class IVFIndex:
+    """
+    Inverted file index over the normalized embeddings
+    """
+
+    def __init__(self, normalized, centroids, list_offsets, list_ids, nprobe=NPROBE):
+        """
+        Initialise the index
+
+        Parameters:
+        normalized (np.array): The normalized embeddings the index was built from
+        centroids (np.array): The normalized centroid of each cluster
+        list_offsets (np.array): The start of each cluster in list_ids, followed by the number of tracks
+        list_ids (np.array): The track indices, sorted by cluster
+        nprobe (int): The number of clusters searched per query
+
+        Returns:
+        None
+        """
+        self.normalized = normalized
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, normalized, nlist=None, iterations=10, nprobe=NPROBE, seed=0):
+        """
+        Cluster the normalized embeddings with spherical k-means and build the inverted lists
+
+        Parameters:
+        normalized (np.array): The normalized embeddings
+        nlist (int): The number of clusters, defaults to 4 * sqrt(number of tracks)
+        iterations (int): The number of k-means iterations
+        nprobe (int): The number of clusters searched per query
+        seed (int): The random seed for the initial centroids and the training sample
+
+        Returns:
+        index (IVFIndex): The index
+        """
+        rng = np.random.default_rng(seed)
+        n = len(normalized)
+        nlist = min(nlist or int(4 * np.sqrt(n)), n)
+
+        # Train on a sample of the tracks, 256 per cluster is plenty for the centroids to converge
+        sample = normalized[np.sort(rng.choice(n, size=min(n, 256 * nlist), replace=False))]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = _assign(sample, centroids)
+            for cluster in range(nlist):
+                members = sample[assignments == cluster]
+                # Reinitialise empty clusters with a random training point
+                centroids[cluster] = members.sum(axis=0) if len(members) else sample[rng.integers(len(sample))]
+            centroids = similarity.normalize(centroids)
+
+        assignments = _assign(normalized, centroids)
+        list_ids = np.argsort(assignments, kind='stable').astype(np.int32)
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=nlist)))).astype(np.int64)
+
+        return cls(normalized, centroids, list_offsets, list_ids, nprobe)
+
+    def search(self, vector, k=10, exclude=None):
+        """
+        Find the tracks most similar to a normalized query vector among the nprobe closest clusters
+
+        Parameters:
+        vector (np.array): The normalized query embedding
+        k (int): The number of similar tracks to return
+        exclude (int): The index of a track to leave out, e.g. the query track
+
+        Returns:
+        indices (np.array): The indices of the most similar tracks
+        similarities (np.array): The cosine similarities of these tracks to the query
+        """
+        clusters, _ = similarity.top_k(self.centroids @ vector, self.nprobe)
+        # Sorted candidates read the (possibly memory-mapped) embeddings in order
+        candidates = np.sort(np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in clusters]))
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+
+        positions, similarities = similarity.top_k(self.normalized[candidates] @ vector, k)
+
+        return candidates[positions], similarities
+
+    def add(self):
+        """
+        Add the tracks appended to the embeddings since the index was built to the lists of their closest clusters
+
+        Parameters:
+        None
+
+        Returns:
+        index (IVFIndex): The index with the same centroids and the appended tracks
+        """
+        start = len(self.list_ids)
+        assignments = _assign(self.normalized[start:], self.centroids)
+        counts = np.bincount(assignments, minlength=len(self.centroids))
+
+        # Insert the appended tracks at the end of the list of their cluster, so only they are assigned and sorted
+        order = np.argsort(assignments, kind='stable')
+        list_ids = np.insert(self.list_ids, np.repeat(self.list_offsets[1:], counts), (start + order).astype(np.int32))
+        list_offsets = self.list_offsets + np.concatenate(([0], np.cumsum(counts)))
+
+        return IVFIndex(self.normalized, self.centroids, list_offsets, list_ids, self.nprobe)
+
+    def save(self, file_path, tracks_hash):
+        # Replace the file so that the modification time of the table changes and cached indexes are reloaded
+        with open(file_path + '.tmp', 'wb') as file:
+            np.savez(file, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids,
+                     nprobe=self.nprobe, tracks_hash=tracks_hash)
+        os.replace(file_path + '.tmp', file_path)
+
+    @classmethod
+    def load(cls, file_path, normalized):
+        with np.load(file_path) as file:
+            return cls(normalized, file['centroids'], file['list_offsets'], file['list_ids'], int(file['nprobe'])), str(file['tracks_hash'])
+
+
+def _assign(normalized, centroids, chunk_size=65536):
+    """
+    Assign each embedding to the cluster with the most similar centroid, in chunks to bound memory
+
+    Parameters:
+    normalized (np.array): The normalized embeddings
+    centroids (np.array): The normalized centroids
+    chunk_size (int): The number of embeddings scored at once
+
+    Returns:
+    assignments (np.array): The cluster of each embedding
+    """
+    return np.concatenate([(normalized[i:i + chunk_size] @ centroids.T).argmax(axis=1)
+                           for i in range(0, len(normalized), chunk_size)])
+
+
+def save_quantized(name, quantized, tracks_hash=None):
+    """
+    Save the quantized embeddings of a table next to the table
+
+    Parameters:
+    name (str): The name of the embeddings table
+    quantized (similarity.QuantizedEmbeddings): The quantized normalized embeddings of the table
+    tracks_hash (str): The hash of the track index of the table, computed if not given
+
+    Returns:
+    None
+    """
+    file_path = quantized_path(name, quantized.quantization)
+    # Replace the file so that the modification time of the table changes and cached embeddings are reloaded
+    with open(file_path + '.tmp', 'wb') as file:
+        np.savez(file, codes=quantized.codes, scale=quantized.scale if quantized.scale is not None else np.array([]),
+                 tracks_hash=tracks_hash or _tracks_hash(name))
+    os.replace(file_path + '.tmp', file_path)
+
+
+def read_normalized(name, snapshot=None):
+    """
+    Read the normalized float32 embeddings of a table, memory-mapped
+
+    Parameters:
+    name (str): The name of the embeddings table
+    snapshot (dict): The store snapshot to read the embeddings from, None to read the current one
+
+    Returns:
+    normalized (np.array or store.StackedRows): The normalized embeddings
+    """
+    normalized = store.read_column(name, 'embedding', snapshot=snapshot)
+    if not similarity.is_normalized(normalized):
+        # Embeddings written before they were normalized on write, the store is only modified by store.py
+        print(f"The embeddings of '{name}' are not normalized, normalizing them in memory. Run store.py to normalize them in the store once")
+        normalized = similarity.normalize(np.asarray(normalized))
+
+    return normalized
+
+
+def load_embeddings(name, snapshot=None):
+    """
+    Load the normalized embeddings of a table, quantized if quantized embeddings were saved for the current rows
+
+    Parameters:
+    name (str): The name of the embeddings table
+    snapshot (dict): The store snapshot to read the embeddings from, None to read the current one
+
+    Returns:
+    normalized (np.array or similarity.QuantizedEmbeddings): The normalized embeddings
+    """
+    # The smallest up-to-date quantization is used
+    for quantization in ['int8', 'float16']:
+        if os.path.exists(quantized_path(name, quantization)):
+            with np.load(quantized_path(name, quantization)) as file:
+                if str(file['tracks_hash']) == _tracks_hash(name, snapshot=snapshot):
+                    return similarity.QuantizedEmbeddings(file['codes'], file['scale'] if file['scale'].size else None)
+            print(f"The {quantization} embeddings of '{name}' are out of date, using float32. Run ann.py --quantize {quantization} to rebuild them")
+
+    return read_normalized(name, snapshot)
+
+
+def load_index(name, normalized, snapshot=None):
+    """
+    Load the IVF index of an embeddings table, or an exact index if there is no up-to-date IVF index
+
+    Parameters:
+    name (str): The name of the embeddings table
+    normalized (np.array or similarity.QuantizedEmbeddings): The normalized embeddings of the table
+    snapshot (dict): The store snapshot the embeddings were read from, None to read the current one
+
+    Returns:
+    index (ExactIndex or IVFIndex): The index
+    """
+    if os.path.exists(index_path(name)):
+        index, tracks_hash = IVFIndex.load(index_path(name), normalized)
+        if tracks_hash == _tracks_hash(name, snapshot=snapshot):
+            return index
+        print(f"The ANN index of '{name}' is out of date, using exact search. Run ann.py to rebuild it")
+
+    return ExactIndex(normalized)
+
+
+def update(name):
+    """
+    Update the saved IVF index and quantized embeddings of an embeddings table to its current rows
+
+    Parameters:
+    name (str): The name of the embeddings table
+
+    Returns:
+    None
+    """
+    tracks = store.read_table(name, columns=[])[store.INDEX_COLUMN]
+    if not len(tracks):
+        return
+    tracks_hash = _tracks_hash(name, tracks)
+    normalized = read_normalized(name)
+
+    if os.path.exists(index_path(name)):
+        index, index_hash = IVFIndex.load(index_path(name), normalized)
+        if index_hash != tracks_hash:
+            # Only add the appended tracks if the rows the index was built from are unchanged, otherwise train it again
+            if len(index.list_ids) <= len(tracks) and index_hash == _tracks_hash(name, tracks[:len(index.list_ids)]):
+                index = index.add()
+            else:
+                index = IVFIndex.build(normalized, nlist=min(len(index.centroids), len(tracks)), nprobe=index.nprobe)
+            index.save(index_path(name), tracks_hash)
+
+    for quantization in similarity.QUANTIZATIONS:
+        if os.path.exists(quantized_path(name, quantization)):
+            with np.load(quantized_path(name, quantization)) as file:
+                codes, scale, codes_hash = file['codes'], (file['scale'] if file['scale'].size else None), str(file['tracks_hash'])
+            if codes_hash == tracks_hash:
+                continue
+            # Only quantize the appended tracks if the quantized rows are unchanged, otherwise quantize all of them again
+            if len(codes) <= len(tracks) and codes_hash == _tracks_hash(name, tracks[:len(codes)]):
+                appended = similarity.quantize(normalized[len(codes):], quantization, scale)
+                quantized = similarity.QuantizedEmbeddings(np.concatenate([codes, appended.codes]), scale)
+            else:
+                quantized = similarity.quantize(np.asarray(normalized), quantization)
+            save_quantized(name, quantized, tracks_hash)
+
+
+def recall_at_k(index, normalized, queries, k=10):
+    """
+    Compute the recall@k of an index against the exact cosine similarity
+
+    Parameters:
+    index (IVFIndex): The index to evaluate
+    normalized (np.array): The normalized embeddings
+    queries (np.array): The indices of the query tracks
+    k (int): The number of similar tracks per query
+
+    Returns:
+    recall (float): The average fraction of the exact top k tracks found by the index
+    query_time (float): The average query time in seconds
+    """
+    exact = ExactIndex(normalized)
+    hits = 0
+    query_time = 0
+    for query_index in queries:
+        expected, _ = exact.search(normalized[query_index], k, exclude=query_index)
+        start = time.perf_counter()
+        found, _ = index.search(normalized[query_index], k, exclude=query_index)
+        query_time += time.perf_counter() - start
+        hits += len(np.intersect1d(expected, found))
+
+    return hits / (len(queries) * k), query_time / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the IVF indexes of the embeddings tables and report their recall@10")
+    parser.add_argument('--nlist', type=int, default=None, help="Number of clusters (default: 4 * sqrt(number of tracks))")
+    parser.add_argument('--nprobe', type=int, default=NPROBE, help=f"Number of clusters searched per query (default: {NPROBE})")
+    parser.add_argument('--quantize', choices=similarity.QUANTIZATIONS, default=None, help="Also save the embeddings quantized to float16 or int8")
+    parser.add_argument('--no-ivf', action='store_true', help="Do not build the IVF indexes")
+    parser.add_argument('--queries', type=int, default=200, help="Number of random query tracks used to compute the recall")
+    args = parser.parse_args()
+
+    for name in EMBEDDINGS_TABLES:
+        normalized = read_normalized(name)
+        queries = np.random.default_rng(0).choice(len(normalized), size=min(args.queries, len(normalized)), replace=False)
+
+        if not args.no_ivf:
+            start = time.perf_counter()
+            index = IVFIndex.build(normalized, nlist=args.nlist, nprobe=args.nprobe)
+            build_time = time.perf_counter() - start
+            index.save(index_path(name), _tracks_hash(name))
+
+            recall, query_time = recall_at_k(index, normalized, queries)
+            print(f"{name}: {len(index.centroids)} clusters built in {build_time:.1f} s, saved to {index_path(name)}")
+            print(f"{name}: recall@10 {recall:.3f} with nprobe={index.nprobe}, {query_time * 1000:.2f} ms per query")
+
+        if args.quantize:
+            quantized = similarity.quantize(np.asarray(normalized), args.quantize)
+            save_quantized(name, quantized)
+
+            recall, query_time = recall_at_k(ExactIndex(quantized), normalized, queries)
+            # The speed cost of the quantization, against exact search on the float32 embeddings
+            _, float32_time = recall_at_k(ExactIndex(normalized), normalized, queries)
+            print(f"{name}: {args.quantize} embeddings use {quantized.nbytes / 2**20:.1f} MB instead of {normalized.nbytes / 2**20:.1f} MB, "
+                  f"saved to {quantized_path(name, args.quantize)}")
+            print(f"{name}: recall@10 {recall:.3f} of exact search on the {args.quantize} embeddings, {query_time * 1000:.2f} ms per query "
+                  f"against {float32_time * 1000:.2f} ms on the float32 embeddings ({query_time / float32_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
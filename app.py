@@ -12,13 +12,16 @@ The app uses the following features to create playlists:
 
 """
 
+import os.path
 import streamlit as st
 import utils as ut
+import store
 import subprocess
+import worker
 
 # File paths
-GENRE_ANALYSIS_PATH = 'data/genre_predictions.csv'
-OTHER_FEATURES_PATH = 'data/features.csv'
+GENRE_ANALYSIS_PATH = store.table_path(store.GENRE_PREDICTIONS_TABLE)
+OTHER_FEATURES_PATH = store.table_path(store.FEATURES_TABLE)
 METADATA_FILE_PATH = 'metadata/discogs-effnet-bs64-1.json'
 
 # Sidebar options
@@ -41,11 +44,47 @@ if playlist_option == "Welcome":
     st.write('\n\n')
     st.write('<span style="color:red;">WARNING: THIS WILL TAKE A WHILE (APPROX. 10 SECONDS PER MINUTE OF AUDIO)</span>', unsafe_allow_html=True)
 
+    # The analysis runs in the background analysis worker (see worker.py), which keeps the models loaded between runs
+    analysis_path = st.text_input('Audio file or directory to analyze (only new or modified files of a directory are analyzed):', 'audio')
     if st.button("Run analysis"):
-        st.write('Running analysis, this will take a while')
-        # Run the analysis scripts
-        result = subprocess.run(["python3", "main.py"])
-        st.write('Analysis complete!')
+        service = worker.connect()
+        if os.path.isdir(analysis_path):
+            st.session_state['analysis_job'] = service.enqueue_directory(analysis_path)
+        else:
+            st.session_state['analysis_job'] = service.enqueue_files([analysis_path])
+        st.session_state['analysis_results'] = []
+
+    if 'analysis_job' in st.session_state:
+        # Poll the progress of the job, the page is refreshed by the Refresh button or any other interaction
+        try:
+            service = worker.connect(start=False)
+            status = service.status()
+            job = service.job(st.session_state['analysis_job'], since=len(st.session_state['analysis_results']))
+        except (*worker.CONNECTION_ERRORS, KeyError):
+            st.write('The analysis worker is not running anymore, run the analysis again to restart it.')
+            del st.session_state['analysis_job']
+        else:
+            st.session_state['analysis_results'] += job['results']
+            if status['state'] == 'failed':
+                st.write('The analysis worker could not load the models:')
+                st.code(status['error'])
+            elif job['state'] == 'queued':
+                st.write(f"Analysis queued, the worker is {status['state']}.")
+            elif job['state'] in ('scanning', 'running'):
+                st.write(f"Analyzing `{job['current'] or analysis_path}`")
+                st.progress(job['done'] / job['total'] if job['total'] else 0., text=f"{job['done']} of {job['total'] or '?'} tracks")
+            elif job['state'] == 'done':
+                st.write(f"Analysis complete! {job['done'] - len(job['failed'])} tracks analyzed.")
+            else:
+                st.write('The analysis failed:')
+                st.code(job['error'])
+
+            for audio_file, error in job['failed'].items():
+                st.write(f'Could not analyze `{audio_file}`: {error}')
+            if st.session_state['analysis_results']:
+                st.dataframe(st.session_state['analysis_results'])
+            if job['state'] not in ('done', 'failed'):
+                st.button('Refresh')
 
     st.write('After running the analysis, you can (optionally) plot feature distributions by clicking on the button below')
     st.write('\n\n')
@@ -58,34 +97,27 @@ if playlist_option == "Welcome":
 
 elif playlist_option in ["Genre", "Tempo", "Instrumental/Voice", "Danceability", "Arousal-Valence", "Key and Scale"]:
 
-    # Load the analysis data
+    # Load the analysis data, all feature pages share the same query table (see query.py)
     if playlist_option == "Genre":
-        genre_analysis, genre_analysis_styles = ut.load_genre_analysis()
-    elif playlist_option == "Tempo":
-        tempo_analysis = ut.load_tempo_analysis()
-    elif playlist_option == "Instrumental/Voice":
-        instrumental_analysis = ut.load_instrumental_analysis()
-    elif playlist_option == "Danceability":
-        danceability_analysis = ut.load_danceability_analysis()
-    elif playlist_option == "Arousal-Valence":
-        arousal_valence_analysis = ut.load_arousal_valence_analysis()
-    elif playlist_option == "Key and Scale":
-        key_scale_analysis = ut.load_key_scale_analysis()
+        genre_table, genre_analysis_styles = ut.load_genre_query_table()
+        genre_activations, _ = ut.load_genre_analysis()
+    else:
+        table = ut.load_feature_query_table()
 
     if playlist_option == "Genre":
         st.write('# Genre analysis playlist')
         st.write(f'Using analysis data from `{GENRE_ANALYSIS_PATH}`.')
-        st.write('Loaded audio analysis for', len(genre_analysis), 'tracks.')
+        st.write('Loaded audio analysis for', len(genre_table), 'tracks.')
 
         st.write('## 🔍 Select')
         st.write('### By style')
         st.write('Style activation statistics:')
-        st.write(genre_analysis.describe())
+        st.write(genre_activations.describe(genre_analysis_styles))
 
         style_select = st.multiselect('Select by style activations:', genre_analysis_styles)
         if style_select:
             # Show the distribution of activation values for the selected styles.
-            st.write(genre_analysis[style_select].describe())
+            st.write(genre_table.frame(genre_table.query().rows(), style_select).describe())
 
             style_select_str = ', '.join(style_select)
             style_select_range = st.slider(f'Select tracks with `{style_select_str}` activations within range:', value=[0.5, 1.])
@@ -99,35 +131,24 @@ elif playlist_option in ["Genre", "Tempo", "Instrumental/Voice", "Danceability",
 
         if st.button("RUN"):
             st.write('## 🔊 Results')
-            mp3s = list(genre_analysis.index)
-
-            if style_select:
-                genre_analysis_query = genre_analysis.loc[mp3s][style_select]
-
-                result = genre_analysis_query
-                for style in style_select:
-                    result = result.loc[result[style] >= style_select_range[0]]
-                st.write(result)
-                mp3s = result.index
+            genre_query = genre_table.query()
+            for style in style_select:
+                genre_query = genre_query.range(style, *style_select_range)
 
             if style_rank:
-                genre_analysis_query = genre_analysis.loc[mp3s][style_rank]
-                genre_analysis_query['RANK'] = genre_analysis_query[style_rank[0]]
-                for style in style_rank[1:]:
-                    genre_analysis_query['RANK'] *= genre_analysis_query[style]
-                ranked = genre_analysis_query.sort_values(['RANK'], ascending=[False])
-                ranked = ranked[['RANK'] + style_rank]
-                mp3s = list(ranked.index)
-
+                rows = genre_query.rank(style_rank, k=max_tracks)
                 st.write('Applied ranking by audio style predictions.')
-                st.write(ranked)
+            else:
+                rows = genre_query.rows()
+            st.write(genre_table.frame(rows, style_select + [style for style in style_rank if style not in style_select]))
 
-            ut.display_tracks(mp3s, max_tracks, shuffle, m3u_filepath='playlists/genre_playlist.m3u8')
+            ut.display_tracks(genre_table.tracks(rows), max_tracks, shuffle, m3u_filepath='playlists/genre_playlist.m3u8')
 
     if playlist_option == "Tempo":
 
-        min_tempo = tempo_analysis['tempo'].min()
-        max_tempo = tempo_analysis['tempo'].max()
+        order, tempos = table.sorted_rows('tempo')
+        min_tempo = float(tempos[0])
+        max_tempo = float(tempos[-1])
 
         st.write('# ⏳ Playlist by tempo')
         tempo_select = st.slider('Filter by tempo:', min_value=min_tempo, max_value=max_tempo, value=(min_tempo, max_tempo))
@@ -139,28 +160,11 @@ elif playlist_option in ["Genre", "Tempo", "Instrumental/Voice", "Danceability",
 
         if st.button("RUN"):
             st.write('## 🔊 Results')
-            mp3s = list(tempo_analysis.index)
-
-            tempo_analysis_query = tempo_analysis.loc[mp3s]
-            result = tempo_analysis_query
-            result = result.loc[(result['tempo'] >= tempo_select[0]) & (result['tempo'] <= tempo_select[1])]
-            st.write(result)
-            mp3s = result.index
-
-            if tempo_rank == 'Ascending':
-                tempo_analysis_query = tempo_analysis.loc[mp3s]
-                ranked = tempo_analysis_query.sort_values(['tempo'], ascending=[True])
-                mp3s = list(ranked.index)
-                st.write('Applied ranking by tempo.')
-                st.write(ranked)
-            elif tempo_rank == 'Descending':
-                tempo_analysis_query = tempo_analysis.loc[mp3s]
-                ranked = tempo_analysis_query.sort_values(['tempo'], ascending=[False])
-                mp3s = list(ranked.index)
-                st.write('Applied ranking by tempo.')
-                st.write(ranked)
-
-            ut.display_tracks(mp3s, max_tracks, shuffle, m3u_filepath='playlists/tempo_playlist.m3u8')
+            rows = table.query().range('tempo', *tempo_select).rank('tempo', ascending=tempo_rank == 'Ascending', k=max_tracks)
+            st.write('Applied ranking by tempo.')
+            st.write(table.frame(rows, ['tempo']))
+
+            ut.display_tracks(table.tracks(rows), max_tracks, shuffle, m3u_filepath='playlists/tempo_playlist.m3u8')
 
     if playlist_option == "Instrumental/Voice":
 
@@ -172,15 +176,10 @@ elif playlist_option in ["Genre", "Tempo", "Instrumental/Voice", "Danceability",
 
         if st.button("RUN"):
             st.write('## 🔊 Results')
-            mp3s = list(instrumental_analysis.index)
+            rows = table.query().equal('instrumental', instrumental_select).rows()
+            st.write(table.frame(rows, ['instrumental']))
 
-            instrumental_analysis_query = instrumental_analysis.loc[mp3s]
-            result = instrumental_analysis_query
-            result = result.loc[(result['Instrumental/Voice'] == instrumental_select)]
-            st.write(result)
-            mp3s = result.index
-
-            ut.display_tracks(mp3s, max_tracks, shuffle, m3u_filepath=f'playlists/{instrumental_select}_playlist.m3u8')
+            ut.display_tracks(table.tracks(rows), max_tracks, shuffle, m3u_filepath=f'playlists/{instrumental_select}_playlist.m3u8')
 
     if playlist_option == "Danceability":
 
@@ -197,28 +196,11 @@ elif playlist_option in ["Genre", "Tempo", "Instrumental/Voice", "Danceability",
 
         if st.button("RUN"):
             st.write('## 🔊 Results')
-            mp3s = list(danceability_analysis.index)
-
-            danceability_analysis_query = danceability_analysis.loc[mp3s]
-            result = danceability_analysis_query
-            result = result.loc[(result['danceability'] >= danceability_select[0]) & (result['danceability'] <= danceability_select[1])]
-            st.write(result)
-            mp3s = result.index
-
-            if danceability_rank == 'Ascending':
-                danceability_analysis_query = danceability_analysis.loc[mp3s]
-                ranked = danceability_analysis_query.sort_values(['danceability'], ascending=[True])
-                mp3s = list(ranked.index)
-                st.write('Applied ranking by danceability.')
-                st.write(ranked)
-            elif danceability_rank == 'Descending':
-                danceability_analysis_query = danceability_analysis.loc[mp3s]
-                ranked = danceability_analysis_query.sort_values(['danceability'], ascending=[False])
-                mp3s = list(ranked.index)
-                st.write('Applied ranking by danceability.')
-                st.write(ranked)
-
-            ut.display_tracks(mp3s, max_tracks, shuffle, m3u_filepath='playlists/danceability_playlist.m3u8')
+            rows = table.query().range('danceability', *danceability_select).rank('danceability', ascending=danceability_rank == 'Ascending', k=max_tracks)
+            st.write('Applied ranking by danceability.')
+            st.write(table.frame(rows, ['danceability']))
+
+            ut.display_tracks(table.tracks(rows), max_tracks, shuffle, m3u_filepath='playlists/danceability_playlist.m3u8')
             
     if playlist_option == "Arousal-Valence":
 
@@ -236,46 +218,18 @@ elif playlist_option in ["Genre", "Tempo", "Instrumental/Voice", "Danceability",
 
         if st.button("RUN"):
             st.write('## 🔊 Results')
-            mp3s = list(arousal_valence_analysis.index)
-
-            arousal_valence_analysis_query = arousal_valence_analysis.loc[mp3s]
-            result = arousal_valence_analysis_query
-            result = result.loc[(result['arousal'] >= arousal_select[0]) & (result['arousal'] <= arousal_select[1])
-                                & (result['valence'] >= valence_select[0]) & (result['valence'] <= valence_select[1])]
-            st.write(result)
-            mp3s = result.index
-
-            if arousal_valence_rank == 'Ascending arousal':
-                arousal_valence_analysis_query = arousal_valence_analysis.loc[mp3s]
-                ranked = arousal_valence_analysis_query.sort_values(['arousal'], ascending=[True])
-                mp3s = list(ranked.index)
-                st.write('Applied ranking by arousal.')
-                st.write(ranked)
-            elif arousal_valence_rank == 'Descending arousal':
-                arousal_valence_analysis_query = arousal_valence_analysis.loc[mp3s]
-                ranked = arousal_valence_analysis_query.sort_values(['arousal'], ascending=[False])
-                mp3s = list(ranked.index)
-                st.write('Applied ranking by arousal.')
-                st.write(ranked)
-            elif arousal_valence_rank == 'Ascending valence':
-                arousal_valence_analysis_query = arousal_valence_analysis.loc[mp3s]
-                ranked = arousal_valence_analysis_query.sort_values(['valence'], ascending=[True])
-                mp3s = list(ranked.index)
-                st.write('Applied ranking by valence.')
-                st.write(ranked)
-            elif arousal_valence_rank == 'Descending valence':
-                arousal_valence_analysis_query = arousal_valence_analysis.loc[mp3s]
-                ranked = arousal_valence_analysis_query.sort_values(['valence'], ascending=[False])
-                mp3s = list(ranked.index)
-                st.write('Applied ranking by valence.')
-                st.write(ranked)
-
-            ut.display_tracks(mp3s, max_tracks, shuffle, m3u_filepath='playlists/arousal_valence_playlist.m3u8')
+            direction, rank_column = arousal_valence_rank.split()
+            rows = (table.query().range('arousal', *arousal_select).range('valence', *valence_select)
+                    .rank(rank_column, ascending=direction == 'Ascending', k=max_tracks))
+            st.write(f'Applied ranking by {rank_column}.')
+            st.write(table.frame(rows, ['arousal', 'valence']))
+
+            ut.display_tracks(table.tracks(rows), max_tracks, shuffle, m3u_filepath='playlists/arousal_valence_playlist.m3u8')
 
     if playlist_option == "Key and Scale":
 
         st.write('# 🎹 Filter by Key and Scale')
-        key_select = st.selectbox('Select by key:', ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B'])
+        key_select = st.selectbox('Select by key:', ut.KEYS)
         scale_select = st.selectbox('Select by scale:', ['major', 'minor'])
         profile_select = st.selectbox('Select by profile:', ['Temperley', 'Krumhansl', 'Edma'])
         st.write('## 🔀 Post-process')
@@ -284,17 +238,8 @@ elif playlist_option in ["Genre", "Tempo", "Instrumental/Voice", "Danceability",
 
         if st.button("RUN"):
             st.write('## 🔊 Results')
-            mp3s = list(key_scale_analysis.index)
-            if profile_select == 'Temperley':
-                key_scale_analysis_query = key_scale_analysis.loc[mp3s]['keyTemperley']
-            elif profile_select == 'Krumhansl':
-                key_scale_analysis_query = key_scale_analysis.loc[mp3s]['keyKrumhansl']
-            elif profile_select == 'Edma':
-                key_scale_analysis_query = key_scale_analysis.loc[mp3s]['keyEdma']
-            
-            result = key_scale_analysis_query
-            result = result.loc[(result == key_select + ' ' + scale_select)]
-            st.write(result)
-            mp3s = result.index
+            key_column, scale_column = f'key{profile_select}', f'scale{profile_select}'
+            rows = table.query().equal(key_column, key_select).equal(scale_column, scale_select).rows()
+            st.write(table.frame(rows, [key_column, scale_column]))
 
-            ut.display_tracks(mp3s, max_tracks, shuffle, m3u_filepath=f'playlists/{key_select}_{scale_select}_{profile_select}_playlist.m3u8')
\ No newline at end of file
+            ut.display_tracks(table.tracks(rows), max_tracks, shuffle, m3u_filepath=f'playlists/{key_select}_{scale_select}_{profile_select}_playlist.m3u8')
@@ -8,6 +8,12 @@ The embeddings are computed using the following models:
 You can select a query track from the list or input a track name. The app will then display the top 10 similar tracks based on the selected query track.
 
 The app uses cosine similarity to compute the similarity between the query track and the rest of the tracks in the dataset.
+Only the similarities of the query track are computed, see similarity.py. If an approximate nearest-neighbour index
+has been built with ann.py, only the tracks in the clusters closest to the query track are scored. If quantized
+embeddings have been saved with ann.py --quantize, they are loaded and searched instead of the float32 embeddings.
+
+The hybrid search ranks tracks by a weighted combination of both similarities, among the tracks that match optional
+tempo, key, instrumental/voice and danceability filters on the features table (see hybrid.py).
 
 The app also provides the option to play the selected track and create playlists based on the top similar tracks.
 
@@ -16,24 +22,70 @@ The app also provides the option to play the selected track and create playlists
 
 import streamlit as st
 import utils as ut
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+import store
+import ann
+import hybrid
 
 # File paths
-DISCOGS_EMBEDDINGS_PATH = 'data/discogs_effnet_embeddings.csv'
-MUSICNN_EMBEDDINGS_PATH = 'data/musicnn_embeddings.csv'
 AUDIO_PATH = 'audio'
 
-# Load discogs and musicnn embeddings as 2D numpy arrays
-discogs_embeddings = pd.read_csv(DISCOGS_EMBEDDINGS_PATH, header=None).to_numpy()[:, 1:]
-musicnn_embeddings = pd.read_csv(MUSICNN_EMBEDDINGS_PATH, header=None).to_numpy()[:, 1:]
-
-# Compute similarity matrices
-similarity_matrix_discogs = cosine_similarity(discogs_embeddings)
-similarity_matrix_musicnn = cosine_similarity(musicnn_embeddings)
-
-# Audio list is first column of discogs embeddings csv
-audio_list = pd.read_csv(DISCOGS_EMBEDDINGS_PATH, header=None, usecols=[0])[0].tolist()
+@st.cache_resource(show_spinner="Loading embeddings...")
+def load_similarity_index(name, mtime, _snapshot):
+    """
+    Load the normalized (or quantized) embeddings of a table and its ANN index (or fall back to exact search)
+
+    The resource is cached until the table is modified, mtime is only part of the cache key.
+
+    Parameters:
+    name (str): The name of the embeddings table
+    mtime (int): The modification time of the table
+    _snapshot (dict): The store snapshot to read the table from, the same for both embeddings tables
+
+    Returns:
+    audio_list (list): The audio file of each row
+    normalized (np.array or similarity.QuantizedEmbeddings): The normalized embeddings
+    index (ann.ExactIndex or ann.IVFIndex): The index used to query similar tracks
+    """
+    audio_list = store.read_table(name, columns=[], snapshot=_snapshot)['audio_file'].tolist()
+    normalized = ann.load_embeddings(name, _snapshot)
+
+    return audio_list, normalized, ann.load_index(name, normalized, _snapshot)
+
+@st.cache_resource(show_spinner="Building the hybrid index...")
+def load_hybrid_index(_audio_list, _discogs_normalized, _musicnn_normalized, discogs_mtime, musicnn_mtime, features_mtime):
+    """
+    Build the hybrid index of both embeddings and the features table, cached until one of the tables is modified
+
+    The arguments starting with an underscore are not hashed by Streamlit, the modification times are the cache key.
+
+    Parameters:
+    _audio_list (list): The audio file of each row of the embeddings tables
+    _discogs_normalized (np.array): The normalized Discogs-EffNet embeddings
+    _musicnn_normalized (np.array): The normalized MusiCNN embeddings
+    discogs_mtime (int): The modification time of the Discogs-EffNet embeddings table
+    musicnn_mtime (int): The modification time of the MusiCNN embeddings table
+    features_mtime (int): The modification time of the features table
+
+    Returns:
+    index (hybrid.HybridIndex): The hybrid index
+    """
+    # Align the features with the embeddings, tracks without features never match a filter
+    features = ut.load_feature_table().reindex(_audio_list)
+
+    return hybrid.HybridIndex(_discogs_normalized, _musicnn_normalized, features)
+
+# Load discogs and musicnn embeddings, normalized so that similarities to a query track are a single matrix-vector product
+# from the same snapshot of the store, so that rows published by the analysis meanwhile are in both or in neither. The
+# modification times are read first, so rows published after them change the cache key of the next run
+discogs_mtime, musicnn_mtime = store.table_mtime(store.DISCOGS_EMBEDDINGS_TABLE), store.table_mtime(store.MUSICNN_EMBEDDINGS_TABLE)
+snapshot = store.read_snapshot()
+audio_list, discogs_normalized, discogs_index = load_similarity_index(store.DISCOGS_EMBEDDINGS_TABLE, discogs_mtime, snapshot)
+musicnn_audio_list, musicnn_normalized, musicnn_index = load_similarity_index(store.MUSICNN_EMBEDDINGS_TABLE, musicnn_mtime, snapshot)
+
+# Both tables are written in the same order
+if audio_list != musicnn_audio_list:
+    st.error('The Discogs-EffNet and MusiCNN embeddings tables contain different tracks, run main.py or extract_embeddings.py again')
+    st.stop()
 
 ## MAIN PAGE ## -----------------------------------------------------------------------------------------------
 st.write('# Create playlists based on audio similarlity')
@@ -63,19 +115,41 @@ if track_select:
         # Get the index of the selected track
         track_index = audio_list.index(track_select)
 
-        # Compute similarity scores
-        discogs_similarities = similarity_matrix_discogs[track_index]
-        musicnn_similarities = similarity_matrix_musicnn[track_index]
-
-        # Sort the tracks based on similarity scores
-        discogs_sorted_indices = discogs_similarities.argsort()[::-1]
-        musicnn_sorted_indices = musicnn_similarities.argsort()[::-1]
+        # Get the 10 most similar tracks, excluding the query track
+        discogs_indices, _ = discogs_index.search(discogs_normalized[track_index], k=10, exclude=track_index)
+        musicnn_indices, _ = musicnn_index.search(musicnn_normalized[track_index], k=10, exclude=track_index)
 
-        # Display the top 10 similar tracks, ignore first track (it's the query track)
+        # Display the top 10 similar tracks
         st.write('## Discogs embeddings')
-        ut.display_tracks([audio_list[i] for i in discogs_sorted_indices[1:]], max_tracks=10, shuffle=False, m3u_filepath='playlists/discogs_playlist.m3u')
+        ut.display_tracks([audio_list[i] for i in discogs_indices], max_tracks=10, shuffle=False, m3u_filepath='playlists/discogs_playlist.m3u')
         st.write('## Musicnn embeddings')
-        ut.display_tracks([audio_list[i] for i in musicnn_sorted_indices[1:]], max_tracks=10, shuffle=False, m3u_filepath='playlists/musicnn_playlist.m3u')
+        ut.display_tracks([audio_list[i] for i in musicnn_indices], max_tracks=10, shuffle=False, m3u_filepath='playlists/musicnn_playlist.m3u')
+
+    st.write('## 🔀 Hybrid similarity')
+    discogs_weight = st.slider('Weight of the Discogs-EffNet similarity (the MusiCNN similarity gets the rest):', min_value=0., max_value=1., value=0.5)
+    constraints = {}
+    if st.checkbox('Filter by tempo'):
+        constraints['tempo'] = st.slider('Tempo range:', min_value=40., max_value=220., value=(90., 130.))
+    if st.checkbox('Filter by key and scale'):
+        profile_select = st.selectbox('Key profile:', ['Temperley', 'Krumhansl', 'Edma'])
+        constraints[f'key{profile_select}'] = st.selectbox('Key:', ut.KEYS)
+        constraints[f'scale{profile_select}'] = st.selectbox('Scale:', ['major', 'minor'])
+    if st.checkbox('Filter by instrumental/voice'):
+        constraints['instrumental'] = st.selectbox('Instrumental/voice:', ['Instrumental', 'Voice'])
+    if st.checkbox('Filter by danceability'):
+        constraints['danceability'] = st.slider('Danceability range:', min_value=0., max_value=1., value=(0.5, 1.))
+
+    if st.button("RUN hybrid"):
+        hybrid_index = load_hybrid_index(audio_list, discogs_normalized, musicnn_normalized, discogs_mtime, musicnn_mtime,
+                                         store.table_mtime(store.FEATURES_TABLE))
+        hybrid_indices, hybrid_scores = hybrid_index.search(audio_list.index(track_select), k=10, discogs_weight=discogs_weight, constraints=constraints)
+
+        st.write('## Hybrid similarity')
+        if len(hybrid_indices) == 0:
+            st.write('No tracks match the filters')
+        else:
+            st.write({audio_list[i]: float(score) for i, score in zip(hybrid_indices, hybrid_scores)})
+            ut.display_tracks([audio_list[i] for i in hybrid_indices], max_tracks=10, shuffle=False, m3u_filepath='playlists/hybrid_playlist.m3u')
 
 else:
     st.write('No track/incorrect track selected')
\ No newline at end of file
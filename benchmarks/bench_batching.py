@@ -0,0 +1,59 @@
+"""
+Benchmark of the feature extraction throughput with and without batching the classifier models across tracks.
+
+Audio files are decoded before timing, so only EssentiaClasses.extract_features (one track at a time) and
+EssentiaClasses.extract_features_batch (several tracks per classifier model call) are measured. Synthetic clips (see
+benchmarks/fixtures.py) are analyzed unless --audio is given.
+Run from the repository root with: python3 -m benchmarks.bench_batching --tracks 64 --batch-tracks 8 16 32
+
+"""
+
+import argparse
+import tempfile
+import time
+import methods as m
+import main as analysis
+from benchmarks import fixtures
+
+
+def bench_per_track(audios):
+    start = time.perf_counter()
+    for audio_mono, audio_stereo in audios:
+        analysis.ess.extract_features(audio_mono, audio_stereo)
+
+    return len(audios) / (time.perf_counter() - start)
+
+
+def bench_batched(audios, batch_tracks):
+    start = time.perf_counter()
+    for i in range(0, len(audios), batch_tracks):
+        for _ in analysis.ess.extract_features_batch(audios[i:i + batch_tracks]):
+            pass
+
+    return len(audios) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the feature extraction throughput with batched classifier models")
+    parser.add_argument('--audio', default=None, help="Directory with the audio files to analyze (default: synthetic clips)")
+    parser.add_argument('--tracks', type=int, default=64, help="Number of audio files to analyze")
+    parser.add_argument('--clip-seconds', type=float, default=30, help="Length of the synthetic clips in seconds (default: 30)")
+    parser.add_argument('--batch-tracks', type=int, nargs='+', default=[4, 16, 64], help="Batch sizes to benchmark")
+    args = parser.parse_args()
+
+    analysis.init_essentia()
+    with tempfile.TemporaryDirectory() as directory:
+        audio_files = fixtures.benchmark_audio_files(args.audio, args.tracks, args.clip_seconds, directory)
+        audios = [m.load_audio_file(audio_file)[::-1] for audio_file in audio_files]
+
+    # Warm up the TensorFlow sessions
+    analysis.ess.extract_features(*audios[0])
+
+    print(f"{'batch tracks':>12} {'tracks/s':>9}")
+    print(f"{'per track':>12} {bench_per_track(audios):>9.2f}")
+    for batch_tracks in args.batch_tracks:
+        print(f"{batch_tracks:>12} {bench_batched(audios, batch_tracks):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark and check of the fused key estimation against one KeyExtractor per key profile.
+
+Audio files are decoded before timing. Synthetic clips (see benchmarks/fixtures.py) are analyzed unless --audio is given.
+The script reports the time per track of both implementations and the number of tracks whose
+key or scale differ, which must be 0, and the largest difference between their key strengths.
+Run from the repository root with: python3 -m benchmarks.bench_key --tracks 32
+
+"""
+
+import argparse
+import tempfile
+import time
+import essentia.standard as es
+import methods as m
+from benchmarks import fixtures
+
+PROFILE_TYPES = ['temperley', 'krumhansl', 'edma']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the fused key estimation with one KeyExtractor per key profile")
+    parser.add_argument('--audio', default=None, help="Directory with the audio files to analyze (default: synthetic clips)")
+    parser.add_argument('--tracks', type=int, default=32, help="Number of audio files to analyze")
+    parser.add_argument('--clip-seconds', type=float, default=30, help="Length of the synthetic clips in seconds (default: 30)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        audio_files = fixtures.benchmark_audio_files(args.audio, args.tracks, args.clip_seconds, directory)
+        audios = [m.load_audio_file(audio_file)[1] for audio_file in audio_files]
+
+    extractors = {profileType: es.KeyExtractor(profileType=profileType) for profileType in PROFILE_TYPES}
+    estimator = m.KeyEstimator(PROFILE_TYPES)
+
+    reference_time = fused_time = 0
+    mismatches = 0
+    max_strength_difference = 0
+    for audio_mono in audios:
+        start = time.perf_counter()
+        reference = {profileType: extractor(audio_mono) for profileType, extractor in extractors.items()}
+        reference_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        fused = estimator(audio_mono)
+        fused_time += time.perf_counter() - start
+
+        for profileType in PROFILE_TYPES:
+            mismatches += tuple(reference[profileType][:2]) != fused[profileType][:2]
+            max_strength_difference = max(max_strength_difference, abs(reference[profileType][2] - fused[profileType][2]))
+
+    tracks = len(audios)
+    print(f"{'KeyExtractor x3':>16} {reference_time / tracks:.3f} s per track")
+    print(f"{'KeyEstimator':>16} {fused_time / tracks:.3f} s per track")
+    print(f"Key or scale mismatches: {mismatches}, largest strength difference: {max_strength_difference:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Report of the memory and top-10 accuracy of the float16 and int8 quantized embeddings against the float32 embeddings.
+
+By default the embeddings tables of the store are used. With --synthetic N, N random embeddings drawn around cluster
+centres are used instead, with the dimensions of the Discogs-EffNet (1280) or MusiCNN (200) embeddings.
+Run from the repository root with: python3 -m benchmarks.bench_quantization [--synthetic 100000]
+
+"""
+
+import argparse
+import time
+import numpy as np
+import ann
+import similarity
+import store
+
+
+def synthetic_embeddings(tracks, dims, clusters=100, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dims), dtype=np.float32)
+
+    return centres[rng.integers(clusters, size=tracks)] + 0.5 * rng.standard_normal((tracks, dims), dtype=np.float32)
+
+
+def report(name, normalized, queries):
+    """
+    Print the memory, recall@10 and query time of exact search on each quantization of normalized embeddings
+
+    Parameters:
+    name (str): The name of the embeddings
+    normalized (np.array): The normalized float32 embeddings
+    queries (np.array): The indices of the query tracks
+
+    Returns:
+    None
+    """
+    for quantization in ['float32'] + similarity.QUANTIZATIONS:
+        embeddings = normalized if quantization == 'float32' else similarity.quantize(normalized, quantization)
+        recall, query_time = ann.recall_at_k(ann.ExactIndex(embeddings), normalized, queries)
+        print(f"{name:>20} {quantization:>8} {embeddings.nbytes / 2**20:>12.1f} {normalized.nbytes / embeddings.nbytes:>8.1f}x "
+              f"{recall:>10.3f} {query_time * 1000:>11.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the memory and top-10 accuracy of quantized embeddings")
+    parser.add_argument('--synthetic', type=int, default=None, metavar='N', help="Use N synthetic embeddings instead of the store tables")
+    parser.add_argument('--queries', type=int, default=200, help="Number of random query tracks used to compute the recall")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        embeddings = {'discogs (synthetic)': synthetic_embeddings(args.synthetic, 1280), 'musicnn (synthetic)': synthetic_embeddings(args.synthetic, 200)}
+    else:
+        embeddings = {name: store.read_table(name, mmap=True)['embedding'] for name in [store.DISCOGS_EMBEDDINGS_TABLE, store.MUSICNN_EMBEDDINGS_TABLE]}
+
+    print(f"{'embeddings':>20} {'dtype':>8} {'memory (MB)':>12} {'smaller':>9} {'recall@10':>10} {'query (ms)':>11}")
+    for name, values in embeddings.items():
+        normalized = similarity.normalize(values)
+        queries = np.random.default_rng(0).choice(len(normalized), size=min(args.queries, len(normalized)), replace=False)
+        report(name, normalized, queries)
+    print("recall@10 is the average fraction of the float32 top 10 neighbours found by exact search on the quantized embeddings.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark of the similarity query in app2.py: the full cosine similarity matrix against similarity.query.
+
+Uses random embeddings with the dimensions of the Discogs-EffNet (1280) or MusiCNN (200) embeddings.
+Run from the repository root with: python3 -m benchmarks.bench_similarity --tracks 2000 10000
+
+"""
+
+import argparse
+import time
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+import similarity
+
+
+def bench_full_matrix(embeddings, query_index, k):
+    # Approach used before: full N x N matrix, then a full argsort of one row
+    start = time.perf_counter()
+    similarity_matrix = cosine_similarity(embeddings)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sorted_indices = similarity_matrix[query_index].argsort()[::-1]
+    neighbours = [i for i in sorted_indices if i != query_index][:k]
+    query_time = time.perf_counter() - start
+
+    return neighbours, build_time, query_time, similarity_matrix.nbytes
+
+
+def bench_top_k(embeddings, query_index, k):
+    start = time.perf_counter()
+    normalized = similarity.normalize(embeddings)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    neighbours, _ = similarity.query(normalized, query_index, k)
+    query_time = time.perf_counter() - start
+
+    return list(neighbours), build_time, query_time, normalized.nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the full similarity matrix against on-demand top-k queries")
+    parser.add_argument('--tracks', type=int, nargs='+', default=[1000, 5000, 10000], help="Collection sizes to benchmark")
+    parser.add_argument('--dims', type=int, default=1280, help="Embedding dimensions (default: 1280, as Discogs-EffNet)")
+    parser.add_argument('--k', type=int, default=10, help="Number of similar tracks per query")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'tracks':>8} {'method':>12} {'build (s)':>10} {'query (ms)':>11} {'memory (MB)':>12} {'same top-k':>11}")
+    for n in args.tracks:
+        embeddings = rng.standard_normal((n, args.dims), dtype=np.float32)
+        query_index = int(rng.integers(n))
+
+        results = {
+            'full matrix': bench_full_matrix(embeddings, query_index, args.k),
+            'top-k': bench_top_k(embeddings, query_index, args.k),
+        }
+        reference = results['full matrix'][0]
+        for method, (neighbours, build_time, query_time, nbytes) in results.items():
+            print(f"{n:>8} {method:>12} {build_time:>10.3f} {query_time * 1000:>11.3f} {nbytes / 2**20:>12.1f} {str(neighbours == reference):>11}")
+
+
+if __name__ == "__main__":
+    main()
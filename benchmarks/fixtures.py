@@ -0,0 +1,145 @@
+"""
+Synthetic fixtures for the benchmarks, generated locally so that results do not depend on an audio collection.
+
+write_audio_clips writes sine and noise clips of a configurable length as wav files. write_tables writes features,
+genre predictions and embeddings tables with a configurable number of tracks to the store.
+
+"""
+
+import os
+import numpy as np
+import activations
+import similarity
+import store
+
+SCALES = ['major', 'minor']
+DISCOGS_DIMS = 1280
+MUSICNN_DIMS = 200
+GENRE_STYLES = 400
+
+
+def synthetic_audio(seconds, sample_rate=44100, seed=0):
+    """
+    Generate a stereo clip of chords of sines with harmonics, over a low level of noise
+
+    Parameters:
+    seconds (float): The length of the clip
+    sample_rate (int): The sample rate of the clip
+    seed (int): The random seed of the chords and the noise
+
+    Returns:
+    audio_stereo (np.array): The clip, one column per channel
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = np.zeros_like(t)
+
+    # A new chord every two seconds
+    for start in np.arange(0, seconds, 2.):
+        segment = (t >= start) & (t < start + 2)
+        root = rng.integers(40, 70)
+        for note in [root, root + rng.choice([3, 4]), root + 7]:
+            frequency = 440 * 2 ** ((note - 69) / 12)
+            for harmonic in range(1, 5):
+                audio[segment] += np.sin(2 * np.pi * frequency * harmonic * t[segment]) / harmonic
+    audio += 0.05 * rng.standard_normal(len(t))
+    audio = 0.5 * audio / max(np.abs(audio).max(), 1e-9)
+
+    return np.stack([audio, audio], axis=1).astype(np.float32)
+
+
+def write_audio_clips(directory, count, seconds, sample_rate=44100):
+    """
+    Write synthetic clips as wav files
+
+    Parameters:
+    directory (str): The directory to write the clips to
+    count (int): The number of clips
+    seconds (float): The length of each clip
+    sample_rate (int): The sample rate of the clips
+
+    Returns:
+    audio_files (list): The paths to the clips
+    """
+    # Only needed for the audio fixtures, the table fixtures do not depend on Essentia
+    import essentia.standard as es
+
+    os.makedirs(directory, exist_ok=True)
+    audio_files = []
+    for i in range(count):
+        audio_file = os.path.join(directory, f'clip-{i:04d}.wav')
+        es.AudioWriter(filename=audio_file, format='wav', sampleRate=sample_rate)(synthetic_audio(seconds, sample_rate, seed=i))
+        audio_files.append(audio_file)
+
+    return audio_files
+
+
+def benchmark_audio_files(audio, count, seconds, directory):
+    """
+    Find the audio files of a benchmark, or write synthetic clips if no audio directory is given
+
+    Parameters:
+    audio (str): The directory with the audio files to benchmark, None to write synthetic clips
+    count (int): The number of audio files
+    seconds (float): The length of each synthetic clip
+    directory (str): The directory to write the synthetic clips to, e.g. a temporary directory
+
+    Returns:
+    audio_files (list): The paths to the audio files
+    """
+    if audio is None:
+        return write_audio_clips(directory, count, seconds)
+
+    import methods as m
+    audio_files = m.search_audio_files(audio)[:count]
+    # Timings over no tracks would be meaningless
+    if not audio_files:
+        raise SystemExit(f"No audio files found in {audio}")
+
+    return audio_files
+
+
+def write_tables(tracks, seed=0, genre_activations='float32'):
+    """
+    Write random features, genre predictions and embeddings tables to the store
+
+    Parameters:
+    tracks (int): The number of tracks of each table
+    seed (int): The random seed
+    genre_activations (str): The storage representation of the genre activations, one of activations.REPRESENTATIONS
+
+    Returns:
+    audio_files (np.array): The audio file of each row
+    """
+    rng = np.random.default_rng(seed)
+    audio_files = np.array([f'audio/track-{i:07d}.mp3' for i in range(tracks)])
+
+    features = {'audio_file': audio_files, 'tempo': rng.uniform(60, 180, tracks).astype(np.float32)}
+    for profile in ['Temperley', 'Krumhansl', 'Edma']:
+        features[f'key{profile}'] = rng.choice(store.KEYS, tracks)
+        features[f'scale{profile}'] = rng.choice(SCALES, tracks)
+    features['loudness'] = rng.uniform(-30, -5, tracks).astype(np.float32)
+    features['instrumental'] = rng.choice(['Instrumental', 'Voice'], tracks)
+    features['danceability'] = rng.uniform(0, 1, tracks).astype(np.float32)
+    features['arousal'] = rng.uniform(1, 9, tracks).astype(np.float32)
+    features['valence'] = rng.uniform(1, 9, tracks).astype(np.float32)
+
+    # Sparse-looking activations, a few styles per track are high
+    genre_activations_matrix = rng.beta(0.3, 8, (tracks, GENRE_STYLES)).astype(np.float32)
+    genre_numbers = genre_activations_matrix.argmax(axis=1)
+    genre_predictions = {'audio_file': audio_files, 'genreNumber': genre_numbers, 'genre': np.array([f'style {i}' for i in genre_numbers]),
+                         'parentGenre': np.array([f'genre {i // 20}' for i in genre_numbers])}
+    genre_predictions.update(activations.encode(genre_activations_matrix, genre_activations))
+
+    tables = {
+        store.FEATURES_TABLE: features,
+        store.GENRE_PREDICTIONS_TABLE: genre_predictions,
+        store.DISCOGS_EMBEDDINGS_TABLE: {'audio_file': audio_files, 'embedding': similarity.normalize(rng.standard_normal((tracks, DISCOGS_DIMS), dtype=np.float32))},
+        store.MUSICNN_EMBEDDINGS_TABLE: {'audio_file': audio_files, 'embedding': similarity.normalize(rng.standard_normal((tracks, MUSICNN_DIMS), dtype=np.float32))},
+    }
+    for name, table in tables.items():
+        store.clear(name)
+        os.makedirs(store.table_path(name))
+        store.write_table(name, table)
+
+    return audio_files
@@ -0,0 +1,267 @@
+"""
+Reproducible benchmark suite for the analysis and the playlist query paths.
+
+The benchmarks run on synthetic fixtures (see fixtures.py): sine and noise clips for the analysis, and random features,
+genre predictions (in the --genre-activations representation) and embeddings tables of --tracks rows, written to a
+temporary store, for the apps.
+
+- load_audio_file: decoding, downmixing and resampling one clip
+- extract_features: the features, embeddings and classifier models of one decoded clip (needs the model weights)
+- load_feature_table, load_genre_analysis: the table loaders of utils.py, without the Streamlit cache
+- tempo filter/rank, key filter, genre filter/rank: the filter and rank steps of the app.py pages
+- similarity query: the exact top-10 query of app2.py, and the same query on an IVF index (see ann.py)
+- startup: the cold start of a fresh Python process importing methods.py, running main.py --help, importing utils.py
+  (the first import of the apps) and building all Essentia extractors and models. Commands that fail here, e.g. when
+  Streamlit or the model weights are missing, are skipped
+
+The median time of each benchmark is appended with the git commit and the parameters to a JSON lines history file,
+and compared with the last entry with the same parameters so that regressions show up across commits.
+Run from the repository root with: python3 -m benchmarks.suite --tracks 10000
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import activations
+import store
+from benchmarks import fixtures
+
+HISTORY_FILE_PATH = 'benchmarks/history.jsonl'
+BENCHMARKS = ['load_audio_file', 'extract_features', 'load_feature_table', 'load_genre_analysis',
+              'tempo filter/rank', 'key filter', 'genre filter/rank', 'similarity query', 'ivf query',
+              'startup import methods', 'startup main.py --help', 'startup import utils', 'startup load models']
+
+# Command of each startup benchmark, run in a fresh Python process from the repository root
+STARTUP_COMMANDS = {
+    'startup import methods': ['-c', 'import methods'],
+    'startup main.py --help': ['main.py', '--help'],
+    'startup import utils': ['-c', 'import utils'],
+    'startup load models': ['-c', 'import methods; methods.EssentiaClasses(preload=methods.EssentiaClasses.extractors)'],
+}
+
+
+def measure(function, repeats):
+    """
+    Time a function over several runs
+
+    Parameters:
+    function (function): The function to time, called without arguments
+    repeats (int): The number of runs
+
+    Returns:
+    timings (dict): The median, minimum and maximum time of a run in seconds
+    """
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    return {'median': float(np.median(durations)), 'min': float(np.min(durations)), 'max': float(np.max(durations))}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def analysis_benchmarks(names, args, directory):
+    """
+    Benchmark the loading and feature extraction of synthetic clips
+
+    Parameters:
+    names (list): The benchmarks to run
+    args (argparse.Namespace): The command line arguments
+    directory (str): The directory for the clips
+
+    Returns:
+    results (dict): The timings of each benchmark, per clip
+    """
+    import methods as m
+
+    audio_files = fixtures.write_audio_clips(os.path.join(directory, 'audio'), args.clips, args.clip_seconds)
+    results = {}
+
+    if 'load_audio_file' in names:
+        results['load_audio_file'] = measure(lambda: m.load_audio_file(audio_files[0]), args.repeats)
+
+    if 'extract_features' in names:
+        import main
+        main.init_essentia()
+        audios = [m.load_audio_file(audio_file) for audio_file in audio_files]
+        # Warm up the TensorFlow sessions
+        main.ess.extract_features(audios[0][1], audios[0][0])
+        results['extract_features'] = measure(lambda: [main.ess.extract_features(audio_mono, audio_stereo) for audio_stereo, audio_mono in audios], args.repeats)
+        results['extract_features'] = {stat: value / len(audios) for stat, value in results['extract_features'].items()}
+
+    return results
+
+
+def app_benchmarks(names, args):
+    """
+    Benchmark the table loaders and the queries of the apps on synthetic tables in the current store
+
+    Parameters:
+    names (list): The benchmarks to run
+    args (argparse.Namespace): The command line arguments
+
+    Returns:
+    results (dict): The timings of each benchmark
+    """
+    results = {}
+    fixtures.write_tables(args.tracks, genre_activations=args.genre_activations)
+
+    if {'load_feature_table', 'load_genre_analysis', 'tempo filter/rank', 'key filter', 'genre filter/rank'} & set(names):
+        import utils as ut
+        # Bypass the Streamlit cache, which would only measure a cache hit after the first run
+        features = ut._load_feature_table.__wrapped__(0)
+        _, styles = ut._load_genre_activations.__wrapped__(0, 0)
+
+        if 'load_feature_table' in names:
+            results['load_feature_table'] = measure(lambda: ut._load_feature_table.__wrapped__(0), args.repeats)
+        if 'load_genre_analysis' in names:
+            results['load_genre_analysis'] = measure(lambda: ut._load_genre_activations.__wrapped__(0, 0), args.repeats)
+
+        # The filter and rank steps of the Tempo, Key and Scale and Genre pages of app.py, on the query tables of utils.py
+        import query
+        table = query.FeatureTable.from_frame(features)
+        genre_table, _ = ut._load_genre_query_table.__wrapped__(0, 0)
+
+        def tempo_filter_rank():
+            return table.tracks(table.query().range('tempo', 90, 130).rank('tempo'))
+
+        def key_filter():
+            return table.tracks(table.query().equal('keyTemperley', 'A').equal('scaleTemperley', 'minor').rows())
+
+        def genre_filter_rank():
+            genre_query = genre_table.query().range(styles[0], 0.01, 1).range(styles[1], 0.01, 1)
+            return genre_table.tracks(genre_query.rank(styles[2:4]))
+
+        for name, function in [('tempo filter/rank', tempo_filter_rank), ('key filter', key_filter), ('genre filter/rank', genre_filter_rank)]:
+            if name in names:
+                results[name] = measure(function, args.repeats)
+
+    if {'similarity query', 'ivf query'} & set(names):
+        import ann
+        normalized = ann.read_normalized(store.DISCOGS_EMBEDDINGS_TABLE)
+        queries = iter(np.random.default_rng(0).integers(len(normalized), size=args.repeats * 2))
+
+        def search(index):
+            query_index = next(queries)
+            return index.search(normalized[query_index], k=10, exclude=query_index)
+
+        if 'similarity query' in names:
+            exact = ann.ExactIndex(normalized)
+            results['similarity query'] = measure(lambda: search(exact), args.repeats)
+        if 'ivf query' in names:
+            ivf = ann.IVFIndex.build(normalized)
+            results['ivf query'] = measure(lambda: search(ivf), args.repeats)
+
+    return results
+
+
+def startup_benchmarks(names, args):
+    """
+    Benchmark the cold start of the scripts and apps, each run starts a new Python process
+
+    Parameters:
+    names (list): The benchmarks to run
+    args (argparse.Namespace): The command line arguments
+
+    Returns:
+    results (dict): The timings of each benchmark
+    """
+    results = {}
+    for name, command in STARTUP_COMMANDS.items():
+        if name not in names:
+            continue
+
+        def run():
+            return subprocess.run([sys.executable] + command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # Also warms up the file system cache, so that only the Python and library startup is measured
+        if run().returncode != 0:
+            print(f"Skipping {name}, the command failed: python3 {' '.join(command)}")
+            continue
+        results[name] = measure(run, args.repeats)
+
+    return results
+
+
+def load_history(file_path):
+    if not os.path.exists(file_path):
+        return []
+
+    with open(file_path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def report(entry, previous):
+    """
+    Print the results of a run and their change since the previous run with the same parameters
+
+    Parameters:
+    entry (dict): The history entry of this run
+    previous (dict): The previous history entry with the same parameters, or None
+
+    Returns:
+    None
+    """
+    print(f"{'benchmark':>24} {'median (ms)':>12} {'min (ms)':>10} {'change':>8}")
+    for name, timings in entry['results'].items():
+        change = ''
+        if previous and name in previous['results']:
+            change = f"{timings['median'] / previous['results'][name]['median'] - 1:+.0%}"
+        print(f"{name:>24} {timings['median'] * 1000:>12.3f} {timings['min'] * 1000:>10.3f} {change:>8}")
+    if previous:
+        print(f"Change is relative to commit {previous['commit']} ({previous['date']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark suite on synthetic fixtures and append the results to the history")
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help="Benchmarks to run (default: all)")
+    parser.add_argument('--tracks', type=int, default=10000, help="Number of tracks of the synthetic tables (default: 10000)")
+    parser.add_argument('--genre-activations', choices=activations.REPRESENTATIONS, default='float32', help="Storage representation of the synthetic genre activations (default: float32)")
+    parser.add_argument('--clips', type=int, default=4, help="Number of synthetic audio clips (default: 4)")
+    parser.add_argument('--clip-seconds', type=float, default=30, help="Length of the synthetic audio clips in seconds (default: 30)")
+    parser.add_argument('--repeats', type=int, default=5, help="Number of timed runs of each benchmark (default: 5)")
+    parser.add_argument('--history', default=HISTORY_FILE_PATH, help=f"JSON lines file the results are appended to (default: {HISTORY_FILE_PATH})")
+    args = parser.parse_args()
+
+    params = {'tracks': args.tracks, 'genre_activations': args.genre_activations, 'clips': args.clips, 'clip_seconds': args.clip_seconds, 'repeats': args.repeats}
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        if {'load_audio_file', 'extract_features'} & set(args.benchmarks):
+            results.update(analysis_benchmarks(args.benchmarks, args, directory))
+
+        # Write the synthetic tables to a temporary store, so that the analysis results are left untouched
+        store_path = store.STORE_PATH
+        store.STORE_PATH = os.path.join(directory, 'store')
+        try:
+            results.update(app_benchmarks(args.benchmarks, args))
+        finally:
+            store.STORE_PATH = store_path
+
+    results.update(startup_benchmarks(args.benchmarks, args))
+
+    entry = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': platform.machine(),
+             'python': platform.python_version(), 'params': params, 'results': {name: results[name] for name in args.benchmarks if name in results}}
+    previous = next((old for old in reversed(load_history(args.history)) if old['params'] == params), None)
+    report(entry, previous)
+
+    with open(args.history, 'a') as file:
+        file.write(json.dumps(entry) + '\n')
+    print(f"Results appended to {args.history}")
+
+
+if __name__ == "__main__":
+    main()
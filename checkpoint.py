@@ -0,0 +1,219 @@
+"""
+Checkpoints of long analysis runs, so that an interrupted run of main.py can be resumed with --resume.
+
+Results are committed in batches: the buffered rows of every output table are written to their part files (each
+written to a temporary file, synced and renamed, see store.TableWriter.flush), the part files of all tables are
+published together (see store.publish), and only then are the tracks of the batch appended to the progress journal,
+which is synced as well. A track is complete once it is in the journal, so
+rows of an interrupted batch are dropped on resume and the batch is analyzed again. A line of the journal that was
+only partly written when the run stopped is ignored.
+
+Files that can not be decoded or analyzed are recorded in the journal with their error instead of stopping the run,
+and in the quarantine file at the end of the run. Incremental runs skip quarantined files until they are modified.
+
+"""
+
+import csv
+import json
+import os
+import time
+import methods as m
+import store
+
+JOURNAL_FILE_PATH = 'data/analysis_journal.jsonl'
+QUARANTINE_FILE_PATH = 'data/analysis_quarantine.csv'
+
+
+class Journal:
+    """
+    Append-only progress journal of an analysis run, one JSON record per line
+    """
+
+    def __init__(self, file_path=JOURNAL_FILE_PATH):
+        self.file_path = file_path
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def start(self, run):
+        """
+        Start the journal of a new run, replacing the journal of a previous run
+
+        Parameters:
+        run (dict): The options of the run needed to resume it, e.g. whether it is incremental
+
+        Returns:
+        None
+        """
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        with open(self.file_path, 'w') as file:
+            file.write(json.dumps({'run': dict(run, started=time.strftime('%Y-%m-%dT%H:%M:%S'))}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def append(self, record):
+        # Records are synced before the run continues, so a journaled batch survives a crash of the machine
+        with open(self.file_path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def load(self):
+        """
+        Load the journal of an interrupted run
+
+        Parameters:
+        None
+
+        Returns:
+        run (dict): The options of the run, None if there is no journal
+        completed (dict): The (size, mtime) signature of each completed audio file
+        failed (dict): The signature and the error of each audio file that could not be analyzed
+        """
+        if not self.exists():
+            return None, {}, {}
+
+        run, completed, failed = None, {}, {}
+        with open(self.file_path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line was being written when the run stopped
+                    break
+                if 'run' in record:
+                    run = record['run']
+                elif 'tracks' in record:
+                    completed.update((audio_file, (size, mtime)) for audio_file, size, mtime in record['tracks'])
+                elif 'failed' in record:
+                    failed[record['failed']] = (tuple(record['signature']), record['error'])
+
+        return run, completed, failed
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.file_path)
+
+
+class Checkpoint:
+    """
+    Commits the rows written to the output tables in batches, and records them in the journal
+    """
+
+    def __init__(self, writers, journal=None, signatures=None, batch_size=256):
+        """
+        Initialise the checkpoint
+
+        Parameters:
+        writers (dict): The table writer of each output table, created with publish=False, the checkpoint flushes and
+                        publishes them
+        journal (Journal): The progress journal, None to only flush the writers
+        signatures (dict): The signature of each audio file, missing signatures are read from the files
+        batch_size (int): The number of tracks committed at once
+
+        Returns:
+        None
+        """
+        self.writers = writers
+        self.journal = journal
+        self.signatures = signatures if signatures is not None else {}
+        self.batch_size = batch_size
+        self.pending = []
+        self.completed = {}
+        self.failed = {}
+
+    def signature(self, audio_file):
+        if audio_file not in self.signatures:
+            self.signatures[audio_file] = m.file_signature(audio_file)
+
+        return self.signatures[audio_file]
+
+    def add(self, audio_file):
+        """
+        Record a track whose rows were appended to the writers, the batch is committed once it is full
+
+        Parameters:
+        audio_file (str): The path to the audio file
+
+        Returns:
+        None
+        """
+        self.pending.append(audio_file)
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def fail(self, audio_file, error):
+        """
+        Quarantine a file that could not be analyzed
+
+        Parameters:
+        audio_file (str): The path to the audio file
+        error (str): The error
+
+        Returns:
+        None
+        """
+        try:
+            signature = self.signature(audio_file)
+        except OSError:
+            # The file was removed, it is not quarantined
+            return
+        self.failed[audio_file] = (signature, error)
+        if self.journal is not None:
+            self.journal.append({'failed': audio_file, 'signature': list(signature), 'error': error})
+
+    def commit(self):
+        """
+        Write the rows of the pending tracks to the tables and publish them, then record the tracks in the journal
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        if not self.pending:
+            return
+
+        for writer in self.writers.values():
+            writer.flush()
+        store.publish(self.writers.values())
+
+        tracks = {audio_file: self.signature(audio_file) for audio_file in self.pending}
+        if self.journal is not None:
+            self.journal.append({'tracks': [[audio_file, *signature] for audio_file, signature in tracks.items()]})
+        self.completed.update(tracks)
+        self.pending = []
+
+
+def load_quarantine():
+    """
+    Load the quarantined audio files
+
+    Parameters:
+    None
+
+    Returns:
+    quarantine (dict): The (size, mtime) signature and the error of each quarantined audio file
+    """
+    if not os.path.exists(QUARANTINE_FILE_PATH):
+        return {}
+
+    with open(QUARANTINE_FILE_PATH, newline='') as file:
+        return {audio_file: ((int(size), int(mtime)), error) for audio_file, size, mtime, error in csv.reader(file)}
+
+
+def write_quarantine(quarantine):
+    """
+    Write the quarantined audio files
+
+    Parameters:
+    quarantine (dict): The (size, mtime) signature and the error of each quarantined audio file
+
+    Returns:
+    None
+    """
+    with open(QUARANTINE_FILE_PATH, 'w', newline='') as file:
+        writer = csv.writer(file)
+        for audio_file, ((size, mtime), error) in quarantine.items():
+            writer.writerow([audio_file, size, mtime, error])
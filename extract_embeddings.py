@@ -1,48 +1,52 @@
 """
-This script extracts embeddings from audio files and writes them to a CSV file.
+This script extracts embeddings from audio files and writes them to the feature store (see store.py).
+
+main.py writes the same embeddings while analyzing the audio files, this script is only needed to extract the
+embeddings without running the feature extractors and classifier models, whose models are then never loaded.
 
 """
 
 
 from tqdm import tqdm
 import methods as m
-import pandas as pd
-import numpy as np
+import similarity
+import store
 
 # Set file path
-DISCOGS_EMBEDDINGS_PATH = 'data/discogs_effnet_embeddings.csv'
-MUSICNN_EMBEDDINGS_PATH = 'data/musicnn_embeddings.csv'
 AUDIOFILES_PATH = "audio"
 
-# Initialise essentia classes and load genre metadata
-ess = m.EssentiaClasses()
 
-# Search for audio files in the audiofiles directory
-audio_files = m.search_audio_files(AUDIOFILES_PATH)
+def main():
+    # Initialise essentia classes, only the two embedding models are loaded (on first use)
+    ess = m.EssentiaClasses()
+
+    # Search for audio files in the audiofiles directory
+    audio_files = m.search_audio_files(AUDIOFILES_PATH)
+
+    # Clear the embeddings tables
+    store.clear(store.DISCOGS_EMBEDDINGS_TABLE)
+    store.clear(store.MUSICNN_EMBEDDINGS_TABLE)
 
-# Initialse embeddings files and clear them
-open(DISCOGS_EMBEDDINGS_PATH, 'w').close()
-open(MUSICNN_EMBEDDINGS_PATH, 'w').close()
+    # Exract embeddings for each audio file and write to the store
+    with store.TableWriter(store.DISCOGS_EMBEDDINGS_TABLE, publish=False) as discogs_writer, store.TableWriter(store.MUSICNN_EMBEDDINGS_TABLE, publish=False) as musicnn_writer:
+        pbar = tqdm(audio_files)
+        for audio_file in pbar:
+            pbar.set_description(f"Extracting embeddings for {audio_file}")
 
-# Exract embeddings for each audio file and write to CSV
-pbar = tqdm(audio_files)
-for audio_file in pbar:
-    pbar.set_description(f"Extracting embeddings for {audio_file}")
+            # Load audio file and extract averaged embeddings
+            audio_stereo, audio_mono = m.load_audio_file(audio_file)
+            ess.extract_embeddings(audio_mono)
 
-    # Load audio file and extract embeddings
-    audio_stereo, audio_mono = m.load_audio_file(audio_file)
-    discogsEmbeddings = ess.getDiscogsEmbeddings(audio_mono)
-    musicnnEmbeddings = ess.getMusiCNNEmbeddings(audio_mono)
+            # Write the normalized embeddings to the store
+            discogs_writer.append({'audio_file': audio_file, 'embedding': similarity.normalize(ess.discogsEmbeddings)})
+            musicnn_writer.append({'audio_file': audio_file, 'embedding': similarity.normalize(ess.musicnnEmbeddings)})
 
-    # Average embeddings
-    discogsEmbeddings = discogsEmbeddings.mean(axis=0)
-    musicnnEmbeddings = musicnnEmbeddings.mean(axis=0)
+    # Publish both tables together, so that the similarity app always reads the same tracks from both
+    store.publish([discogs_writer, musicnn_writer])
+    store.compact([store.DISCOGS_EMBEDDINGS_TABLE, store.MUSICNN_EMBEDDINGS_TABLE])
 
-    # Write embeddings to CSV file
-    df = pd.DataFrame([np.concatenate(([audio_file], discogsEmbeddings))])
-    df.to_csv(DISCOGS_EMBEDDINGS_PATH, mode='a', header=False, index=False)
+    print("Finished analyzing all audio files")
 
-    df = pd.DataFrame([np.concatenate(([audio_file], musicnnEmbeddings))])
-    df.to_csv(MUSICNN_EMBEDDINGS_PATH, mode='a', header=False, index=False)
 
-print("Finished analyzing all audio files")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
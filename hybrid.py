@@ -0,0 +1,91 @@
+"""
+Hybrid similarity queries that combine the Discogs-EffNet and MusiCNN embeddings with constraints on the features.
+
+A track is scored by the weighted sum of its cosine similarities to the query track under both embedding models. Hard
+constraints on the features table (tempo range, key and scale, instrumental/voice, danceability range) are applied
+before scoring, as the predicates of a query on a query.FeatureTable: a categorical constraint compares the integer
+codes of the column and a range constraint is a binary search in its sorted order. Only the embeddings of the tracks
+that pass all constraints are scored, instead of scoring the whole collection and filtering the results afterwards.
+
+"""
+
+import numpy as np
+import query
+import similarity
+import store
+
+
+class HybridIndex:
+    """
+    Index that scores tracks by both embedding models, among the tracks that match the feature constraints
+    """
+
+    def __init__(self, discogs_normalized, musicnn_normalized, features):
+        """
+        Initialise the index and the query table of the features
+
+        Parameters:
+        discogs_normalized (np.array): The normalized Discogs-EffNet embeddings, or similarity.QuantizedEmbeddings
+        musicnn_normalized (np.array): The normalized MusiCNN embeddings, in the same track order
+        features (pd.DataFrame): The features of each track, in the same track order as the embeddings, with the
+                                 store.CATEGORICAL_COLUMNS as categoricals. Tracks without features (NaN rows) never
+                                 match a constraint
+
+        Returns:
+        None
+        """
+        self.discogs_normalized = discogs_normalized
+        self.musicnn_normalized = musicnn_normalized
+        self.table = query.FeatureTable.from_frame(features)
+
+    def mask(self, constraints):
+        """
+        Combine the masks of the feature constraints
+
+        Parameters:
+        constraints (dict): The value of each constrained categorical feature, and the (min, max) of each constrained
+                            numeric feature, e.g. {'keyEdma': 'A', 'scaleEdma': 'minor', 'tempo': (110, 130)}
+
+        Returns:
+        mask (np.array): Whether each track matches all constraints, None if there are no constraints
+        """
+        features = self.table.query()
+        for column, value in constraints.items():
+            if column in store.CATEGORICAL_COLUMNS:
+                features = features.equal(column, value)
+            elif column in self.table.columns:
+                features = features.range(column, *value)
+            else:
+                raise ValueError(f"Unknown feature constraint '{column}', expected one of {list(self.table.columns)}")
+
+        return features.mask()
+
+    def search(self, query_index, k=10, discogs_weight=0.5, constraints=None):
+        """
+        Find the tracks most similar to a query track under both models, among the tracks that match the constraints
+
+        Parameters:
+        query_index (int): The index of the query track
+        k (int): The number of similar tracks to return
+        discogs_weight (float): The weight of the Discogs-EffNet similarity, the MusiCNN similarity has 1 - discogs_weight
+        constraints (dict): The feature constraints, see mask
+
+        Returns:
+        indices (np.array): The indices of the most similar tracks, excluding the query track
+        scores (np.array): The weighted cosine similarities of these tracks to the query track
+        """
+        mask = self.mask(constraints or {})
+        discogs_query = self.discogs_normalized[query_index]
+        musicnn_query = self.musicnn_normalized[query_index]
+
+        if mask is None:
+            scores = discogs_weight * (self.discogs_normalized @ discogs_query) + (1 - discogs_weight) * (self.musicnn_normalized @ musicnn_query)
+            return similarity.top_k(scores, k, exclude=query_index)
+
+        # Only the embeddings of the matching tracks are gathered and scored
+        candidates = np.flatnonzero(mask)
+        candidates = candidates[candidates != query_index]
+        scores = discogs_weight * (self.discogs_normalized[candidates] @ discogs_query) + (1 - discogs_weight) * (self.musicnn_normalized[candidates] @ musicnn_query)
+        positions, scores = similarity.top_k(scores, k)
+
+        return candidates[positions], scores
@@ -1,64 +1,519 @@
 """
-This script is used to analyze audio files and extract features from them. The features are then written to a CSV file.
+This script is used to analyze audio files and extract features from them. The features are then written to the feature store (see store.py).
+
+Audio files are decoded and run through each embedding model once. The averaged Discogs-EffNet and MusiCNN embeddings
+used by the similarity app are written in the same pass, and the frame-level embeddings can be kept with --frame-embeddings.
+
+Tracks can be analyzed in parallel with the --workers option. Each worker process builds its own Essentia classes
+(so the TensorFlow graphs are loaded once per worker) and the main process collects and writes all results.
+
+With the --batch-tracks option the classifier models run once per batch of tracks instead of once per track.
+
+With the --pipeline option audio files are decoded by --decode-workers processes while the models run in the main
+process and a writer thread writes the results (see pipeline.py). The time spent in each stage is reported at the end.
+
+With the --profile option the wall time and memory of each stage (decoding, rhythm, key, loudness, each model and
+writing) are recorded per track to a profile log and summarized as percentiles at the end (see profiling.py).
+
+With the --incremental option only new or modified audio files are analyzed. Every analyzed file is recorded with its
+size and modification time in a manifest file, and rows of deleted or modified files are dropped from the store tables.
+
+Audio files are found by the parallel scanner of scan.py, and the analysis starts as soon as the first files are found
+(except with --incremental, which needs the whole listing first). With --scan-manifest the listing of each directory is
+kept, and directories that have not been modified since are not listed again.
+
+With the --genre-activations option the 400 genre activations of each track are stored as float32, float16 or as their
+top k values (see activations.py). Existing rows are converted when --incremental is used with another representation.
+
+Results are committed every --checkpoint-tracks tracks and recorded in a progress journal, and files that can not be
+decoded or analyzed are quarantined with their error instead of stopping the run (see checkpoint.py). An interrupted run
+is continued from its last committed batch with --resume. Incremental runs skip quarantined files until they are
+modified, or retry them with --retry-failed.
 
 """
 
 
-import pandas as pd
+import argparse
+import csv
+import multiprocessing as mp
+import os
+from functools import partial
+import numpy as np
 from tqdm import tqdm
+import activations
+import checkpoint
 import methods as m
+import pipeline
+import profiling
+import scan
+import similarity
+import store
 
 # Set file paths
 AUDIOFILES_PATH = "audio"
-FEATURES_FILE_PATH = 'data/features.csv'
-GENRE_PREDICTIONS_FILE_PATH = 'data/genre_predictions.csv'
+FRAME_EMBEDDINGS_PATH = 'data/frame_embeddings'
 METADATA_FILE_PATH = 'metadata/discogs-effnet-bs64-1.json'
 GENRE_COUNTS_FILE_PATH = 'data/genre_counts.tsv'
+MANIFEST_FILE_PATH = 'data/analysis_manifest.csv'
+
+# Store tables with one row per analyzed track
+OUTPUT_TABLES = [store.FEATURES_TABLE, store.GENRE_PREDICTIONS_TABLE, store.DISCOGS_EMBEDDINGS_TABLE, store.MUSICNN_EMBEDDINGS_TABLE]
+
+# Errors of a single audio file, which is quarantined: Essentia raises RuntimeError for files it can not decode or
+# analyze, e.g. corrupt or empty audio, and numpy raises ValueError for degenerate signals. Other errors, such as
+# m.ModelLoadError or errors of the configuration, affect every file and stop the run
+DECODE_ERRORS = (RuntimeError, OSError)
+ANALYSIS_ERRORS = (RuntimeError, ValueError)
+
+# Essentia classes of the current process, initialised on first use
+ess = None
+
+def init_essentia():
+    """
+    Initialise the essentia classes for the current process and load genre metadata
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    global ess
+    ess = m.EssentiaClasses()
+    ess.load_genre_metadata(METADATA_FILE_PATH)
+
+def analyze_audio_file(audio_file, frame_embeddings=False, analysis_window=None):
+    """
+    Load an audio file and extract its features and embeddings
+
+    Parameters:
+    audio_file (str): The path to the audio file
+    frame_embeddings (bool): Whether to also return the frame-level embeddings
+    analysis_window (float): If set, only the central analysis_window seconds of longer files are analyzed
+
+    Returns:
+    results (dict): The extracted features, genre predictions and averaged embeddings of the track
+    """
+    # Load audio file and extract features
+    with profiling.tracks([audio_file]):
+        audio_stereo, audio_mono = m.load_audio_file(audio_file, analysis_window)
+        discogsEmbeddings, musicnnEmbeddings = ess.extract_features(audio_mono, audio_stereo)
+
+        return collect_results(audio_file, discogsEmbeddings, musicnnEmbeddings, frame_embeddings)
+
+def decode_audio_file(audio_file, analysis_window=None):
+    """
+    Load an audio file, attributing its decoding to the file in the profile log
+
+    Parameters:
+    audio_file (str): The path to the audio file
+    analysis_window (float): If set, only the central analysis_window seconds of longer files are kept
+
+    Returns:
+    decoded (tuple): The audio signal and the downmixed audio signal resampled to 16kHz, or the error message if the
+                     file could not be decoded
+    """
+    with profiling.tracks([audio_file]):
+        try:
+            return m.load_audio_file(audio_file, analysis_window)
+        except DECODE_ERRORS as error:
+            # The error is returned instead of raised, so that one unreadable file does not stop the run
+            return format_error(error)
+
+def format_error(error):
+    return f'{type(error).__name__}: {error}'
+
+def analyze_audio_batch(audio_files, frame_embeddings=False, analysis_window=None):
+    """
+    Load a batch of audio files and extract their features and embeddings, running the classifier models once per batch
+
+    Parameters:
+    audio_files (list): The paths to the audio files
+    frame_embeddings (bool): Whether to also return the frame-level embeddings
+    analysis_window (float): If set, only the central analysis_window seconds of longer files are analyzed
+
+    Returns:
+    results (list): The results of each track as returned by analyze_audio_file, or the error of each file that could
+                    not be analyzed
+    """
+    return analyze_decoded_batch([(audio_file, decode_audio_file(audio_file, analysis_window)) for audio_file in audio_files], frame_embeddings)
+
+def analyze_decoded_batch(batch, frame_embeddings=False):
+    """
+    Extract the features and embeddings of a batch of decoded audio files, running the classifier models once per batch
+
+    Parameters:
+    batch (list): The path and the (audio_stereo, audio_mono) signals returned by decode_audio_file of each audio file
+    frame_embeddings (bool): Whether to also return the frame-level embeddings
+
+    Returns:
+    results (list): The results of each track as returned by analyze_audio_file, and the audio_file and error of each
+                    file that could not be decoded or analyzed
+    """
+    failed = [{'audio_file': audio_file, 'error': decoded} for audio_file, decoded in batch if isinstance(decoded, str)]
+    batch = [(audio_file, decoded) for audio_file, decoded in batch if not isinstance(decoded, str)]
+    if not batch:
+        return failed
+
+    audio_files = [audio_file for audio_file, _ in batch]
+    # extract_features_batch expects the mono signal first
+    audios = [decoded[::-1] for _, decoded in batch]
+
+    try:
+        with profiling.tracks(audio_files):
+            return failed + [collect_results(audio_file, discogsEmbeddings, musicnnEmbeddings, frame_embeddings)
+                             for audio_file, (discogsEmbeddings, musicnnEmbeddings) in zip(audio_files, ess.extract_features_batch(audios))]
+    except ANALYSIS_ERRORS as error:
+        if len(batch) == 1:
+            return failed + [{'audio_file': audio_files[0], 'error': format_error(error)}]
+        # Analyze the tracks of the batch one at a time, so that only the files that fail are quarantined
+        return failed + [results for item in batch for results in analyze_decoded_batch([item], frame_embeddings)]
+
+def collect_results(audio_file, discogsEmbeddings, musicnnEmbeddings, frame_embeddings=False):
+    """
+    Collect the features of the track last extracted by the essentia classes
+
+    Parameters:
+    audio_file (str): The path to the audio file
+    discogsEmbeddings (np.array): The Discogs-EffNet embeddings of each frame
+    musicnnEmbeddings (np.array): The MusiCNN embeddings of each frame
+    frame_embeddings (bool): Whether to include the frame-level embeddings
+
+    Returns:
+    results (dict): The extracted features, genre predictions and averaged embeddings of the track
+    """
+    results = {
+        'audio_file': audio_file,
+        'features': ess.write_features_dict(audio_file),
+        'genre_predictions': ess.write_genre_dict(audio_file),
+        'discogs_embeddings': ess.discogsEmbeddings,
+        'musicnn_embeddings': ess.musicnnEmbeddings,
+    }
+    if frame_embeddings:
+        results['frame_embeddings'] = {'discogs': discogsEmbeddings, 'musicnn': musicnnEmbeddings}
+
+    return results
+
+def write_frame_embeddings(audio_file, frame_embeddings):
+    """
+    Save the frame-level embeddings of one track to a .npz file mirroring the audio file path
+
+    Parameters:
+    audio_file (str): The path to the audio file
+    frame_embeddings (dict): The frame-level embeddings of each model
+
+    Returns:
+    None
+    """
+    file_path = os.path.join(FRAME_EMBEDDINGS_PATH, audio_file + '.npz')
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    np.savez(file_path, **frame_embeddings)
+
+def write_results(results, writers, genre_activations='float32'):
+    """
+    Append the results of one track to the features, genre predictions and embeddings tables
 
-# Initialise essentia classes and load genre metadata
-ess = m.EssentiaClasses()
-ess.load_genre_metadata(METADATA_FILE_PATH)
+    Parameters:
+    results (dict): The results returned by analyze_audio_file
+    writers (dict): The table writer of each output table
+    genre_activations (str): The storage representation of the genre activations, one of activations.REPRESENTATIONS
 
-def analyze_audio_files(audio_files):
+    Returns:
+    None
+    """
+    with profiling.tracks([results['audio_file']]), profiling.stage('write'):
+        writers[store.FEATURES_TABLE].append(results['features'])
+        genre_predictions = dict(results['genre_predictions'])
+        genre_predictions.update(activations.encode(genre_predictions.pop(activations.DENSE_COLUMN), genre_activations))
+        writers[store.GENRE_PREDICTIONS_TABLE].append(genre_predictions)
+        # Embeddings are stored normalized, so that the similarity app can memory-map them as they are
+        writers[store.DISCOGS_EMBEDDINGS_TABLE].append({'audio_file': results['audio_file'], 'embedding': similarity.normalize(results['discogs_embeddings'])})
+        writers[store.MUSICNN_EMBEDDINGS_TABLE].append({'audio_file': results['audio_file'], 'embedding': similarity.normalize(results['musicnn_embeddings'])})
 
-    pbar = tqdm(audio_files)
-    for audio_file in pbar:
-        pbar.set_description(f"Analyzing {audio_file}")
+        if 'frame_embeddings' in results:
+            write_frame_embeddings(results['audio_file'], results['frame_embeddings'])
 
-        # Load audio file and extract features
-        audio_stereo, audio_mono = m.load_audio_file(audio_file)
-        ess.extract_features(audio_mono, audio_stereo)
+def iter_batches(items, batch_size):
+    """
+    Split items into batches as they arrive
 
-        # Write features to CSV file
-        features_dict = ess.write_features_dict(audio_file)
-        df_features = pd.DataFrame([features_dict])
-        df_features.to_csv(FEATURES_FILE_PATH, mode='a', header=False, index=False)
-        
-        # Write genre predictions to CSV file
-        genre_predictions_dict = ess.write_genre_dict(audio_file)
-        df_genre_predictions = pd.DataFrame([genre_predictions_dict])
-        df_genre_predictions.to_csv(GENRE_PREDICTIONS_FILE_PATH, mode='a', header=False, index=False)
+    Parameters:
+    items (iterable): The items
+    batch_size (int): The number of items per batch, the last batch can be smaller
+
+    Yields:
+    batch (list): The next batch of items
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def record_signatures(entries, signatures):
+    """
+    Pass on the audio files found by scan.scan_audio_files, recording their signatures
+
+    Parameters:
+    entries (iterable): The (audio_file, signature) tuples
+    signatures (dict): The dictionary the signature of each audio file is added to
+
+    Yields:
+    audio_file (str): The path to the audio file
+    """
+    for audio_file, signature in entries:
+        signatures[audio_file] = signature
+        yield audio_file
+
+def analyze_audio_files(audio_files, workers=1, frame_embeddings=False, batch_tracks=1, decode_workers=0, analysis_window=None, genre_activations='float32',
+                        signatures=None, journal=None, checkpoint_tracks=store.BATCH_SIZE):
+    """
+    Analyze audio files and write their features and embeddings to the store tables, committing them in batches
+
+    Parameters:
+    audio_files (iterable): The paths to the audio files, a list or e.g. a generator of files as they are found
+    workers (int): The number of worker processes, 1 analyzes the files in the current process
+    frame_embeddings (bool): Whether to also save the frame-level embeddings
+    batch_tracks (int): The number of tracks whose embedding frames are run through the classifier models at once
+    decode_workers (int): The number of decoding processes of the staged pipeline, 0 decodes in the analysis processes
+    analysis_window (float): If set, only the central analysis_window seconds of longer files are analyzed
+    genre_activations (str): The storage representation of the genre activations, one of activations.REPRESENTATIONS
+    signatures (dict): The signature of each audio file found by the scan, recorded in the journal
+    journal (checkpoint.Journal): The progress journal the committed and failed tracks are recorded in, if any
+    checkpoint_tracks (int): The number of tracks committed to the store tables at once
+
+    Returns:
+    completed (dict): The (size, mtime) signature of each analyzed audio file
+    failed (dict): The signature and the error of each audio file that could not be analyzed
+    """
+    analyze = partial(analyze_audio_batch, frame_embeddings=frame_embeddings, analysis_window=analysis_window)
+    batches = iter_batches(audio_files, batch_tracks)
+    # The rows of a batch of tracks are written to the part files when the batch is committed
+    writers = {name: store.TableWriter(name, batch_size=checkpoint_tracks, publish=False) for name in OUTPUT_TABLES}
+    checkpoints = checkpoint.Checkpoint(writers, journal, signatures, batch_size=checkpoint_tracks)
+
+    def commit(results):
+        if 'error' in results:
+            checkpoints.fail(results['audio_file'], results['error'])
+        else:
+            write_results(results, writers, genre_activations)
+            checkpoints.add(results['audio_file'])
+
+    try:
+        # The total is unknown while the audio files are still being found, the bar is closed also on errors
+        with tqdm(total=len(audio_files) if isinstance(audio_files, list) else None, unit='track') as pbar:
+            if decode_workers > 0:
+                if ess is None:
+                    init_essentia()
+
+                def progress(results):
+                    pbar.set_description(f"Analyzed {results['audio_file']}")
+                    pbar.update(1)
+
+                stages = pipeline.Pipeline(partial(decode_audio_file, analysis_window=analysis_window), partial(analyze_decoded_batch, frame_embeddings=frame_embeddings), commit,
+                                           decode_workers=decode_workers, batch_size=batch_tracks, queue_size=max(8, 2 * batch_tracks))
+                timings = stages.run(audio_files, progress)
+            elif workers > 1:
+                # Spawn fresh processes so that no TensorFlow state is shared with the parent
+                with mp.get_context('spawn').Pool(workers, initializer=init_essentia) as pool:
+                    for batch_results in pool.imap_unordered(analyze, batches):
+                        pbar.set_description(f"Analyzed {batch_results[-1]['audio_file']}")
+                        for results in batch_results:
+                            commit(results)
+                        pbar.update(len(batch_results))
+            else:
+                if ess is None:
+                    init_essentia()
+
+                for batch in batches:
+                    pbar.set_description(f"Analyzing {batch[0]}")
+                    for results in analyze(batch):
+                        commit(results)
+                    pbar.update(len(batch))
+
+        if decode_workers > 0:
+            pipeline.report_timings(timings, pbar.n)
+    finally:
+        # Commit the analyzed tracks, also when the analysis is interrupted. Rows of a track that was being written
+        # are written as well but not journaled, so they are dropped when the run is resumed
+        checkpoints.commit()
+        for writer in writers.values():
+            writer.close()
+
+    # Merge the written batches so that the apps read contiguous columns
+    store.compact(OUTPUT_TABLES)
 
     print("Finished analyzing all audio files")
 
-def main():
-    # Search for audio files in the audiofiles directory
-    audio_files = m.search_audio_files(AUDIOFILES_PATH)
+    return checkpoints.completed, checkpoints.failed
 
-    # Initialse features.csv and genre_predicitons.csv and clear them
-    open(FEATURES_FILE_PATH, 'w').close()
-    open(GENRE_PREDICTIONS_FILE_PATH, 'w').close()
+def load_manifest():
+    """
+    Load the manifest of analyzed audio files
 
-    # Analyze audio files and write features to CSV
-    analyze_audio_files(audio_files)
+    Parameters:
+    None
 
-    print("Writing genre counts to genre_counts.tsv...")
-    # Extract specific genre predictions from genre_predictions.csv
-    genre_df = pd.read_csv(GENRE_PREDICTIONS_FILE_PATH, usecols=[2], header=None)
+    Returns:
+    manifest (dict): The (size, mtime) signature of each analyzed audio file, empty if there is no manifest
+    """
+    if not os.path.exists(MANIFEST_FILE_PATH):
+        return {}
+
+    with open(MANIFEST_FILE_PATH, newline='') as file:
+        return {audio_file: (int(size), int(mtime)) for audio_file, size, mtime in csv.reader(file)}
+
+def write_manifest(manifest):
+    """
+    Write the manifest of analyzed audio files
+
+    Parameters:
+    manifest (dict): The (size, mtime) signature of each analyzed audio file
+
+    Returns:
+    None
+    """
+    with open(MANIFEST_FILE_PATH, 'w', newline='') as file:
+        writer = csv.writer(file)
+        for audio_file, (size, mtime) in manifest.items():
+            writer.writerow([audio_file, size, mtime])
+
+def write_genre_counts():
+    """
+    Write the number of tracks of each genre in the genre predictions table
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    # No genre predictions were written, e.g. every file was quarantined
+    if not store.table_exists(store.GENRE_PREDICTIONS_TABLE):
+        return
+
+    # Extract specific genre predictions from the genre predictions table
+    genre_df = store.load_frame(store.GENRE_PREDICTIONS_TABLE, columns=['genre'])
     genre_df.columns = ['Genre']
 
     # Save the extracted genre predictions and number of occurrences to a new TSV file
     genre_df['Genre'].value_counts().to_csv(GENRE_COUNTS_FILE_PATH, sep='\t', header=['Count'])
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyze audio files and extract features from them")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes used for the analysis (default: 1)")
+    parser.add_argument('--batch-tracks', type=int, default=1, help="Number of tracks per classifier model batch (default: 1)")
+    parser.add_argument('--pipeline', action='store_true', help="Decode audio files in separate processes while the models run, and report the time of each stage")
+    parser.add_argument('--decode-workers', type=int, default=2, help="Number of decoding processes used with --pipeline (default: 2)")
+    parser.add_argument('--analysis-window', type=float, default=None, help="Only analyze the central number of seconds of longer audio files (they are still decoded whole)")
+    parser.add_argument('--incremental', action='store_true', help="Only analyze new or modified audio files and keep the existing results")
+    parser.add_argument('--resume', action='store_true', help=f"Continue the interrupted run recorded in {checkpoint.JOURNAL_FILE_PATH} from its last committed batch")
+    parser.add_argument('--retry-failed', action='store_true', help=f"Analyze the files quarantined in {checkpoint.QUARANTINE_FILE_PATH} again even if they were not modified")
+    parser.add_argument('--checkpoint-tracks', type=int, default=store.BATCH_SIZE, help=f"Number of tracks committed to the store and the journal at once (default: {store.BATCH_SIZE})")
+    parser.add_argument('--profile', nargs='?', const=profiling.PROFILE_LOG_PATH, default=None, metavar='LOG',
+                        help=f"Record the time and memory of each analysis stage per track to a profile log (default: {profiling.PROFILE_LOG_PATH}) and print a summary")
+    parser.add_argument('--scan-workers', type=int, default=scan.SCAN_WORKERS, help=f"Number of directories listed at once when searching for audio files (default: {scan.SCAN_WORKERS})")
+    parser.add_argument('--scan-manifest', nargs='?', const=scan.SCAN_MANIFEST_FILE_PATH, default=None, metavar='MANIFEST',
+                        help=f"Keep the listing of each directory in a manifest (default: {scan.SCAN_MANIFEST_FILE_PATH}) and only list the directories modified since the last scan")
+    parser.add_argument('--genre-activations', choices=activations.REPRESENTATIONS, default=None,
+                        help="Storage representation of the genre activations (default: the representation of the existing table, or float32)")
+    parser.add_argument('--frame-embeddings', action='store_true', help=f"Also save the frame-level embeddings of each track to {FRAME_EMBEDDINGS_PATH}")
+    args = parser.parse_args()
+    if args.pipeline and args.workers > 1:
+        parser.error("--pipeline runs the models in the main process and can not be combined with --workers")
+    if args.resume and (args.incremental or args.genre_activations or args.analysis_window or args.frame_embeddings):
+        parser.error("--resume continues with the options of the interrupted run")
+    return args
+
+def main():
+    args = parse_args()
+
+    if args.profile:
+        # Enable profiling before the worker processes are spawned, so that they write to the same log
+        if os.path.exists(args.profile):
+            os.remove(args.profile)
+        profiling.enable(args.profile)
+
+    journal = checkpoint.Journal()
+    completed, failed = {}, {}
+    if args.resume:
+        run, completed, failed = journal.load()
+        if run is None:
+            raise SystemExit(f"There is no interrupted run to resume, {checkpoint.JOURNAL_FILE_PATH} does not exist")
+        # Continue with the options that determine the rows of the interrupted run
+        args.incremental, args.analysis_window, args.frame_embeddings = run['incremental'], run['analysis_window'], run['frame_embeddings']
+        genre_activations = run['genre_activations']
+        print(f"Resuming the run started at {run['started']}, {len(completed)} audio files were analyzed and {len(failed)} failed")
+    else:
+        if journal.exists():
+            print(f"Discarding the interrupted run recorded in {checkpoint.JOURNAL_FILE_PATH}, use --resume to continue it instead")
+        genre_activations = args.genre_activations or activations.table_representation() or 'float32'
+        journal.start({'incremental': args.incremental, 'genre_activations': genre_activations,
+                       'analysis_window': args.analysis_window, 'frame_embeddings': args.frame_embeddings})
+
+    # Search for audio files in the audiofiles directory, the files are yielded as their directories are listed
+    scan_manifest = scan.ScanManifest(args.scan_manifest, m.AUDIO_FILE_TYPES) if args.scan_manifest else None
+    entries = scan.scan_audio_files(AUDIOFILES_PATH, m.AUDIO_FILE_TYPES, workers=args.scan_workers, manifest=scan_manifest)
+    signatures = {}
+    unchanged = set()
+    # Quarantined files are only skipped by incremental runs
+    quarantine = checkpoint.load_quarantine() if args.incremental else {}
+
+    if args.incremental or args.resume:
+        # The whole listing is needed to find the deleted and modified files
+        signatures = dict(entries)
+        audio_files = sorted(signatures)
+
+        # Keep the results of unchanged files and of the tracks committed before the run was interrupted, drop the
+        # rows of deleted or modified files and of the batch that was not committed
+        manifest = load_manifest() if args.incremental else {}
+        unchanged = {audio_file for audio_file, signature in signatures.items() if manifest.get(audio_file) == signature}
+        completed = {audio_file: signature for audio_file, signature in completed.items() if signatures.get(audio_file) == signature}
+        store.keep_rows(OUTPUT_TABLES, unchanged | set(completed))
+        # New rows are appended in the representation of the kept rows
+        if activations.table_representation() not in (None, genre_activations):
+            activations.convert(genre_activations)
+
+        # Files that could not be analyzed are skipped until they are modified
+        quarantine.update(failed)
+        quarantine = {} if args.retry_failed else {audio_file: (signature, error) for audio_file, (signature, error) in quarantine.items()
+                                                   if signatures.get(audio_file) == signature and audio_file not in unchanged}
+        audio_files = [audio_file for audio_file in audio_files if audio_file not in unchanged and audio_file not in completed and audio_file not in quarantine]
+        print(f"{len(unchanged)} unchanged, {len(completed)} already analyzed and {len(quarantine)} quarantined audio files, {len(audio_files)} to analyze")
+    else:
+        # Clear the features, genre predictions and embeddings tables, and the manifest of their audio files
+        for name in OUTPUT_TABLES:
+            store.clear(name)
+        write_manifest({})
+        # Analyze the audio files while the scan continues
+        audio_files = record_signatures(entries, signatures)
+
+    # Analyze audio files and write features to the store
+    analyzed, failed = analyze_audio_files(audio_files, workers=args.workers, frame_embeddings=args.frame_embeddings, batch_tracks=args.batch_tracks,
+                                           decode_workers=args.decode_workers if args.pipeline else 0, analysis_window=args.analysis_window,
+                                           genre_activations=genre_activations, signatures=signatures, journal=journal,
+                                           checkpoint_tracks=args.checkpoint_tracks)
+    completed.update(analyzed)
+    quarantine.update(failed)
+    if failed:
+        print(f"{len(failed)} audio files could not be analyzed, they are listed with their errors in {checkpoint.QUARANTINE_FILE_PATH}")
+
+    # Only the analyzed files are recorded in the manifest, so quarantined files are analyzed by the next full run
+    write_manifest({**{audio_file: signatures[audio_file] for audio_file in unchanged}, **completed})
+    checkpoint.write_quarantine(quarantine)
+    journal.remove()
+    if scan_manifest is not None:
+        scan_manifest.save()
+
+    if args.profile and os.path.exists(args.profile):
+        profiling.report(profiling.summarize(profiling.load_records(args.profile)))
+        print(f"Profile log written to {args.profile}, summarize it again with: python3 profiling.py {args.profile}")
+
+    print("Writing genre counts to genre_counts.tsv...")
+    write_genre_counts()
+
 if __name__ == "__main__":
     main()
@@ -2,10 +2,19 @@
 Methods for extracting audio features from audio files.
 
 The EssentiaClasses class is used to extract audio features from audio files using Essentia. The class is also used to load the discogs metadata json file and extract the genre list.
+Each of its extractors (and TensorFlow graph) is only built on first use, so only the models a script needs are loaded.
 
-The search_audio_files function is used to search for audio files in a given directory.
+Essentia (and the TensorFlow library it links) is imported on first use by load_essentia, so importing this module is
+cheap, e.g. for search_audio_files or file_signature.
+
+The KeyEstimator class estimates the key with several key profiles from a single HPCP computation.
+
+The search_audio_files function is used to search for audio files in a given directory, with the parallel scanner of scan.py.
+
+The file_signature function is used to detect new or modified audio files between runs.
 
 The load_audio_file function is used to load an audio file from a given path, downmix to mono and resample to 16kHz.
+It uses an AudioLoader, which resamples from the actual sample rate of each file and reuses its Essentia algorithms.
 
 """
 
@@ -13,13 +22,40 @@ import os
 # Set logging level for tensorflow
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # or any {'0', '1', '2'}
 
-import essentia
-# # Set logging level for essentia
-essentia.log.warningActive = False               # deactivate the warning level
-essentia.log.infoActive = False                  # deactivate the info level
-
-import essentia.standard as es
 import json
+import numpy as np
+import profiling
+import scan
+
+# essentia.standard, imported on first use by load_essentia
+es = None
+
+def load_essentia():
+    """
+    Import essentia.standard on first use, importing essentia also loads the TensorFlow library
+
+    Parameters:
+    None
+
+    Returns:
+    es (module): The essentia.standard module
+    """
+    global es
+    if es is None:
+        import essentia
+        # # Set logging level for essentia
+        essentia.log.warningActive = False               # deactivate the warning level
+        essentia.log.infoActive = False                  # deactivate the info level
+
+        import essentia.standard
+        es = essentia.standard
+
+    return es
+
+class ModelLoadError(Exception):
+    """
+    Error building an extractor, e.g. a missing Essentia algorithm or model graph, which affects every track of a run
+    """
 
 class EssentiaClasses:
     """
@@ -32,6 +68,19 @@ class EssentiaClasses:
     parent_genre_list = []
     batchSize = 64                                      # Change to implement GPU support
 
+    # Function building each extractor, called on first access of the extractor (see __getattr__)
+    extractors = {
+        'getRhythm': lambda self: es.RhythmExtractor2013(),
+        'getKey': lambda self: KeyEstimator(['temperley', 'krumhansl', 'edma']),
+        'getLoudness': lambda self: es.LoudnessEBUR128(),
+        'getDiscogsEmbeddings': lambda self: es.TensorflowPredictEffnetDiscogs(graphFilename="weights/discogs-effnet-bs64-1.pb", output="PartitionedCall:1",),
+        'getMusiCNNEmbeddings': lambda self: es.TensorflowPredictMusiCNN(graphFilename="weights/msd-musicnn-1.pb", output="model/dense/BiasAdd",),
+        'getMusicStyles': lambda self: es.TensorflowPredict2D(graphFilename="weights/genre_discogs400-discogs-effnet-1.pb", input="serving_default_model_Placeholder", output="PartitionedCall:0", batchSize=self.batchSize),
+        'getInstrumental': lambda self: es.TensorflowPredict2D(graphFilename="weights/voice_instrumental-discogs-effnet-1.pb", output="model/Softmax", batchSize=self.batchSize),
+        'getDanceability': lambda self: es.TensorflowPredict2D(graphFilename="weights/danceability-discogs-effnet-1.pb", output="model/Softmax", batchSize=self.batchSize),
+        'getArousalAndValence': lambda self: es.TensorflowPredict2D(graphFilename="weights/emomusic-msd-musicnn-2.pb", output="model/Identity", batchSize=self.batchSize),
+    }
+
     @classmethod
     def load_genre_metadata(cls, metadata_file):
         """
@@ -52,60 +101,141 @@ class EssentiaClasses:
         cls.parent_genre_list = [genre.split('--')[0] for genre in cls.genre_list]
         
     
-    def __init__(self):
+    def __init__(self, preload=()):
         """
-        Initialise the Essentia classes for feature extraction
+        Initialise the Essentia classes for feature extraction, the extractors are built on first use
 
         Parameters:
-        None
+        preload (list): The names of extractors to build now instead of on first use, e.g. list(EssentiaClasses.extractors)
 
         Returns:
         None
         """
-       
-        # Initialise the classes
-        self.getRhythm = es.RhythmExtractor2013()
-        self.getKeyTemperley = es.KeyExtractor(profileType='temperley')
-        self.getKeyKrumhansl = es.KeyExtractor(profileType='krumhansl')
-        self.getKeyEdma = es.KeyExtractor(profileType='edma')
-        self.getLoudness = es.LoudnessEBUR128()
-        self.getDiscogsEmbeddings = es.TensorflowPredictEffnetDiscogs(graphFilename="weights/discogs-effnet-bs64-1.pb", output="PartitionedCall:1",)
-        self.getMusiCNNEmbeddings = es.TensorflowPredictMusiCNN(graphFilename="weights/msd-musicnn-1.pb", output="model/dense/BiasAdd",)
-        self.getMusicStyles = es.TensorflowPredict2D(graphFilename="weights/genre_discogs400-discogs-effnet-1.pb", input="serving_default_model_Placeholder", output="PartitionedCall:0", batchSize=self.batchSize)
-        self.getInstrumental = es.TensorflowPredict2D(graphFilename="weights/voice_instrumental-discogs-effnet-1.pb", output="model/Softmax", batchSize=self.batchSize)
-        self.getDanceability = es.TensorflowPredict2D(graphFilename="weights/danceability-discogs-effnet-1.pb", output="model/Softmax", batchSize=self.batchSize)
-        self.getArousalAndValence = es.TensorflowPredict2D(graphFilename="weights/emomusic-msd-musicnn-2.pb", output="model/Identity", batchSize=self.batchSize)
 
-    def extract_features(self, audio_mono, audio_stereo):
+        load_essentia()
+        self.load_extractors(preload)
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet, i.e. extractors that have not been used
+        if name not in type(self).extractors:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        try:
+            extractor = type(self).extractors[name](self)
+        except Exception as error:
+            raise ModelLoadError(f"Could not build {name}: {type(error).__name__}: {error}") from error
+        setattr(self, name, extractor)
+
+        return extractor
+
+    def load_extractors(self, names):
         """
-        Extract audio features from an audio file
+        Build extractors now instead of on first use, e.g. to keep the model loading time out of the first track
 
         Parameters:
-        audio_file (str): The path to the audio file
+        names (list): The names of the extractors, see EssentiaClasses.extractors
 
         Returns:
         None
         """
+        for name in names:
+            getattr(self, name)
 
-        # Get features
-        self.tempo = self.getRhythm(audio_mono)[0]
-        self.keyTemperley, self.scaleTemperley, _= self.getKeyTemperley(audio_mono)
-        self.keyKrumhansl, self.scaleKrumhansl, _= self.getKeyKrumhansl(audio_mono)
-        self.keyEdma, self.scaleEdma, _ = self.getKeyEdma(audio_mono)
-        self.loudness = self.getLoudness(audio_stereo)[2]
+    def extract_embeddings(self, audio_mono):
+        """
+        Extract the frame-level embeddings of both embedding models and their average over all frames
 
-        # Get embeddings
-        discogsEmbeddings = self.getDiscogsEmbeddings(audio_mono)
-        musicnnEmbeddings = self.getMusiCNNEmbeddings(audio_mono)
+        Parameters:
+        audio_mono (np.array): The downmixed audio signal resampled to 16kHz
 
-        # Use embeddings on classifier models
-        genre_Predictions = self.getMusicStyles(discogsEmbeddings)
-        instrVoice = self.getInstrumental(discogsEmbeddings)
-        danceability = self.getDanceability(discogsEmbeddings)[:, 0]
-        arouVal = self.getArousalAndValence(musicnnEmbeddings)
+        Returns:
+        discogsEmbeddings (np.array): The Discogs-EffNet embeddings of each frame
+        musicnnEmbeddings (np.array): The MusiCNN embeddings of each frame
+        """
+
+        with profiling.stage('discogs embeddings'):
+            discogsEmbeddings = self.getDiscogsEmbeddings(audio_mono)
+        with profiling.stage('musicnn embeddings'):
+            musicnnEmbeddings = self.getMusiCNNEmbeddings(audio_mono)
+
+        # Average embedding frames
+        self.discogsEmbeddings = discogsEmbeddings.mean(axis=0)
+        self.musicnnEmbeddings = musicnnEmbeddings.mean(axis=0)
+
+        return discogsEmbeddings, musicnnEmbeddings
+
+    def extract_signal_features(self, audio_mono, audio_stereo):
+        """
+        Extract the tempo, key and loudness of an audio file
+
+        Parameters:
+        audio_mono (np.array): The downmixed audio signal resampled to 16kHz
+        audio_stereo (np.array): The audio signal
+
+        Returns:
+        signal_features (dict): The tempo, key and scale of each key profile, and loudness
+        """
+
+        with profiling.stage('rhythm'):
+            signal_features = {'tempo': self.getRhythm(audio_mono)[0]}
+        # The three key profiles share one HPCP computation
+        with profiling.stage('key'):
+            keys = self.getKey(audio_mono)
+        signal_features['keyTemperley'], signal_features['scaleTemperley'], _ = keys['temperley']
+        signal_features['keyKrumhansl'], signal_features['scaleKrumhansl'], _ = keys['krumhansl']
+        signal_features['keyEdma'], signal_features['scaleEdma'], _ = keys['edma']
+        with profiling.stage('loudness'):
+            signal_features['loudness'] = self.getLoudness(audio_stereo)[2]
+
+        return signal_features
+
+    def classify(self, discogsEmbeddings, musicnnEmbeddings):
+        """
+        Run the classifier models on embedding frames
+
+        Parameters:
+        discogsEmbeddings (np.array): Discogs-EffNet embedding frames
+        musicnnEmbeddings (np.array): MusiCNN embedding frames
+
+        Returns:
+        predictions (tuple): The genre, instrumental/voice and danceability predictions of each Discogs-EffNet frame,
+                             and the arousal and valence predictions of each MusiCNN frame
+        """
+
+        with profiling.stage('genre model'):
+            genre_Predictions = self.getMusicStyles(discogsEmbeddings)
+        with profiling.stage('instrumental model'):
+            instrVoice = self.getInstrumental(discogsEmbeddings)
+        with profiling.stage('danceability model'):
+            danceability = self.getDanceability(discogsEmbeddings)[:, 0]
+        with profiling.stage('arousal/valence model'):
+            arouVal = self.getArousalAndValence(musicnnEmbeddings)
+
+        return genre_Predictions, instrVoice, danceability, arouVal
+
+    def set_features(self, signal_features, discogsEmbeddings, musicnnEmbeddings, predictions):
+        """
+        Set the features of a track from its signal features, embedding frames and classifier predictions
+
+        Parameters:
+        signal_features (dict): The features returned by extract_signal_features
+        discogsEmbeddings (np.array): The Discogs-EffNet embeddings of each frame
+        musicnnEmbeddings (np.array): The MusiCNN embeddings of each frame
+        predictions (tuple): The classifier predictions of each frame, as returned by classify
+
+        Returns:
+        None
+        """
+
+        vars(self).update(signal_features)
+        genre_Predictions, instrVoice, danceability, arouVal = predictions
         arousal = arouVal[:, 0]
         valence = arouVal[:, 1]
 
+        # Average embedding frames
+        self.discogsEmbeddings = discogsEmbeddings.mean(axis=0)
+        self.musicnnEmbeddings = musicnnEmbeddings.mean(axis=0)
+
         # Average classifier output frames
         self.genreActivations = genre_Predictions.mean(axis=0)
         self.genreNumber = self.genreActivations.argmax()
@@ -118,6 +248,67 @@ class EssentiaClasses:
         self.arousal = arousal.mean(axis=0)
         self.valence = valence.mean(axis=0)
 
+    def extract_features(self, audio_mono, audio_stereo):
+        """
+        Extract audio features from an audio file
+
+        Parameters:
+        audio_mono (np.array): The downmixed audio signal resampled to 16kHz
+        audio_stereo (np.array): The audio signal
+
+        Returns:
+        discogsEmbeddings (np.array): The Discogs-EffNet embeddings of each frame
+        musicnnEmbeddings (np.array): The MusiCNN embeddings of each frame
+        """
+
+        # Get features
+        signal_features = self.extract_signal_features(audio_mono, audio_stereo)
+
+        # Get embeddings
+        discogsEmbeddings, musicnnEmbeddings = self.extract_embeddings(audio_mono)
+
+        # Use embeddings on classifier models
+        predictions = self.classify(discogsEmbeddings, musicnnEmbeddings)
+        self.set_features(signal_features, discogsEmbeddings, musicnnEmbeddings, predictions)
+
+        return discogsEmbeddings, musicnnEmbeddings
+
+    def extract_features_batch(self, audios):
+        """
+        Extract audio features from several audio files, running each classifier model once over the embedding frames of all files
+
+        The features of each file are set one file at a time, so write_features_dict and write_genre_dict
+        have to be called before the next file is requested from the generator.
+
+        Parameters:
+        audios (list): The (audio_mono, audio_stereo) signals of each audio file
+
+        Yields:
+        discogsEmbeddings (np.array): The Discogs-EffNet embeddings of each frame of the file
+        musicnnEmbeddings (np.array): The MusiCNN embeddings of each frame of the file
+        """
+
+        signal_features, discogs_frames, musicnn_frames = [], [], []
+        for i, (audio_mono, audio_stereo) in enumerate(audios):
+            with profiling.item(i):
+                signal_features.append(self.extract_signal_features(audio_mono, audio_stereo))
+                discogsEmbeddings, musicnnEmbeddings = self.extract_embeddings(audio_mono)
+            discogs_frames.append(discogsEmbeddings)
+            musicnn_frames.append(musicnnEmbeddings)
+
+        # Run the classifier models on the frames of all files, so that their batches are filled
+        genre_Predictions, instrVoice, danceability, arouVal = self.classify(np.concatenate(discogs_frames), np.concatenate(musicnn_frames))
+
+        # Split the predictions back per file
+        discogs_splits = np.cumsum([len(frames) for frames in discogs_frames])[:-1]
+        musicnn_splits = np.cumsum([len(frames) for frames in musicnn_frames])[:-1]
+        predictions = zip(np.split(genre_Predictions, discogs_splits), np.split(instrVoice, discogs_splits),
+                          np.split(danceability, discogs_splits), np.split(arouVal, musicnn_splits))
+
+        for i, file_predictions in enumerate(predictions):
+            self.set_features(signal_features[i], discogs_frames[i], musicnn_frames[i], file_predictions)
+            yield discogs_frames[i], musicnn_frames[i]
+
     def write_features_dict(self, audio_file):
         """
         Write the extracted features to a dictionary
@@ -156,7 +347,7 @@ class EssentiaClasses:
         audio_file (str): The path to the audio file
 
         Returns:
-        genre_predictions (dict): A dictionary containing the genre predictions, and genre activations in indvidual columns
+        genre_predictions (dict): A dictionary containing the genre predictions, and the array of genre activations
 
         """
 
@@ -165,15 +356,86 @@ class EssentiaClasses:
             'genreNumber': self.genreNumber,
             'genre': self.genre,
             'parentGenre': self.parentGenre,
+            'activations': self.genreActivations,
        }
-        # Convert the numpy array to a list and add it to the dictionary
-        genre_activations_list = self.genreActivations.tolist()
-        for i, activation in enumerate(genre_activations_list):
-            genre_predictions[f'activation_{i}'] = activation
 
         return genre_predictions
 
-def search_audio_files(directory, file_types=['.mp3', '.wav', '.flac', '.aac']):
+class KeyEstimator:
+    """
+    Class for estimating the key and scale of a signal with several key profiles from a single HPCP
+
+    It computes the same key, scale and strength as one KeyExtractor per profile with the default parameters, but the
+    framing, spectrum, spectral peaks, whitening and HPCP are computed once and only the Key algorithm runs per profile.
+    """
+
+    def __init__(self, profileTypes, frameSize=4096, hopSize=4096, sampleRate=44100, pcpThreshold=0.2):
+        """
+        Initialise the key estimator, with the parameters KeyExtractor uses internally
+
+        Parameters:
+        profileTypes (list): The key profiles to score the HPCP against, e.g. ['temperley', 'krumhansl', 'edma']
+        frameSize (int): The frame size of the HPCP frames
+        hopSize (int): The hop size of the HPCP frames
+        sampleRate (float): The sample rate assumed for the signal, KeyExtractor defaults to 44100
+        pcpThreshold (float): Bins of the normalized average HPCP below this value are set to 0
+
+        Returns:
+        None
+        """
+        self.frameSize = frameSize
+        self.hopSize = hopSize
+        self.pcpThreshold = pcpThreshold
+        load_essentia()
+        self.getWindow = es.Windowing(type='hann')
+        self.getSpectrum = es.Spectrum()
+        self.getSpectralPeaks = es.SpectralPeaks(orderBy='magnitude', magnitudeThreshold=1e-4, minFrequency=25, maxFrequency=3500, maxPeaks=60, sampleRate=sampleRate)
+        self.getWhitening = es.SpectralWhitening(maxFrequency=3500, sampleRate=sampleRate)
+        self.getHPCP = es.HPCP(size=12, harmonics=4, minFrequency=25, maxFrequency=3500, weightType='cosine', windowSize=1., normalized='none', sampleRate=sampleRate)
+        self.getKeys = {profileType: es.Key(profileType=profileType, pcpSize=12, numHarmonics=4, slope=0.6, usePolyphony=False, useThreeChords=False)
+                        for profileType in profileTypes}
+
+    def hpcp(self, audio_mono):
+        """
+        Compute the average HPCP of a signal, normalized to a maximum of 1 and thresholded
+
+        Parameters:
+        audio_mono (np.array): The mono signal
+
+        Returns:
+        hpcp (np.array): The average HPCP
+        """
+        frames = []
+        for frame in es.FrameGenerator(audio_mono, frameSize=self.frameSize, hopSize=self.hopSize):
+            spectrum = self.getSpectrum(self.getWindow(frame))
+            frequencies, magnitudes = self.getSpectralPeaks(spectrum)
+            frames.append(self.getHPCP(frequencies, self.getWhitening(spectrum, frequencies, magnitudes)))
+
+        hpcp = np.mean(frames, axis=0).astype(np.float32) if frames else np.zeros(12, dtype=np.float32)
+        if hpcp.max() > 0:
+            hpcp /= hpcp.max()
+        hpcp[hpcp < self.pcpThreshold] = 0
+
+        return hpcp
+
+    def __call__(self, audio_mono):
+        """
+        Estimate the key and scale of a signal with each key profile
+
+        Parameters:
+        audio_mono (np.array): The mono signal
+
+        Returns:
+        keys (dict): The key, scale and strength of each profile
+        """
+        hpcp = self.hpcp(audio_mono)
+
+        return {profileType: tuple(getKey(hpcp)[:3]) for profileType, getKey in self.getKeys.items()}
+
+# Extensions of the audio files that are analyzed
+AUDIO_FILE_TYPES = ['.mp3', '.wav', '.flac', '.aac']
+
+def search_audio_files(directory, file_types=AUDIO_FILE_TYPES):
     """
     Search for audio files in a given directory
 
@@ -182,37 +444,121 @@ def search_audio_files(directory, file_types=['.mp3', '.wav', '.flac', '.aac']):
     file_types (list): The file types to search for
 
     Returns:
-    audio_files (list): A list of the audio files found in the directory
+    audio_files (list): A sorted list of the audio files found in the directory, relative to the current directory
+
+    """
+
+    # The directories are listed in parallel (see scan.py), use scan.scan_audio_files to get the files as they are found
+    return sorted(audio_file for audio_file, _ in scan.scan_audio_files(directory, file_types))
+
+def file_signature(file_path):
+    """
+    Get the signature used to detect changes to a file
+
+    Parameters:
+    file_path (str): The path to the file
+
+    Returns:
+    signature (tuple): The size in bytes and the modification time in nanoseconds of the file
+
+    """
+    stat = os.stat(file_path)
 
+    return stat.st_size, stat.st_mtime_ns
+
+class AudioLoader:
+    """
+    Class for loading audio files, downmixing them to mono and resampling them to the sample rate of the models
+
+    The MonoMixer and the Resample algorithm of each input sample rate are created once and reused for every file.
     """
 
-    audio_files = []
+    def __init__(self, outputSampleRate=16000):
+        """
+        Initialise the audio loader
+
+        Parameters:
+        outputSampleRate (int): The sample rate of the mono signal
+
+        Returns:
+        None
+        """
+        self.outputSampleRate = outputSampleRate
+        load_essentia()
+        self.mixToMono = es.MonoMixer()
+        self.resamplers = {}
+
+    def resample(self, audio_mono, inputSampleRate):
+        """
+        Resample a mono signal to the output sample rate
+
+        Parameters:
+        audio_mono (np.array): The mono signal
+        inputSampleRate (float): The sample rate of the mono signal
+
+        Returns:
+        audio_mono (np.array): The resampled mono signal
+        """
+        if inputSampleRate == self.outputSampleRate:
+            return audio_mono
+
+        if inputSampleRate not in self.resamplers:
+            self.resamplers[inputSampleRate] = es.Resample(inputSampleRate=inputSampleRate, outputSampleRate=self.outputSampleRate)
+
+        return self.resamplers[inputSampleRate](audio_mono)
+
+    def load(self, file_path, analysis_window=None):
+        """
+        Load an audio file, downmix to mono and resample to the output sample rate
+
+        Parameters:
+        file_path (str): The path to the audio file
+        analysis_window (float): If set, only the central analysis_window seconds of longer files are kept. The whole
+                                 file is still decoded, the window only bounds the downmixing, resampling and analysis
+
+        Returns:
+        audio_stereo (np.array): The audio signal at its native sample rate
+        audio_mono (np.array): The downmixed audio signal resampled to the output sample rate
 
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith(tuple(file_types)):
-                audio_files.append(os.path.relpath(os.path.join(root, file), os.getcwd()))
+        """
+        # Extract stereo audio at its native sample rate
+        with profiling.stage('decode'):
+            audio_stereo, sr, nc, _, _, _ = es.AudioLoader(filename=file_path)()
+
+        # Keep the central analysis window. Essentia's loaders can not seek (EasyLoader with startTime also decodes the
+        # whole file), so the whole file is still decoded, but the window is copied so that the decoded file is freed
+        if analysis_window:
+            window = int(analysis_window * sr)
+            if len(audio_stereo) > window:
+                start = (len(audio_stereo) - window) // 2
+                audio_stereo = audio_stereo[start:start + window].copy()
+
+        # Mix to mono and resample
+        with profiling.stage('resample'):
+            audio_mono = self.mixToMono(audio_stereo, nc)
+            audio_mono = self.resample(audio_mono, sr)
 
-    return audio_files
+        return audio_stereo, audio_mono
 
-def load_audio_file(file_path):
+# Audio loader of the current process, initialised on first use
+audio_loader = None
+
+def load_audio_file(file_path, analysis_window=None):
     """
     Load an audio file from a given path, downmix to mono and resample to 16kHz
 
     Parameterers:
     file_path (str): The path to the audio file
+    analysis_window (float): If set, only the central analysis_window seconds of longer files are kept, the whole file
+                             is still decoded
 
     Returns:
     audio_stereo (np.array): The audio signal
     audio_mono(np.array): The downmixed audio signal resampled to 16kHz
 
     """
-    # Extract stereo auio
-    audio_stereo, sr, nc, _, _, _ =  es.AudioLoader(filename=file_path)()
-    # Mix to mono
-    audio_mono = es.MonoMixer()(audio_stereo, nc)
-    # Resample to 16kHz
-    audio_mono = es.Resample(inputSampleRate=44100, outputSampleRate=16000)(audio_mono)
-
-    return audio_stereo, audio_mono
+    global audio_loader
+    if audio_loader is None:
+        audio_loader = AudioLoader()
 
+    return audio_loader.load(file_path, analysis_window)
@@ -0,0 +1,176 @@
+"""
+Staged analysis pipeline where decoding, inference and writing run concurrently, connected by bounded queues.
+
+Audio files are decoded by a pool of worker processes, inference runs in the calling process (which holds the models)
+and results are written by a writer thread. The queues between the stages are bounded, so at most a fixed number of
+decoded tracks are held in memory whichever stage is the slowest.
+
+The time spent in each stage, and waiting for the input of each stage, is returned so the bottleneck can be identified.
+
+"""
+
+import multiprocessing as mp
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Marks the end of the items in a queue
+DONE = None
+
+
+def _timed(function, item):
+    start = time.perf_counter()
+    result = function(item)
+
+    return result, time.perf_counter() - start
+
+
+class Pipeline:
+    """
+    Decode, inference and write stages connected by bounded queues
+    """
+
+    def __init__(self, decode, infer, write, decode_workers=2, batch_size=1, queue_size=8):
+        """
+        Initialise the pipeline
+
+        Parameters:
+        decode (function): Decodes one item, runs in a worker process so it must be a module-level function
+        infer (function): Takes a list of (item, decoded) tuples and returns the list of their results
+        write (function): Writes the result of one item
+        decode_workers (int): The number of decoding worker processes
+        batch_size (int): The number of decoded items passed to infer at once
+        queue_size (int): The maximum number of items waiting between two stages
+
+        Returns:
+        None
+        """
+        self.decode = decode
+        self.infer = infer
+        self.write = write
+        self.decode_workers = decode_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue(maxsize=queue_size)
+        self.timings = {'decode': [], 'inference': [], 'write': [], 'inference wait': [], 'write wait': []}
+        self.errors = []
+
+    def _decode_stage(self, items):
+        try:
+            with ProcessPoolExecutor(self.decode_workers, mp_context=mp.get_context('spawn')) as executor:
+                # Only queue_size items are decoding at once, so the workers can not run ahead of the queue
+                pending = deque()
+                for item in items:
+                    pending.append((item, executor.submit(_timed, self.decode, item)))
+                    if len(pending) >= self.queue_size:
+                        self._put_decoded(*pending.popleft())
+                    if self.errors:
+                        break
+                while pending and not self.errors:
+                    self._put_decoded(*pending.popleft())
+                for _, future in pending:
+                    future.cancel()
+        except Exception as error:
+            self.errors.append(error)
+        finally:
+            self.decoded.put(DONE)
+
+    def _put_decoded(self, item, future):
+        decoded, duration = future.result()
+        self.timings['decode'].append(duration)
+        self.decoded.put((item, decoded))
+
+    def _write_stage(self, progress):
+        while True:
+            start = time.perf_counter()
+            result = self.results.get()
+            self.timings['write wait'].append(time.perf_counter() - start)
+            if result is DONE:
+                return
+            # Keep draining the queue after an error so that the inference stage is never blocked
+            if self.errors:
+                continue
+            try:
+                _, duration = _timed(self.write, result)
+                self.timings['write'].append(duration)
+                if progress:
+                    progress(result)
+            except Exception as error:
+                self.errors.append(error)
+
+    def _next_batch(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            start = time.perf_counter()
+            decoded = self.decoded.get()
+            self.timings['inference wait'].append(time.perf_counter() - start)
+            if decoded is DONE:
+                return batch, True
+            batch.append(decoded)
+
+        return batch, False
+
+    def run(self, items, progress=None):
+        """
+        Run all items through the pipeline, inference runs in the calling thread
+
+        Parameters:
+        items (list): The items to process
+        progress (function): Called with the result of each item once it is written
+
+        Returns:
+        timings (dict): The durations in seconds of each stage and of the waits for the input of each stage
+        """
+        decoder = threading.Thread(target=self._decode_stage, args=(items,), daemon=True)
+        writer = threading.Thread(target=self._write_stage, args=(progress,), daemon=True)
+        decoder.start()
+        writer.start()
+
+        try:
+            done = False
+            while not done and not self.errors:
+                batch, done = self._next_batch()
+                if batch:
+                    results, duration = _timed(self.infer, batch)
+                    self.timings['inference'].append(duration)
+                    for result in results:
+                        self.results.put(result)
+        except Exception as error:
+            self.errors.append(error)
+        finally:
+            # Unblock the decoder if inference stopped early, then let the writer finish the queued results
+            while decoder.is_alive():
+                try:
+                    self.decoded.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.results.put(DONE)
+            writer.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        return self.timings
+
+
+def report_timings(timings, tracks):
+    """
+    Print the total and per-track time of each stage
+
+    Parameters:
+    timings (dict): The timings returned by Pipeline.run
+    tracks (int): The number of processed tracks
+
+    Returns:
+    None
+    """
+    print(f"{'stage':>15} {'total (s)':>10} {'per track (s)':>14}")
+    for stage, durations in timings.items():
+        total = sum(durations)
+        print(f"{stage:>15} {total:>10.2f} {total / max(tracks, 1):>14.3f}")
+    print("Decode time is summed over the decoding workers. A long inference wait means decoding is the bottleneck,")
+    print("a long write wait with a short inference wait means inference is the bottleneck.")
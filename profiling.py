@@ -0,0 +1,285 @@
+"""
+Per-stage profiling of the analysis.
+
+Stages of the analysis (decoding, rhythm, key, loudness, embedding models, classifier models and writing) are wrapped
+in profiling.stage context managers. When profiling is enabled, each stage appends one JSON line to the profile log with
+the tracks it processed, its wall time, the resident memory of the process after it and the peak resident memory while
+it ran. When it is disabled the context managers do nothing.
+
+The peak of each stage is measured on its own: on Linux the peak resident memory (VmHWM) is reset when a stage starts,
+by writing to /proc/self/clear_refs, and read when it ends. The reset applies to the whole process, so before each reset
+the current peak is also credited to every stage still running, e.g. in another thread. Where the peak can not be reset,
+the peak of the memory allocated by Python and numpy is measured with tracemalloc instead, which does not see the memory
+allocated by Essentia and TensorFlow.
+
+Profiling is enabled with profiling.enable, which sets the PROFILE_LOG environment variable so that worker processes
+spawned afterwards write to the same log. Each record is written with a single append, so processes can share the file.
+
+Running this script prints the percentiles of the time per track of each stage in a profile log.
+
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+PROFILE_LOG_ENV = 'PROFILE_LOG'
+PROFILE_LOG_PATH = 'data/profile.jsonl'
+PERCENTILES = [50, 90, 99]
+
+# Profile log of the current process, None when profiling is disabled
+log_path = os.environ.get(PROFILE_LOG_ENV)
+_lock = threading.Lock()
+_context = threading.local()
+
+# Peak memory in MB of each running stage, and whether the peak resident memory of the process can be reset
+_running = {}
+_resettable = None
+
+
+def enable(path=PROFILE_LOG_PATH):
+    """
+    Enable profiling in the current process and in the worker processes it spawns afterwards
+
+    Parameters:
+    path (str): The path to the profile log, records are appended to an existing log
+
+    Returns:
+    None
+    """
+    global log_path
+    log_path = path
+    os.environ[PROFILE_LOG_ENV] = path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+
+def _current_tracks():
+    return getattr(_context, 'tracks', [])
+
+
+def _memory_mb():
+    """
+    Get the resident memory of the current process
+
+    Parameters:
+    None
+
+    Returns:
+    rss (float): The resident memory in MB, None if /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return None
+
+
+def _reset_peak():
+    """
+    Reset the peak memory of the current process, the peak resident memory if possible and otherwise the tracemalloc peak
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    global _resettable
+    if _resettable is not False:
+        try:
+            # 5 resets the peak resident memory of the process, see proc(5)
+            with open('/proc/self/clear_refs', 'w') as file:
+                file.write('5')
+            _resettable = True
+            return
+        except OSError:
+            _resettable = False
+            tracemalloc.start()
+
+    tracemalloc.reset_peak()
+
+
+def _peak_mb():
+    """
+    Get the peak memory of the current process since the last _reset_peak
+
+    Parameters:
+    None
+
+    Returns:
+    peak (float): The peak resident memory in MB, or the peak memory traced by tracemalloc
+    """
+    if _resettable:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    # In kilobytes
+                    return int(line.split()[1]) / 2 ** 10
+
+    return tracemalloc.get_traced_memory()[1] / 2 ** 20
+
+
+def _update_running_peaks():
+    # Credit the peak since the last reset to every running stage, called with the lock held before each reset
+    if _running:
+        peak = _peak_mb()
+        for key in _running:
+            _running[key] = max(_running[key], peak)
+
+
+@contextlib.contextmanager
+def tracks(audio_files):
+    """
+    Attribute the stages run in this context to the given tracks
+
+    Parameters:
+    audio_files (list): The paths to the audio files processed in this context
+
+    Yields:
+    None
+    """
+    previous = _current_tracks()
+    _context.tracks = list(audio_files)
+    try:
+        yield
+    finally:
+        _context.tracks = previous
+
+
+@contextlib.contextmanager
+def item(index):
+    """
+    Narrow the tracks of the current context to one of them, e.g. for the per-track steps of a batch
+
+    Parameters:
+    index (int): The position of the track in the current tracks
+
+    Yields:
+    None
+    """
+    current = _current_tracks()
+    with tracks(current[index:index + 1]):
+        yield
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Record the wall time and memory of a stage of the analysis, if profiling is enabled
+
+    Parameters:
+    name (str): The name of the stage
+
+    Yields:
+    None
+    """
+    if log_path is None:
+        yield
+        return
+
+    key = object()
+    with _lock:
+        _update_running_peaks()
+        _reset_peak()
+        _running[key] = 0.0
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            _update_running_peaks()
+            _running[key] = max(_running[key], _peak_mb())
+            peak = _running.pop(key)
+
+    record = {'time': time.time(), 'pid': os.getpid(), 'stage': name, 'tracks': _current_tracks(), 'seconds': seconds,
+              'rss_mb': _memory_mb(), 'peak_rss_mb': peak}
+    with _lock, open(log_path, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+
+def load_records(path=PROFILE_LOG_PATH):
+    """
+    Load the records of a profile log
+
+    Parameters:
+    path (str): The path to the profile log
+
+    Returns:
+    records (list): The record of each profiled stage
+    """
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def summarize(records):
+    """
+    Compute the percentiles of the time per track and the peak memory of each stage
+
+    Stages that process a batch of tracks at once, such as the classifier models with --batch-tracks, are divided
+    evenly over the tracks of the batch.
+
+    Parameters:
+    records (list): The records of a profile log
+
+    Returns:
+    summary (dict): The number of records, total time, time per track percentiles and peak memory of each stage
+    """
+    stages = {}
+    for record in records:
+        stages.setdefault(record['stage'], []).append(record)
+
+    summary = {}
+    for name, stage_records in stages.items():
+        per_track = np.array([record['seconds'] / max(len(record['tracks']), 1) for record in stage_records])
+        summary[name] = {
+            'count': len(stage_records),
+            'total': float(sum(record['seconds'] for record in stage_records)),
+            **{f'p{percentile}': float(np.percentile(per_track, percentile)) for percentile in PERCENTILES},
+            'max': float(per_track.max()),
+            'peak_rss_mb': max(record['peak_rss_mb'] for record in stage_records),
+        }
+
+    return summary
+
+
+def report(summary):
+    """
+    Print the summary of a profile log, the slowest stages first
+
+    Parameters:
+    summary (dict): The summary returned by summarize
+
+    Returns:
+    None
+    """
+    columns = [f'p{percentile} (s)' for percentile in PERCENTILES] + ['max (s)']
+    print(f"{'stage':>22} {'count':>7} {'total (s)':>10} " + ' '.join(f'{column:>9}' for column in columns) + f" {'peak MB':>8}")
+    for name, stats in sorted(summary.items(), key=lambda item: item[1]['total'], reverse=True):
+        values = [stats[f'p{percentile}'] for percentile in PERCENTILES] + [stats['max']]
+        print(f"{name:>22} {stats['count']:>7} {stats['total']:>10.2f} " + ' '.join(f'{value:>9.3f}' for value in values)
+              + f" {stats['peak_rss_mb']:>8.0f}")
+    print("Times are per track. Peak memory is the largest peak resident memory of the process while the stage ran.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a profile log written by main.py --profile")
+    parser.add_argument('log', nargs='?', default=PROFILE_LOG_PATH, help=f"Profile log (default: {PROFILE_LOG_PATH})")
+    parser.add_argument('--json', action='store_true', help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    summary = summarize(load_records(args.log))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        report(summary)
+
+
+if __name__ == "__main__":
+    main()
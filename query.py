@@ -0,0 +1,245 @@
+"""
+Query engine over an in-memory feature table, used by the playlist pages of app.py.
+
+A FeatureTable holds each column of a table as a numpy array (categorical columns as integer codes) and the track id
+of each row. Queries are built by chaining range and equality predicates, e.g.
+
+    rows = table.query().range('tempo', 90, 130).equal('keyEdma', 'A').rank('tempo', k=50)
+    tracks = table.tracks(rows)
+
+Range predicates are evaluated with a binary search on the rows sorted by the column, and equality predicates with a
+comparison of the integer codes, both giving a boolean mask over the rows. The masks of all predicates are combined
+without copying the table. Ranking by one column walks the cached sorted order of the column, and ranking by a product
+of columns only sorts the k best rows (selected with np.argpartition), so the results are row indices and track ids
+rather than intermediate DataFrames.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class FeatureTable:
+    """
+    Columns of a feature table as numpy arrays, with the sorted order of each column computed on first use
+    """
+
+    def __init__(self, track_ids, columns, categories=None):
+        """
+        Initialise the table
+
+        Parameters:
+        track_ids (np.array): The track id of each row
+        columns (Mapping): The values of each column, columns can also be computed on first access
+        categories (dict): For each categorical column, the code of each value
+
+        Returns:
+        None
+        """
+        self.track_ids = np.asarray(track_ids)
+        self.columns = columns
+        self.categories = categories or {}
+        self._sorted = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Create a table from a DataFrame indexed by track id, categorical columns are stored as their codes
+
+        Parameters:
+        df (pd.DataFrame): The features, one row per track
+
+        Returns:
+        table (FeatureTable): The table
+        """
+        columns = {}
+        categories = {}
+        for column in df.columns:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                columns[column] = df[column].cat.codes.to_numpy()
+                categories[column] = {value: code for code, value in enumerate(df[column].cat.categories)}
+            else:
+                columns[column] = df[column].to_numpy()
+
+        return cls(df.index.to_numpy(), columns, categories)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def sorted_rows(self, column):
+        """
+        Get the rows sorted by ascending value of a numeric column, rows with a missing value are left out
+
+        Parameters:
+        column (str): The name of the column
+
+        Returns:
+        order (np.array): The sorted row indices
+        values (np.array): The values of the column in that order
+        """
+        if column not in self._sorted:
+            values = self.columns[column]
+            order = np.argsort(values, kind='stable')
+            order = order[~np.isnan(values[order])]
+            self._sorted[column] = (order, values[order])
+
+        return self._sorted[column]
+
+    def query(self):
+        return Query(self)
+
+    def tracks(self, rows):
+        """
+        Get the track ids of rows
+
+        Parameters:
+        rows (np.array): The row indices
+
+        Returns:
+        tracks (list): The track id of each row
+        """
+        return self.track_ids[rows].tolist()
+
+    def frame(self, rows, columns):
+        """
+        Build a DataFrame of some columns of some rows, e.g. to display the results of a query
+
+        Parameters:
+        rows (np.array): The row indices
+        columns (list): The names of the columns
+
+        Returns:
+        df (pd.DataFrame): The columns of the rows, indexed by track id
+        """
+        df = pd.DataFrame({column: self.columns[column][rows] for column in columns}, index=self.track_ids[rows])
+        for column in columns:
+            if column in self.categories:
+                df[column] = pd.Categorical.from_codes(df[column], categories=list(self.categories[column]))
+
+        return df
+
+
+class Query:
+    """
+    Conjunction of predicates over a FeatureTable, each predicate returns a new query
+    """
+
+    def __init__(self, table, predicates=()):
+        self.table = table
+        self.predicates = tuple(predicates)
+
+    def range(self, column, low=None, high=None):
+        """
+        Keep the rows whose value of a numeric column is within a range
+
+        Parameters:
+        column (str): The name of the column
+        low (float): The lowest value kept, None for no lower bound
+        high (float): The highest value kept, None for no upper bound
+
+        Returns:
+        query (Query): The query with the predicate added
+        """
+        return Query(self.table, self.predicates + (('range', column, (low, high)),))
+
+    def equal(self, column, value):
+        """
+        Keep the rows whose value of a column is equal to a value
+
+        Parameters:
+        column (str): The name of the column
+        value: The value
+
+        Returns:
+        query (Query): The query with the predicate added
+        """
+        return Query(self.table, self.predicates + (('equal', column, value),))
+
+    def _predicate_mask(self, kind, column, value):
+        table = self.table
+        if kind == 'range':
+            # Binary search in the sorted column, then mark the rows in between
+            order, values = table.sorted_rows(column)
+            low, high = value
+            start = 0 if low is None else np.searchsorted(values, low, side='left')
+            end = len(values) if high is None else np.searchsorted(values, high, side='right')
+            mask = np.zeros(len(table), dtype=bool)
+            mask[order[start:end]] = True
+            return mask
+
+        if column in table.categories:
+            code = table.categories[column].get(value)
+            if code is None:
+                return np.zeros(len(table), dtype=bool)
+            return table.columns[column] == code
+
+        return table.columns[column] == value
+
+    def mask(self):
+        """
+        Evaluate the predicates
+
+        Parameters:
+        None
+
+        Returns:
+        mask (np.array): Whether each row matches all predicates, None if the query has no predicates
+        """
+        mask = None
+        for predicate in self.predicates:
+            predicate_mask = self._predicate_mask(*predicate)
+            mask = predicate_mask if mask is None else np.logical_and(mask, predicate_mask, out=mask)
+
+        return mask
+
+    def rows(self):
+        """
+        Get the rows matching all predicates
+
+        Parameters:
+        None
+
+        Returns:
+        rows (np.array): The matching row indices, in table order
+        """
+        mask = self.mask()
+
+        return np.arange(len(self.table)) if mask is None else np.flatnonzero(mask)
+
+    def rank(self, by, ascending=False, k=None):
+        """
+        Rank the rows matching all predicates by a column, or by the product of several columns
+
+        Parameters:
+        by (str or list): The column to rank by, or the columns whose product is ranked
+        ascending (bool): Whether the lowest values are ranked first
+        k (int): The number of rows to return, None or 0 returns all matching rows
+
+        Returns:
+        rows (np.array): The ranked row indices
+        """
+        mask = self.mask()
+        columns = [by] if isinstance(by, str) else list(by)
+
+        if len(columns) == 1:
+            # Walk the cached sorted order of the column and keep the matching rows, no sort is needed
+            order, _ = self.table.sorted_rows(columns[0])
+            if not ascending:
+                order = order[::-1]
+            if mask is not None:
+                order = order[mask[order]]
+            return order[:k] if k else order
+
+        rows = self.rows()
+        scores = self.table.columns[columns[0]][rows].astype(np.float64)
+        for column in columns[1:]:
+            scores *= self.table.columns[column][rows]
+        if not ascending:
+            scores = -scores
+
+        # Only sort the k best rows
+        if k and k < len(rows):
+            best = np.argpartition(scores, k - 1)[:k]
+            return rows[best[np.argsort(scores[best], kind='stable')]]
+
+        return rows[np.argsort(scores, kind='stable')]
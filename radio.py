@@ -0,0 +1,178 @@
+"""
+This script generates a "radio" playlist for every track in the collection: its most similar tracks under the
+Discogs-EffNet and the MusiCNN embeddings.
+
+The all-pairs search runs in blocks of query tracks. Each block is scored against the collection in chunks with a
+running top k (see similarity.batch_top_k), so memory is bounded by the block and chunk sizes and not by the square of
+the number of tracks. Blocks are processed by a pool of worker processes, which memory-map the normalized embeddings of the store.
+
+The neighbours are written to the radio_neighbours store table, with for each model the row indices of the neighbours
+in the radio_neighbours table itself and their cosine similarities, so they resolve to tracks through the audio_file
+column written with them and not through the rows of the embeddings tables, which change when tracks are analyzed or
+removed. load_neighbours reads them back and rejects them once the embeddings tables no longer contain the same tracks.
+With --playlists an .m3u8 playlist is also written per track and model, with paths relative to the playlist like the
+playlists of the apps.
+
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+from functools import partial
+import numpy as np
+from tqdm import tqdm
+import ann
+import similarity
+import store
+
+# File paths
+AUDIO_PATH = 'audio'
+RADIO_PLAYLISTS_PATH = 'playlists/radio'
+
+# Embeddings table of each model, the neighbour table has a neighbours and a similarities column per model
+MODELS = {'discogs': store.DISCOGS_EMBEDDINGS_TABLE, 'musicnn': store.MUSICNN_EMBEDDINGS_TABLE}
+
+BLOCK_SIZE = 256
+
+# Normalized embeddings of the current worker process
+normalized = None
+
+
+def init_worker(name, snapshot):
+    global normalized
+    normalized = ann.read_normalized(name, snapshot)
+
+
+def block_neighbours(start, k, block_size=BLOCK_SIZE):
+    """
+    Find the neighbours of a block of tracks, excluding each track itself
+
+    Parameters:
+    start (int): The index of the first track of the block
+    k (int): The number of neighbours per track
+    block_size (int): The number of tracks in the block
+
+    Returns:
+    start (int): The index of the first track of the block
+    indices (np.array): The neighbour indices of each track of the block
+    similarities (np.array): The cosine similarities of the neighbours
+    """
+    queries = np.asarray(normalized[start:start + block_size])
+    indices, similarities = similarity.batch_top_k(queries, normalized, k, exclude=np.arange(start, start + len(queries)))
+
+    return start, indices, similarities
+
+
+def all_neighbours(name, k, workers):
+    """
+    Find the neighbours of every track of an embeddings table
+
+    Parameters:
+    name (str): The name of the embeddings table
+    k (int): The number of neighbours per track
+    workers (int): The number of worker processes
+
+    Returns:
+    indices (np.array): The int32 neighbour indices of each track
+    similarities (np.array): The cosine similarities of the neighbours
+    """
+    # The workers memory-map the normalized embeddings, so that they are not copied to each process. They all read the
+    # same snapshot of the store, so rows published meanwhile are not seen by only some of them
+    snapshot = store.read_snapshot()
+    tracks = len(ann.read_normalized(name, snapshot))
+    # A track has no neighbours without other tracks, e.g. in a table emptied by store.keep_rows
+    if tracks < 2:
+        print(f"'{name}' has {tracks} tracks, at least 2 are needed to find neighbours")
+        return np.zeros((tracks, 0), dtype=np.int32), np.zeros((tracks, 0), dtype=np.float32)
+
+    k = min(k, tracks - 1)
+    indices = np.empty((tracks, k), dtype=np.int32)
+    similarities = np.empty((tracks, k), dtype=np.float32)
+
+    with mp.get_context('spawn').Pool(workers, initializer=init_worker, initargs=(name, snapshot)) as pool:
+        with tqdm(total=tracks, unit='track', desc=name) as pbar:
+            for start, block_indices, block_similarities in pool.imap_unordered(partial(block_neighbours, k=k), range(0, tracks, BLOCK_SIZE)):
+                indices[start:start + len(block_indices)] = block_indices
+                similarities[start:start + len(block_indices)] = block_similarities
+                pbar.update(len(block_indices))
+
+    return indices, similarities
+
+
+def load_neighbours(model):
+    """
+    Load the radio neighbours of every track under one model
+
+    Parameters:
+    model (str): The name of the model, one of MODELS
+
+    Returns:
+    audio_files (np.array): The audio file of each track
+    neighbours (np.array): The neighbours of each track, as indices into audio_files
+    similarities (np.array): The cosine similarities of the neighbours
+    """
+    table = store.read_table(store.RADIO_NEIGHBOURS_TABLE, columns=[f'{model}_neighbours', f'{model}_similarities'])
+    embedded = store.read_table(MODELS[model], columns=[])[store.INDEX_COLUMN]
+    if not np.array_equal(table[store.INDEX_COLUMN], embedded):
+        raise ValueError(f"The radio neighbours are out of date, the '{MODELS[model]}' table has changed since. Run radio.py again")
+
+    return table[store.INDEX_COLUMN], table[f'{model}_neighbours'], table[f'{model}_similarities']
+
+
+def write_playlists(audio_files, neighbours, model):
+    """
+    Write one .m3u8 playlist per track with its neighbours, mirroring the audio directory
+
+    Parameters:
+    audio_files (np.array): The audio file of each row
+    neighbours (np.array): The neighbours of each track, as indices into audio_files
+    model (str): The name of the model, playlists are written to a directory per model
+
+    Returns:
+    None
+    """
+    for audio_file, track_neighbours in zip(tqdm(audio_files, unit='playlist', desc=model), neighbours):
+        playlist = os.path.join(RADIO_PLAYLISTS_PATH, model, os.path.splitext(os.path.relpath(audio_file, AUDIO_PATH))[0] + '.m3u8')
+        os.makedirs(os.path.dirname(playlist), exist_ok=True)
+        # Paths relative to the playlist, so that the playlist can be opened from its folder
+        with open(playlist, 'w') as file:
+            file.write('\n'.join(os.path.relpath(audio_files[i], os.path.dirname(playlist)) for i in track_neighbours))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the most similar tracks of every track under both embedding models")
+    parser.add_argument('--k', type=int, default=50, help="Number of neighbours per track (default: 50)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--playlists', action='store_true', help=f"Also write an .m3u8 playlist per track and model to {RADIO_PLAYLISTS_PATH}")
+    args = parser.parse_args()
+
+    audio_files = store.read_table(store.DISCOGS_EMBEDDINGS_TABLE, columns=[])[store.INDEX_COLUMN]
+    if not np.array_equal(audio_files, store.read_table(store.MUSICNN_EMBEDDINGS_TABLE, columns=[])[store.INDEX_COLUMN]):
+        raise SystemExit("The Discogs-EffNet and MusiCNN embeddings tables contain different tracks, run main.py or extract_embeddings.py again")
+
+    # The neighbour indices are rows of the embeddings tables, which are the rows of the neighbours table written here
+    table = {store.INDEX_COLUMN: audio_files}
+    for model, name in MODELS.items():
+        indices, similarities = all_neighbours(name, args.k, args.workers)
+        table[f'{model}_neighbours'] = indices
+        # Half precision is plenty to order and display the similarities
+        table[f'{model}_similarities'] = similarities.astype(np.float16)
+
+    # Tracks analyzed meanwhile, e.g. by the analysis worker, would shift the rows the neighbour indices refer to
+    for name in MODELS.values():
+        if not np.array_equal(audio_files, store.read_table(name, columns=[])[store.INDEX_COLUMN]):
+            raise SystemExit(f"The '{name}' table changed while the neighbours were computed, run radio.py again")
+
+    store.clear(store.RADIO_NEIGHBOURS_TABLE)
+    os.makedirs(store.table_path(store.RADIO_NEIGHBOURS_TABLE))
+    store.write_table(store.RADIO_NEIGHBOURS_TABLE, table)
+    print(f"Neighbours of {len(audio_files)} tracks written to {store.table_path(store.RADIO_NEIGHBOURS_TABLE)}")
+
+    if args.playlists:
+        for model in MODELS:
+            write_playlists(audio_files, table[f'{model}_neighbours'], model)
+        print(f"Playlists written to {RADIO_PLAYLISTS_PATH}")
+
+
+if __name__ == "__main__":
+    main()
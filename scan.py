@@ -0,0 +1,166 @@
+"""
+Parallel scanner for the audio files of large directory trees.
+
+scan_audio_files lists directories with os.scandir in a pool of threads, so that the latency of network file systems
+(e.g. NFS) overlaps between directories, and yields each audio file with its size and modification time as soon as
+its directory is listed, so the analysis can start before the whole tree is scanned.
+
+A ScanManifest can be passed to make rescans incremental. It records the modification time, audio files (with their
+size and modification time) and subdirectories of each directory, and a directory whose modification time has not
+changed is not listed again. A directory's modification time changes when files are added, removed or renamed in it,
+but not when a file is rewritten in place, so such files are only seen by a scan without the manifest.
+
+"""
+
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+SCAN_MANIFEST_FILE_PATH = 'data/scan_manifest.json'
+SCAN_WORKERS = 16
+
+# Directories modified less than this many nanoseconds before they are listed are not recorded in the manifest, as
+# files may still be added to them within the resolution of the modification time
+RACY_MTIME_NS = 2 * 10 ** 9
+
+
+class ScanManifest:
+    """
+    Listing of each scanned directory, reused while the modification time of the directory is unchanged
+    """
+
+    def __init__(self, file_path=SCAN_MANIFEST_FILE_PATH, file_types=()):
+        """
+        Initialise the manifest from its file, if it exists and was written for the same file types
+
+        Parameters:
+        file_path (str): The path to the manifest file
+        file_types (list): The extensions of the files that are recorded
+
+        Returns:
+        None
+        """
+        self.file_path = file_path
+        self.file_types = sorted(file_types)
+        self.directories = {}
+        self.scanned = {}
+
+        if os.path.exists(file_path):
+            with open(file_path) as file:
+                manifest = json.load(file)
+            if manifest['file_types'] == self.file_types:
+                self.directories = manifest['directories']
+
+    def get(self, directory, mtime):
+        """
+        Get the listing of a directory, if the directory has not been modified since it was recorded
+
+        Parameters:
+        directory (str): The path to the directory
+        mtime (int): The current modification time of the directory in nanoseconds
+
+        Returns:
+        listing (tuple): The (name, size, mtime) of each audio file and the names of the subdirectories, None if the
+                         directory has to be listed again
+        """
+        recorded = self.directories.get(directory)
+        if recorded is None or recorded[0] != mtime:
+            return None
+        self.scanned[directory] = recorded
+
+        return recorded[1], recorded[2]
+
+    def put(self, directory, mtime, files, subdirectories):
+        if time.time_ns() - mtime >= RACY_MTIME_NS:
+            self.scanned[directory] = [mtime, files, subdirectories]
+
+    def save(self):
+        """
+        Write the listings of the directories of the last scan, directories that were not scanned are left out
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        with open(self.file_path + '.tmp', 'w') as file:
+            json.dump({'file_types': self.file_types, 'directories': self.scanned}, file)
+        os.replace(self.file_path + '.tmp', self.file_path)
+
+
+def _scan_directory(directory, file_types, manifest):
+    """
+    List the audio files and subdirectories of one directory
+
+    Parameters:
+    directory (str): The path to the directory, '' for the current directory
+    file_types (tuple): The extensions of the audio files
+    manifest (ScanManifest): The manifest with the previous listings, or None
+
+    Returns:
+    directory (str): The path to the directory
+    files (list): The name, size and modification time in nanoseconds of each audio file
+    subdirectories (list): The names of the subdirectories, symbolic links to directories are not followed
+    """
+    try:
+        mtime = os.stat(directory or os.curdir).st_mtime_ns
+        listing = manifest.get(directory, mtime) if manifest is not None else None
+        if listing is not None:
+            return directory, *listing
+
+        files, subdirectories = [], []
+        with os.scandir(directory or os.curdir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirectories.append(entry.name)
+                    elif entry.name.endswith(file_types):
+                        stat = entry.stat()
+                        files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    # The entry was removed while the directory was listed
+                    continue
+    except OSError:
+        # Unreadable or removed directories are skipped, like os.walk does
+        return directory, [], []
+
+    if manifest is not None:
+        manifest.put(directory, mtime, files, subdirectories)
+
+    return directory, files, subdirectories
+
+
+def scan_audio_files(directory, file_types, workers=SCAN_WORKERS, manifest=None):
+    """
+    Find the audio files of a directory tree, listing its directories in parallel
+
+    Parameters:
+    directory (str): The directory to search
+    file_types (list): The extensions of the audio files
+    workers (int): The number of directories listed at once
+    manifest (ScanManifest): A manifest of a previous scan, directories that were not modified since are not listed
+
+    Yields:
+    audio_file (str): The path to an audio file, relative to the current directory
+    signature (tuple): The size in bytes and the modification time in nanoseconds of the file
+    """
+    # Relative paths are joined as they are, so there is no relpath call per file
+    directory = os.path.relpath(directory)
+    if directory == os.curdir:
+        directory = ''
+    file_types = tuple(file_types)
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(_scan_directory, directory, file_types, manifest)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, files, subdirectories = future.result()
+                for subdirectory in subdirectories:
+                    pending.add(executor.submit(_scan_directory, os.path.join(path, subdirectory), file_types, manifest))
+                for name, size, mtime in files:
+                    yield os.path.join(path, name), (size, mtime)
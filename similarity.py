@@ -0,0 +1,259 @@
+"""
+Methods for querying the tracks most similar to a query track.
+
+Embeddings are L2-normalized once with normalize when they are written to the store, after which the cosine similarity between the query track and all
+tracks is a single matrix-vector product. top_k only sorts the k most similar tracks, selected with np.argpartition,
+so a query needs O(N) time and memory instead of the O(N^2) of a full similarity matrix.
+
+For large collections the normalized embeddings can be quantized to float16, or to int8 with a scale per dimension,
+which stores them in a half or a quarter of the memory. QuantizedEmbeddings computes the similarities directly from the
+quantized codes, in chunks, and can be used in place of the normalized float32 array by query and the indexes of ann.py.
+
+"""
+
+import numpy as np
+
+QUANTIZATIONS = ['float16', 'int8']
+
+
+def normalize(embeddings):
+    """
+    L2-normalize embeddings so that their dot product is the cosine similarity
+
+    Parameters:
+    embeddings (np.array): The embeddings, one row per track, or the embedding of one track
+
+    Returns:
+    normalized (np.array): The float32 normalized embeddings, rows with a zero norm are left as zeros
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return embeddings / norms
+
+
+def is_normalized(embeddings, sample=1024, tolerance=1e-3):
+    """
+    Check whether float32 embeddings are already normalized, from a sample of rows spread over the array
+
+    Parameters:
+    embeddings (np.array): The embeddings, e.g. memory-mapped, only the sampled rows are read
+    sample (int): The number of rows checked, None checks every row
+    tolerance (float): The largest difference of a norm from 1
+
+    Returns:
+    normalized (bool): Whether the sampled rows have a norm of 1, or of 0
+    """
+    if embeddings.dtype != np.float32:
+        return False
+
+    if sample is None:
+        norms = np.linalg.norm(np.asarray(embeddings), axis=1)
+    else:
+        rows = np.unique(np.linspace(0, len(embeddings) - 1, num=min(sample, len(embeddings)), dtype=np.int64))
+        norms = np.linalg.norm(embeddings[rows], axis=1)
+
+    return bool(np.all((np.abs(norms - 1) < tolerance) | (norms == 0)))
+
+
+def top_k(scores, k, exclude=None):
+    """
+    Select the k highest scores in descending order
+
+    Parameters:
+    scores (np.array): The score of each track
+    k (int): The number of tracks to select
+    exclude (int): The index of a track to leave out, e.g. the query track
+
+    Returns:
+    indices (np.array): The indices of the selected tracks
+    scores (np.array): The scores of the selected tracks
+    """
+    scores = np.asarray(scores)
+    if exclude is not None:
+        scores = scores.copy()
+        scores[exclude] = -np.inf
+        k = min(k, len(scores) - 1)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.intp), scores[:0]
+
+    # Partition the k highest scores to the front, then only sort those
+    indices = np.argpartition(-scores, k - 1)[:k]
+    indices = indices[np.argsort(-scores[indices], kind='stable')]
+
+    return indices, scores[indices]
+
+
+def query(normalized, query_index, k=10):
+    """
+    Find the tracks most similar to a query track
+
+    Parameters:
+    normalized (np.array): The normalized embeddings returned by normalize
+    query_index (int): The index of the query track
+    k (int): The number of similar tracks to return
+
+    Returns:
+    indices (np.array): The indices of the most similar tracks, excluding the query track
+    similarities (np.array): The cosine similarities of these tracks to the query track
+    """
+    similarities = normalized @ normalized[query_index]
+
+    return top_k(similarities, k, exclude=query_index)
+
+
+def batch_top_k(queries, normalized, k, exclude=None, chunk_size=16384):
+    """
+    Find the k tracks most similar to each of several query vectors, scanning the tracks in chunks with a running top k
+
+    Only a (queries x chunk_size) block of similarities is held in memory at once, whatever the number of tracks.
+
+    Parameters:
+    queries (np.array): The normalized query vectors, one row per query
+    normalized (np.array): The normalized embeddings of the tracks
+    k (int): The number of similar tracks per query
+    exclude (np.array): The index of a track to leave out for each query, e.g. the query tracks themselves
+    chunk_size (int): The number of tracks scored at once
+
+    Returns:
+    indices (np.array): The int32 indices of the most similar tracks of each query, in descending similarity
+    similarities (np.array): The float32 cosine similarities of these tracks to each query
+    """
+    n = len(normalized)
+    k = min(k, n - 1 if exclude is not None else n)
+    if k <= 0:
+        return np.empty((len(queries), 0), dtype=np.int32), np.empty((len(queries), 0), dtype=np.float32)
+
+    rows = np.arange(len(queries))
+    best_indices = np.full((len(queries), k), -1, dtype=np.int32)
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+    for start in range(0, n, chunk_size):
+        scores = queries @ np.asarray(normalized[start:start + chunk_size], dtype=np.float32).T
+        if exclude is not None:
+            in_chunk = (exclude >= start) & (exclude < start + scores.shape[1])
+            scores[rows[in_chunk], exclude[in_chunk] - start] = -np.inf
+
+        # Merge the chunk with the current top k, then keep the k highest of each row
+        candidate_scores = np.concatenate([best_scores, scores], axis=1)
+        candidate_indices = np.concatenate([best_indices, np.broadcast_to(np.arange(start, start + scores.shape[1], dtype=np.int32), scores.shape)], axis=1)
+        keep = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(candidate_scores, keep, axis=1)
+        best_indices = np.take_along_axis(candidate_indices, keep, axis=1)
+
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+
+    return np.take_along_axis(best_indices, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class QuantizedEmbeddings:
+    """
+    Normalized embeddings stored as float16 or as int8 codes with a scale per dimension
+
+    Indexing returns dequantized float32 rows and the @ operator scores all rows against a float32 query vector,
+    so the quantized embeddings can be used wherever the normalized float32 array is used.
+    """
+
+    # Number of bytes of the float32 rows dequantized at once when scoring, small enough to stay in the CPU cache
+    chunk_bytes = 2**20
+
+    def __init__(self, codes, scale=None):
+        """
+        Initialise the quantized embeddings
+
+        Parameters:
+        codes (np.array): The float16 embeddings, or the int8 codes of the embeddings
+        scale (np.array): The float32 scale of each dimension of the int8 codes, None for float16 embeddings
+
+        Returns:
+        None
+        """
+        self.codes = codes
+        self.scale = scale
+
+    @property
+    def quantization(self):
+        return str(self.codes.dtype)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        vectors = self.codes[rows].astype(np.float32)
+
+        return vectors * self.scale if self.scale is not None else vectors
+
+    def __matmul__(self, vector):
+        """
+        Compute the dot product of every row with a query vector, without dequantizing all rows at once
+
+        Parameters:
+        vector (np.array): The float32 query vector
+
+        Returns:
+        scores (np.array): The float32 dot product of each row with the query vector
+        """
+        # Fold the scale of the int8 codes into the query vector, so that the codes only need a cast. numpy casts
+        # float16 several times slower than integers, so float16 codes are read through their bits instead: shifted
+        # into the exponent and mantissa of a float32, they are the float16 values times 2**-112, also folded into the
+        # query vector (the sign bit is moved with a mask). This is exact, for zeros and subnormal values as well
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.scale is not None:
+            vector = vector * self.scale
+            codes = self.codes
+        else:
+            vector = vector * np.float32(2.0 ** 112)
+            codes = self.codes.view(np.int16)
+
+        rows = max(1, self.chunk_bytes // (4 * codes.shape[1]))
+        chunk = np.empty((rows, codes.shape[1]), dtype=np.float32)
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), rows):
+            block = codes[start:start + rows]
+            values = chunk[:len(block)]
+            if self.scale is not None:
+                np.copyto(values, block, casting='unsafe')
+            else:
+                bits = values.view(np.int32)
+                np.copyto(bits, block)
+                np.left_shift(bits, 13, out=bits)
+                np.bitwise_and(bits, np.int32(~0x70000000), out=bits)
+            np.matmul(values, vector, out=scores[start:start + len(block)])
+
+        return scores
+
+
+def quantize(normalized, quantization, scale=None):
+    """
+    Quantize normalized embeddings
+
+    Parameters:
+    normalized (np.array): The normalized float32 embeddings
+    quantization (str): 'float16', or 'int8' for symmetric int8 codes with the scale of each dimension set by its largest value
+    scale (np.array): The int8 scale of each dimension to use instead, e.g. to quantize rows appended to quantized
+                      embeddings, larger values are clipped
+
+    Returns:
+    quantized (QuantizedEmbeddings): The quantized embeddings
+    """
+    if quantization == 'float16':
+        return QuantizedEmbeddings(np.asarray(normalized, dtype=np.float16))
+    if quantization != 'int8':
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+
+    if scale is None:
+        scale = np.abs(normalized).max(axis=0).astype(np.float32) / 127
+        scale[scale == 0] = 1
+    codes = np.clip(np.rint(normalized / scale), -127, 127).astype(np.int8)
+
+    return QuantizedEmbeddings(codes, scale)
@@ -1,5 +1,5 @@
 """
-This script reads the genre_predictions.csv and features.csv files, plots and saves the distribution of the following features:
+This script reads the genre predictions and features tables from the feature store, plots and saves the distribution of the following features:
 - Parent genre
 - Tempo
 - Danceability
@@ -12,9 +12,7 @@ This script reads the genre_predictions.csv and features.csv files, plots and sa
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-
-FEATURES_FILE_PATH = 'data/features.csv'
-GENRE_PREDICTIONS_FILE_PATH = 'data/genre_predictions.csv'
+import store
 
 # Define common plotting parameters
 title_font_size = 14
@@ -66,26 +64,26 @@ def plot_distribution(data, x_col, title, xlabel, ylabel, save_path, kde=False,
 
 
 # MAIN -----------------------------------------------------------------------------------------------
-# Read features file path
-df_features = pd.read_csv(FEATURES_FILE_PATH, header=None)
+# Read features table
+df_features = store.load_frame(store.FEATURES_TABLE)
 
-# Read genre predictions file path and plot distribution of genres
+# Read genre predictions table and plot distribution of genres
 print("Plotting distribution of parent genres...")
-df_genres = pd.read_csv(GENRE_PREDICTIONS_FILE_PATH, usecols=[3], header=None)
+df_genres = store.load_frame(store.GENRE_PREDICTIONS_TABLE, columns=['parentGenre'])
 df_genres.columns = ['Parent Genre']
 plot_distribution(df_genres, 'Parent Genre', 'Distribution of Parent Genres', None, 'Number of tracks', 'plots/parent_genre_distribution.png', rotation=45)
 
 # Plot tempo distribution
 print("Plotting tempo distribution...")
-plot_distribution(df_features[1], 'Tempo', 'Tempo distribution', 'Tempo (bpm)', 'Number of tracks', 'plots/tempo_distribution.png', kde=True, rugplot=True)
+plot_distribution(df_features['tempo'], 'Tempo', 'Tempo distribution', 'Tempo (bpm)', 'Number of tracks', 'plots/tempo_distribution.png', kde=True, rugplot=True)
 
 # Plot danceability distribution
 print("Plotting danceability distribution...")
-plot_distribution(df_features[10], 'Danceability', 'Danceability distribution', 'Danceability (0-1)', 'Number of tracks', 'plots/danceability_distribution.png', rugplot=True)
+plot_distribution(df_features['danceability'], 'Danceability', 'Danceability distribution', 'Danceability (0-1)', 'Number of tracks', 'plots/danceability_distribution.png', rugplot=True)
 
 # Plot key distribution only
 print("Plotting key distribution for each profile...")
-df_key = df_features[[2, 4, 6]].copy()  # Explicitly copy the subset
+df_key = df_features[['keyTemperley', 'keyKrumhansl', 'keyEdma']].copy()  # Explicitly copy the subset
 df_key.columns = ['Temperley', 'Krumhansl', 'Edma']
 df_key = df_key.melt(var_name='Profile', value_name='Key')
 
@@ -93,7 +91,7 @@ plot_distribution(df_key, 'Key', 'Key Distribution between profiles', 'Key', 'Nu
 
 # Plot scale distribution only
 print("Plotting scale distribution for each profile...")
-df_scale = df_features[[3, 5, 7]].copy()  # Explicitly copy the subset
+df_scale = df_features[['scaleTemperley', 'scaleKrumhansl', 'scaleEdma']].copy()  # Explicitly copy the subset
 df_scale.columns = ['Temperley', 'Krumhansl', 'Edma']
 df_scale = df_scale.melt(var_name='Profile', value_name='Scale')
 
@@ -102,7 +100,7 @@ plot_distribution(df_scale,'Scale', 'Scale Distribution between profiles', 'Scal
 # Plot key and scale distribution
 print("Plotting key and scale distribution...")
 for profile in ['Temperley', 'Krumhansl', 'Edma']:
-    key_col, scale_col = (2, 3) if profile == 'Temperley' else (4, 5) if profile == 'Krumhansl' else (6, 7)
+    key_col, scale_col = f'key{profile}', f'scale{profile}'
     df_key_scale = df_features[[key_col, scale_col]].copy()  # Explicitly copy the subset
     df_key_scale.columns = ['key', 'scale']
     df_key_scale['Key and Scale'] = df_key_scale['key'] + ' ' + df_key_scale['scale']
@@ -110,15 +108,15 @@ for profile in ['Temperley', 'Krumhansl', 'Edma']:
 
 # Plot loudness distribution
 print("Plotting loudness distribution...")
-plot_distribution(df_features[8], 'Loudness', 'Loudness distribution', 'Loudness (LUFS)', 'Number of tracks', 'plots/loudness_distribution.png', kde=True, rugplot=True)
+plot_distribution(df_features['loudness'], 'Loudness', 'Loudness distribution', 'Loudness (LUFS)', 'Number of tracks', 'plots/loudness_distribution.png', kde=True, rugplot=True)
 
 # Plot distribution of voice/instrumental tracks
 print("Plotting voice/instrumental distribution...")
-plot_distribution(df_features[9], 'Voice/Instrumental', 'Distribution of Voice/Instrumental tracks', None, 'Number of tracks', 'plots/voice_instrumental_distribution.png', hist_shrink=0.8)
+plot_distribution(df_features['instrumental'], 'Voice/Instrumental', 'Distribution of Voice/Instrumental tracks', None, 'Number of tracks', 'plots/voice_instrumental_distribution.png', hist_shrink=0.8)
 
 # Plot arousal and valence distribution
 print("Plotting arousal and valence distribution...")
-df_arousal_valence = df_features[[11, 12]].copy()          # Explicitly copy the subset
+df_arousal_valence = df_features[['arousal', 'valence']].copy()          # Explicitly copy the subset
 df_arousal_valence.columns = ['Arousal', 'Valence']
 
 # Scatter plot
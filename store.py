@@ -0,0 +1,761 @@
+"""
+Binary columnar storage for the analysis results.
+
+Each table is a directory in data/store. The compacted rows of a table are stored in a base directory, with one .npy
+file per column and an index.txt file with the audio file of each row. Rows appended during the analysis are buffered
+by a TableWriter and written in batches as .npz part files, which compact() merges into a new base directory.
+
+Written files are never modified. A part file or base directory is only read once it is published: published.json in
+data/store records the base directory and the last part file of each table, and is replaced atomically. publish makes the
+part files of several table writers visible together, and compact and keep_rows publish the new base directories of
+several tables together, so readers see the same tracks in all of them. Reads given the same read_snapshot see the tables
+as they were published together. Files that are no longer published are removed one generation later, so that readers
+of the previous snapshot can finish.
+
+Tables are read back as typed numpy columns with read_table, or as a pandas DataFrame indexed by audio file with load_frame.
+Columns are stored as contiguous arrays, so compacted tables such as the embedding matrices can be memory-mapped with
+read_table(name, mmap=True) and only the pages that are used are read from disk. read_column memory-maps a column also
+while part files are pending, stacking their rows after the base rows without copying the base column.
+
+Tables that were never written are migrated from the CSV files of earlier versions the first time they are read.
+Running this script migrates the CSV files written by earlier versions of main.py and extract_embeddings.py to the store,
+and normalizes the embeddings tables written before the embeddings were normalized on write. Embeddings are only
+normalized here and on write, reading them never modifies the store.
+
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import numpy as np
+import similarity
+
+# Store path and table names
+STORE_PATH = 'data/store'
+FEATURES_TABLE = 'features'
+GENRE_PREDICTIONS_TABLE = 'genre_predictions'
+DISCOGS_EMBEDDINGS_TABLE = 'discogs_embeddings'
+MUSICNN_EMBEDDINGS_TABLE = 'musicnn_embeddings'
+RADIO_NEIGHBOURS_TABLE = 'radio_neighbours'
+EMBEDDINGS_TABLES = [DISCOGS_EMBEDDINGS_TABLE, MUSICNN_EMBEDDINGS_TABLE]
+
+# Column names of the features table, in the order of the columns of features.csv
+FEATURES_COLUMNS = ['audio_file', 'tempo', 'keyTemperley', 'scaleTemperley', 'keyKrumhansl', 'scaleKrumhansl', 'keyEdma', 'scaleEdma',
+                    'loudness', 'instrumental', 'danceability', 'arousal', 'valence']
+
+# Columns of the features table with a small set of values, loaded as categoricals
+CATEGORICAL_COLUMNS = ['keyTemperley', 'scaleTemperley', 'keyKrumhansl', 'scaleKrumhansl', 'keyEdma', 'scaleEdma', 'instrumental']
+
+# Keys in the spelling of Essentia's key extractors, which write Eb, Ab and Bb rather than D#, G# and A#
+KEYS = ['C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B']
+
+# Legacy CSV files of each table and the number of leading scalar columns, the remaining columns form a matrix column
+LEGACY_CSV_FILES = {
+    FEATURES_TABLE: ('data/features.csv', FEATURES_COLUMNS, None),
+    GENRE_PREDICTIONS_TABLE: ('data/genre_predictions.csv', ['audio_file', 'genreNumber', 'genre', 'parentGenre'], 'activations'),
+    DISCOGS_EMBEDDINGS_TABLE: ('data/discogs_effnet_embeddings.csv', ['audio_file'], 'embedding'),
+    MUSICNN_EMBEDDINGS_TABLE: ('data/musicnn_embeddings.csv', ['audio_file'], 'embedding'),
+}
+
+BATCH_SIZE = 256
+INDEX_COLUMN = 'audio_file'
+INDEX_FILE = 'index.txt'
+META_FILE = 'meta.json'
+PUBLISHED_FILE = 'published.json'
+PUBLISH_LOCK_FILE = 'published.lock'
+MIGRATE_LOCK_FILE = 'migrate.lock'
+
+
+def table_path(name):
+    return os.path.join(STORE_PATH, name)
+
+
+def _base_path(name, number):
+    # Base directory 0 is the base directory of earlier versions
+    return os.path.join(table_path(name), 'base' if number == 0 else f'base-{number:06d}')
+
+
+def _base_numbers(name):
+    if not os.path.exists(table_path(name)):
+        return []
+
+    return sorted(0 if file == 'base' else int(file[5:]) for file in os.listdir(table_path(name))
+                  if file == 'base' or (file.startswith('base-') and file[5:].isdigit()))
+
+
+def _part_numbers(name):
+    """
+    List the part files of a table, published or not
+
+    Parameters:
+    name (str): The name of the table
+
+    Returns:
+    part_numbers (list): The sorted numbers of the part files
+    """
+    if not os.path.exists(table_path(name)):
+        return []
+
+    return sorted(int(file[5:-4]) for file in os.listdir(table_path(name)) if file.startswith('part-') and file.endswith('.npz'))
+
+
+def _part_file(name, number):
+    return os.path.join(table_path(name), f'part-{number:06d}.npz')
+
+
+def read_snapshot():
+    """
+    Read the published state of all tables, reads given the same snapshot see the tables as they were published together
+
+    Parameters:
+    None
+
+    Returns:
+    snapshot (dict): The published base directory and last part file of each table
+    """
+    try:
+        with open(os.path.join(STORE_PATH, PUBLISHED_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def _state(name, snapshot=None):
+    """
+    Get the published base directory and last part file of a table
+
+    Parameters:
+    name (str): The name of the table
+    snapshot (dict): The snapshot returned by read_snapshot, None to read the current one
+
+    Returns:
+    base (int): The number of the base directory, None if the table has no base directory
+    last_part (int): The number of the last published part file
+    """
+    if snapshot is None:
+        snapshot = read_snapshot()
+    if name in snapshot:
+        return snapshot[name]['base'], snapshot[name]['last_part']
+
+    # Tables written by earlier versions are not published: their base directory and all their part files are read,
+    # restoring the base directory of an interrupted compaction
+    legacy_path = _base_path(name, 0)
+    if not os.path.exists(legacy_path) and os.path.exists(legacy_path + '.old'):
+        os.rename(legacy_path + '.old', legacy_path)
+    bases = _base_numbers(name)
+
+    return (bases[-1] if bases else None), max(_part_numbers(name), default=0)
+
+
+def _load_meta(name, base):
+    """
+    Load the metadata of a base directory of a table
+
+    Parameters:
+    name (str): The name of the table
+    base (int): The number of the base directory, None if the table has no base directory
+
+    Returns:
+    meta (dict): The column names and the number of the last part file merged into the base directory
+    """
+    if base is None or not os.path.exists(os.path.join(_base_path(name, base), META_FILE)):
+        return {'columns': [], 'last_part': 0}
+
+    with open(os.path.join(_base_path(name, base), META_FILE)) as file:
+        return json.load(file)
+
+
+def _pending_parts(name, base, last_part):
+    # The published part files that have not been merged into the base directory
+    merged = _load_meta(name, base)['last_part']
+
+    return [number for number in _part_numbers(name) if merged < number <= last_part]
+
+
+def _publish(states):
+    """
+    Publish the new state of several tables together, by replacing published.json
+
+    Parameters:
+    states (dict): For each table, the new last part file and optionally the new base directory, None to publish it empty
+
+    Returns:
+    None
+    """
+    os.makedirs(STORE_PATH, exist_ok=True)
+    replaced = {}
+    with open(os.path.join(STORE_PATH, PUBLISH_LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        snapshot = read_snapshot()
+        for name, state in states.items():
+            if state is None:
+                snapshot[name] = {'base': None, 'last_part': 0}
+                continue
+            base, last_part = _state(name, snapshot)
+            if state.get('base', base) != base:
+                replaced[name] = base
+            # Part files published by other writers meanwhile stay published
+            snapshot[name] = {'base': state.get('base', base), 'last_part': max(last_part, state['last_part'])}
+
+        file_path = os.path.join(STORE_PATH, PUBLISHED_FILE)
+        with open(file_path + '.tmp', 'w') as file:
+            json.dump(snapshot, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file_path + '.tmp', file_path)
+
+    # Remove the files that only readers of snapshots before the previous one could use
+    for name, previous in replaced.items():
+        if previous is None:
+            continue
+        for number in _base_numbers(name):
+            if number < previous:
+                shutil.rmtree(_base_path(name, number), ignore_errors=True)
+        merged = _load_meta(name, previous)['last_part']
+        for number in _part_numbers(name):
+            if number <= merged:
+                os.remove(_part_file(name, number))
+
+
+def _as_column(values):
+    """
+    Convert a list of values to a typed numpy column, strings are stored as fixed-width unicode
+
+    Parameters:
+    values (list or np.array): The values of the column
+
+    Returns:
+    column (np.array): The typed column
+    """
+    column = np.asarray(values)
+    if column.dtype == object:
+        column = column.astype(str)
+
+    # Store row-major arrays so that rows of matrix columns are contiguous when memory-mapped
+    return np.ascontiguousarray(column)
+
+
+def table_exists(name):
+    base, last_part = _state(name)
+
+    return bool(_load_meta(name, base)['columns']) or bool(_pending_parts(name, base, last_part))
+
+
+def pending_parts(name):
+    """
+    Count the published part files of a table that have not been compacted yet
+
+    Parameters:
+    name (str): The name of the table
+
+    Returns:
+    count (int): The number of pending part files
+    """
+    return len(_pending_parts(name, *_state(name)))
+
+
+def table_mtime(name):
+    """
+    Get the modification time of a table, which changes whenever rows are published, compacted or removed
+
+    Parameters:
+    name (str): The name of the table
+
+    Returns:
+    mtime (int): The latest modification time of the table directory and of the published state in nanoseconds, 0 if
+                 the table does not exist
+    """
+    mtimes = []
+    for path in [table_path(name), os.path.join(STORE_PATH, PUBLISHED_FILE)]:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+
+    return max(mtimes) if os.path.exists(table_path(name)) else 0
+
+
+def read_table(name, columns=None, mmap=False, snapshot=None):
+    """
+    Read the columns of a table
+
+    Parameters:
+    name (str): The name of the table
+    columns (list): The columns to read, None reads all columns
+    mmap (bool): Whether to memory-map the columns instead of reading them, only if the table has no pending part files
+    snapshot (dict): The snapshot returned by read_snapshot to read the table from, None to read its current state
+
+    Returns:
+    table (dict): The audio_file column and each requested column as a numpy array, rows in insertion order
+    """
+    base, last_part = _state(name, snapshot)
+    meta = _load_meta(name, base)
+    part_numbers = _pending_parts(name, base, last_part)
+
+    if columns is None:
+        columns = meta['columns']
+        if not columns and part_numbers:
+            with np.load(_part_file(name, part_numbers[0])) as part:
+                columns = [column for column in part.files if column != INDEX_COLUMN]
+
+    chunks = {column: [] for column in [INDEX_COLUMN] + list(columns)}
+
+    if meta['columns']:
+        base_path = _base_path(name, base)
+        with open(os.path.join(base_path, INDEX_FILE)) as file:
+            chunks[INDEX_COLUMN].append(np.array(file.read().splitlines(), dtype=str))
+        # Pending part files have to be concatenated with the base columns, so those are read in memory
+        mmap_mode = 'r' if mmap and not part_numbers else None
+        for column in columns:
+            chunks[column].append(np.load(os.path.join(base_path, column + '.npy'), mmap_mode=mmap_mode))
+
+    for number in part_numbers:
+        with np.load(_part_file(name, number)) as part:
+            for column in chunks:
+                chunks[column].append(part[column])
+
+    if not chunks[INDEX_COLUMN]:
+        if _migrate_missing(name):
+            return read_table(name, columns, mmap)
+        raise FileNotFoundError(f"Table '{name}' does not exist in {STORE_PATH}, run main.py to analyze the audio files")
+
+    return {column: np.concatenate(chunk) if len(chunk) > 1 else chunk[0] for column, chunk in chunks.items()}
+
+
+class StackedRows:
+    """
+    Rows of a column stored in several chunks, e.g. a memory-mapped base column and the part files appended since
+
+    Rows are indexed like the rows of one array, and the @ operator multiplies each chunk in turn, so the chunks are
+    never copied into one array.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.offsets = np.cumsum([0] + [len(chunk) for chunk in chunks])
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]),) + self.chunks[0].shape[1:]
+
+    @property
+    def dtype(self):
+        return self.chunks[0].dtype
+
+    @property
+    def nbytes(self):
+        return sum(chunk.nbytes for chunk in self.chunks)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            row = rows + len(self) if rows < 0 else rows
+            if not 0 <= row < len(self):
+                raise IndexError(f"Row {rows} is out of bounds for {len(self)} rows")
+            chunk = np.searchsorted(self.offsets, row, side='right') - 1
+            return self.chunks[chunk][row - self.offsets[chunk]]
+
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(len(self)))
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = np.where(rows < 0, rows + len(self), rows)
+
+        values = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        for chunk, start, end in zip(self.chunks, self.offsets[:-1], self.offsets[1:]):
+            in_chunk = (rows >= start) & (rows < end)
+            if in_chunk.any():
+                values[in_chunk] = chunk[rows[in_chunk] - start]
+
+        return values
+
+    def __matmul__(self, other):
+        return np.concatenate([chunk @ other for chunk in self.chunks])
+
+    def __array__(self, dtype=None, copy=None):
+        values = np.concatenate(self.chunks)
+
+        return values.astype(dtype, copy=False) if dtype is not None else values
+
+
+def read_column(name, column, snapshot=None):
+    """
+    Read one column of a table memory-mapped, also when the table has pending part files
+
+    Parameters:
+    name (str): The name of the table
+    column (str): The name of the column
+    snapshot (dict): The snapshot returned by read_snapshot to read the table from, None to read its current state
+
+    Returns:
+    values (np.memmap or StackedRows): The memory-mapped base column, stacked with the rows of the pending part files
+    """
+    base, last_part = _state(name, snapshot)
+    chunks = []
+    if _load_meta(name, base)['columns']:
+        chunks.append(np.load(os.path.join(_base_path(name, base), column + '.npy'), mmap_mode='r'))
+    for number in _pending_parts(name, base, last_part):
+        with np.load(_part_file(name, number)) as part:
+            chunks.append(part[column])
+
+    if not chunks:
+        if _migrate_missing(name):
+            return read_column(name, column)
+        raise FileNotFoundError(f"Table '{name}' does not exist in {STORE_PATH}, run main.py to analyze the audio files")
+
+    return chunks[0] if len(chunks) == 1 else StackedRows(chunks)
+
+
+def load_frame(name, columns=None):
+    """
+    Load the one-dimensional columns of a table as a DataFrame indexed by audio file
+
+    Parameters:
+    name (str): The name of the table
+    columns (list): The columns to load, None loads all one-dimensional columns
+
+    Returns:
+    df (pd.DataFrame): The table
+    """
+    # pandas is imported on first use, so that scripts which only read columns start faster
+    import pandas as pd
+
+    table = read_table(name, columns)
+    index = table.pop(INDEX_COLUMN)
+    df = pd.DataFrame({column: values for column, values in table.items() if values.ndim == 1}, index=index)
+
+    return df
+
+
+def _write_base(name, table, last_part):
+    """
+    Write the rows of a table to a new base directory, which replaces the published rows once it is published
+
+    Parameters:
+    name (str): The name of the table
+    table (dict): The audio_file column and the other columns as numpy arrays
+    last_part (int): The number of the last part file whose rows are in the table, later part files stay pending
+
+    Returns:
+    state (dict): The new base directory and the last part file it replaces, to publish
+    """
+    number = max(_base_numbers(name), default=0) + 1
+    base_path = _base_path(name, number)
+    tmp_path = base_path + '.tmp'
+
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    columns = [column for column in table if column != INDEX_COLUMN]
+    with open(os.path.join(tmp_path, INDEX_FILE), 'w') as file:
+        file.writelines(audio_file + '\n' for audio_file in table[INDEX_COLUMN])
+    for column in columns:
+        np.save(os.path.join(tmp_path, column + '.npy'), _as_column(table[column]))
+    with open(os.path.join(tmp_path, META_FILE), 'w') as file:
+        json.dump({'columns': columns, 'last_part': last_part}, file)
+    os.rename(tmp_path, base_path)
+
+    return {'base': number, 'last_part': last_part}
+
+
+def write_table(name, table):
+    """
+    Replace all rows of a table, the new base directory is published only once all its files are written
+
+    Parameters:
+    name (str): The name of the table
+    table (dict): The audio_file column and the other columns as numpy arrays
+
+    Returns:
+    None
+    """
+    _publish({name: _write_base(name, table, _state(name)[1])})
+
+
+def compact(names):
+    """
+    Merge the pending part files of tables into new base directories, which are published together
+
+    Parameters:
+    names (str or list): The name of the table, or the names of tables that are read together
+
+    Returns:
+    None
+    """
+    names = [names] if isinstance(names, str) else names
+    # Each table is written before the next one is read, so only one table is held in memory. The snapshot is read
+    # first, so part files published meanwhile stay pending
+    snapshot = read_snapshot()
+    states = {name: _write_base(name, read_table(name, snapshot=snapshot), _state(name, snapshot)[1])
+              for name in names if _pending_parts(name, *_state(name, snapshot))}
+    if states:
+        _publish(states)
+
+
+def keep_rows(names, audio_files):
+    """
+    Keep only the rows of tables whose audio file is one of the given audio files, the tables are published together
+
+    Parameters:
+    names (str or list): The name of the table, or the names of tables that are read together
+    audio_files (set): The audio files to keep
+
+    Returns:
+    None
+    """
+    names = [names] if isinstance(names, str) else names
+    snapshot = read_snapshot()
+    states = {}
+    for name in names:
+        if not table_exists(name):
+            continue
+        table = read_table(name, snapshot=snapshot)
+        mask = np.array([audio_file in audio_files for audio_file in table[INDEX_COLUMN]], dtype=bool)
+        # Tables without rows to drop are not written again
+        if not mask.all():
+            states[name] = _write_base(name, {column: values[mask] for column, values in table.items()}, _state(name, snapshot)[1])
+
+    if states:
+        _publish(states)
+
+
+def clear(name):
+    """
+    Remove all rows of a table
+
+    Parameters:
+    name (str): The name of the table
+
+    Returns:
+    None
+    """
+    _publish({name: None})
+    shutil.rmtree(table_path(name), ignore_errors=True)
+
+
+class TableWriter:
+    """
+    Buffered writer that appends rows to a table in batches
+    """
+
+    def __init__(self, name, batch_size=BATCH_SIZE, publish=True):
+        """
+        Initialise the writer
+
+        Parameters:
+        name (str): The name of the table
+        batch_size (int): The number of rows buffered before they are written to a part file
+        publish (bool): Whether to publish each part file when it is written, otherwise the part files are published
+                        with publish, e.g. together with the part files of other tables
+
+        Returns:
+        None
+        """
+        self.name = name
+        self.batch_size = batch_size
+        self.publish = publish
+        self.last_part = None
+        self.rows = []
+        os.makedirs(table_path(name), exist_ok=True)
+
+        # Part files written but never published, e.g. by a run that was interrupted, would be published with the next ones
+        _, last_part = _state(name)
+        for number in _part_numbers(name):
+            if number > last_part:
+                os.remove(_part_file(name, number))
+        # All part files of tables written by earlier versions are read, so the table is published before parts are added
+        if name not in read_snapshot():
+            _publish({name: {'last_part': last_part}})
+
+    def append(self, row):
+        """
+        Append a row to the table
+
+        Parameters:
+        row (dict): The audio_file and the value of each column, array values are stored as matrix columns
+
+        Returns:
+        None
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered rows to a new part file
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        if not self.rows:
+            return
+
+        columns = {column: _as_column([row[column] for row in self.rows]) for column in self.rows[0]}
+        base, last_part = _state(self.name)
+        number = max(_part_numbers(self.name) + [last_part, _load_meta(self.name, base)['last_part']]) + 1
+
+        # Write to a temporary file first so that readers never see a partially written part, and sync it so that a
+        # part that exists after a crash of the machine is complete
+        part_file = _part_file(self.name, number)
+        with open(part_file + '.tmp', 'wb') as file:
+            np.savez(file, **columns)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(part_file + '.tmp', part_file)
+
+        self.rows = []
+        self.last_part = number
+        if self.publish:
+            _publish({self.name: {'last_part': number}})
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def publish(writers):
+    """
+    Publish the part files written by several table writers together, so that readers see their rows in all the tables
+
+    Parameters:
+    writers (list): The table writers, created with publish=False
+
+    Returns:
+    None
+    """
+    states = {writer.name: {'last_part': writer.last_part} for writer in writers if writer.last_part is not None}
+    if states:
+        _publish(states)
+
+
+def migrate_csv(name):
+    """
+    Migrate the legacy CSV file of a table to the store
+
+    Parameters:
+    name (str): The name of the table
+
+    Returns:
+    migrated (bool): Whether the CSV file exists and was migrated
+    """
+    table = _read_csv(name)
+    if table is None:
+        return False
+
+    clear(name)
+    write_table(name, table)
+
+    return True
+
+
+def _read_csv(name):
+    """
+    Read the legacy CSV file of a table
+
+    Parameters:
+    name (str): The name of the table
+
+    Returns:
+    table (dict): The audio_file column and the other columns as numpy arrays, None if there is no CSV file
+    """
+    file_path, scalar_columns, matrix_column = LEGACY_CSV_FILES[name]
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        return None
+
+    import pandas as pd
+    df = pd.read_csv(file_path, header=None)
+    table = {column: df[i].to_numpy() for i, column in enumerate(scalar_columns)}
+    if matrix_column:
+        table[matrix_column] = df[df.columns[len(scalar_columns):]].to_numpy(dtype=np.float32)
+    # Embeddings are stored normalized, see main.write_results
+    if name in EMBEDDINGS_TABLES:
+        table[matrix_column] = similarity.normalize(table[matrix_column])
+
+    return table
+
+
+def _migrate_missing(name):
+    """
+    Migrate the legacy CSV file of a table that was never written to the store, e.g. on the first run after upgrading
+
+    Tables written by this version are recorded in published.json, also once cleared, so they are never replaced by
+    the CSV files.
+
+    Parameters:
+    name (str): The name of the table
+
+    Returns:
+    migrated (bool): Whether the table was migrated, by this or by another process
+    """
+    if name not in LEGACY_CSV_FILES or name in read_snapshot() or not os.path.exists(LEGACY_CSV_FILES[name][0]):
+        return False
+
+    os.makedirs(STORE_PATH, exist_ok=True)
+    with open(os.path.join(STORE_PATH, MIGRATE_LOCK_FILE), 'w') as lock:
+        # Other processes reading the table wait for the migration, and then read the migrated table
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if name in read_snapshot() or table_exists(name):
+            return table_exists(name)
+        table = _read_csv(name)
+        if table is None:
+            return False
+        # The new base directory is published at once, so readers never see the table half migrated
+        write_table(name, table)
+
+    print(f"Migrated {LEGACY_CSV_FILES[name][0]} to {table_path(name)}")
+
+    return True
+
+
+def migrate_csvs():
+    """
+    Migrate all legacy CSV files to the store
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    for name in LEGACY_CSV_FILES:
+        if migrate_csv(name):
+            print(f"Migrated {LEGACY_CSV_FILES[name][0]} to {table_path(name)}")
+
+
+def normalize_embeddings():
+    """
+    Normalize the embeddings tables written before the embeddings were normalized on write, checking every row
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    for name in EMBEDDINGS_TABLES:
+        if not table_exists(name) or similarity.is_normalized(read_column(name, 'embedding'), sample=None):
+            continue
+        # Part files published meanwhile, e.g. by the analysis worker, are already normalized and stay pending
+        snapshot = read_snapshot()
+        table = read_table(name, snapshot=snapshot)
+        table['embedding'] = similarity.normalize(table['embedding'])
+        _publish({name: _write_base(name, table, _state(name, snapshot)[1])})
+        print(f"Normalized the embeddings of {table_path(name)}")
+
+
+if __name__ == "__main__":
+    migrate_csvs()
+    normalize_embeddings()
@@ -0,0 +1,69 @@
+import os
+import threading
+import numpy as np
+import pytest
+import main
+import methods as m
+import store
+import worker
+
+
+def fake_results(audio_file):
+    features = {column: 0.5 for column in store.FEATURES_COLUMNS}
+    features.update(audio_file=audio_file, keyTemperley='C', scaleTemperley='major', keyKrumhansl='C', scaleKrumhansl='major',
+                    keyEdma='C', scaleEdma='major')
+    genre_predictions = {'audio_file': audio_file, 'genreNumber': 0, 'genre': 'Rock---Indie Rock', 'parentGenre': 'Rock',
+                         'activations': np.full(400, 0.1, dtype=np.float32)}
+
+    return {'audio_file': audio_file, 'features': features, 'genre_predictions': genre_predictions,
+            'discogs_embeddings': np.ones(8, dtype=np.float32), 'musicnn_embeddings': np.ones(4, dtype=np.float32)}
+
+
+def new_job(kind, paths):
+    job = {'kind': kind, 'paths': paths, 'state': 'queued', 'total': None, 'done': 0, 'current': None, 'results': [],
+           'failed': {}, 'error': None}
+    # The service is used without its thread, which would load the models
+    service = worker.AnalysisService.__new__(worker.AnalysisService)
+    service.lock = threading.Lock()
+
+    return service, job
+
+
+def test_run_job_replaces_tracks_missing_from_manifest(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'analyze_audio_file', fake_results)
+    os.makedirs('audio')
+    for audio_file in ['audio/a.mp3', 'audio/b.mp3']:
+        with open(audio_file, 'wb') as file:
+            file.write(b'audio')
+
+    # Tracks stored without a manifest, as after migrating the CSV files
+    writers = {name: store.TableWriter(name) for name in main.OUTPUT_TABLES}
+    for audio_file in ['audio/a.mp3', 'audio/b.mp3']:
+        main.write_results(fake_results(audio_file), writers)
+    for writer in writers.values():
+        writer.close()
+    assert not os.path.exists(main.MANIFEST_FILE_PATH)
+
+    service, job = new_job('directory', ['audio'])
+    service.run_job(job)
+
+    assert job['done'] == 2 and not job['failed']
+    for name in main.OUTPUT_TABLES:
+        assert sorted(store.read_table(name, columns=[])[store.INDEX_COLUMN]) == ['audio/a.mp3', 'audio/b.mp3']
+
+
+def test_run_job_fails_on_model_errors(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('audio')
+    with open('audio/a.mp3', 'wb') as file:
+        file.write(b'audio')
+
+    def fail(audio_file):
+        raise m.ModelLoadError("Could not build model")
+    monkeypatch.setattr(main, 'analyze_audio_file', fail)
+
+    service, job = new_job('files', ['audio/a.mp3'])
+    with pytest.raises(m.ModelLoadError):
+        service.run_job(job)
+    assert not job['failed']
@@ -1,5 +1,11 @@
 """
 Helper file for the Streamlit apps to load and display the audio tracks and other features.
+
+Loaded tables are cached with st.cache_data, keyed by the modification time of the underlying store table, so widget
+interactions reuse the loaded data and a new analysis run invalidates the cache. The genre activations are memory-mapped
+in their stored representation (see activations.py) and cached with st.cache_resource. The query tables of the playlist pages
+(see query.py) are cached with st.cache_resource, so they are shared and not copied between reruns, and keep the
+sorted orders of their columns.
 """
 
 
@@ -9,107 +15,102 @@ import pandas as pd
 import streamlit as st
 import random
 import os.path
+import store
+import query
+import activations
 
 m3u_filepaths_file = 'playlists/streamlit.m3u8'
-GENRE_ANALYSIS_PATH = 'data/genre_predictions.csv'
 METADATA_FILE_PATH = 'metadata/discogs-effnet-bs64-1.json'
-OTHER_FEATURES_PATH = 'data/features.csv'
-
-def load_genre_analysis():
-    # Read discogs metadata json file to get the genre corresponding to each index
-    with open(METADATA_FILE_PATH) as file:
-        metadata_dict = json.load(file)
-    genre_analysis_styles = metadata_dict["classes"]
-
-    # Read the CSV file
-    df = pd.read_csv(GENRE_ANALYSIS_PATH, header=None)
-
-    # Set the first column as the index
-    df.set_index(0, inplace=True)
-    df.index.name = None
-
-    # Select the 4th column and above
-    df = df[df.columns[3:]]
-
-    # Create a dictionary mapping old column names to new column names
-    column_mapping = dict(zip(df.columns, genre_analysis_styles))
 
-    # Rename the columns
-    df.rename(columns=column_mapping, inplace=True)
+# Categorical columns and key spellings of the features table, defined with the table in store.py so that the modules
+# that do not import Streamlit (hybrid.py, the benchmarks) use the same lists
+CATEGORICAL_COLUMNS = store.CATEGORICAL_COLUMNS
+KEYS = store.KEYS
 
-    return df, genre_analysis_styles
+@st.cache_data(show_spinner=False)
+def _load_feature_table(mtime):
+    # The mtime argument is only part of the cache key
+    df = store.load_frame(store.FEATURES_TABLE)
 
-def load_tempo_analysis():
-
-    # Read the CSV file
-    df = pd.read_csv(OTHER_FEATURES_PATH, header=None, usecols=[0, 1])
-
-    # Set the first column as the index
-    df.set_index(0, inplace=True)
-    df.index.name = None
-
-    # Rename the columns
-    df.rename(columns={1: 'tempo'}, inplace=True)
+    # Categorical dtypes for the key, scale and instrumental columns, float32 for the numeric columns
+    for column in df.columns:
+        df[column] = df[column].astype('category' if column in CATEGORICAL_COLUMNS else 'float32')
 
     return df
 
-def load_instrumental_analysis():
-    # Read the CSV file
-    df = pd.read_csv(OTHER_FEATURES_PATH, header=None, usecols=[0, 9])
-
-    # Set the first column as the index
-    df.set_index(0, inplace=True)
-    df.index.name = None
+@st.cache_resource(show_spinner=False)
+def _load_genre_activations(mtime, metadata_mtime):
+    # Read discogs metadata json file to get the genre corresponding to each index
+    with open(METADATA_FILE_PATH) as file:
+        metadata_dict = json.load(file)
+    genre_analysis_styles = metadata_dict["classes"]
 
-    # Rename the columns
-    df.rename(columns={9: 'Instrumental/Voice'}, inplace=True)
+    # Read the genre activations in their stored representation (see activations.py), without expanding them
+    table = store.read_table(store.GENRE_PREDICTIONS_TABLE, mmap=True)
 
-    return df
+    return activations.GenreActivations(table, len(genre_analysis_styles)), genre_analysis_styles
 
-def load_danceability_analysis():
-    # Read the CSV file
-    df = pd.read_csv(OTHER_FEATURES_PATH, header=None, usecols=[0, 10])
+@st.cache_resource(show_spinner=False)
+def _load_feature_query_table(mtime):
+    return query.FeatureTable.from_frame(_load_feature_table(mtime))
 
-    # Set the first column as the index
-    df.set_index(0, inplace=True)
-    df.index.name = None
+@st.cache_resource(show_spinner=False)
+def _load_genre_query_table(mtime, metadata_mtime):
+    genre_activations, genre_analysis_styles = _load_genre_activations(mtime, metadata_mtime)
+    # One column per style, expanded from the activations the first time a style is filtered or ranked by
+    style_columns = activations.StyleColumns(genre_activations, genre_analysis_styles)
+    track_ids = store.read_table(store.GENRE_PREDICTIONS_TABLE, columns=[])[store.INDEX_COLUMN]
+    return query.FeatureTable(track_ids, style_columns), genre_analysis_styles
 
-    # Rename the columns
-    df.rename(columns={10: 'danceability'}, inplace=True)
+def load_feature_table():
+    """
+    Load the features table, shared by all feature pages and cached until the table is modified
 
-    return df
+    Parameters:
+    None
 
-def load_arousal_valence_analysis():
-    # Read the CSV file
-    df = pd.read_csv(OTHER_FEATURES_PATH, header=None, usecols=[0, 11, 12])
+    Returns:
+    df (pd.DataFrame): The features indexed by audio file, with named columns (see store.FEATURES_COLUMNS)
+    """
+    return _load_feature_table(store.table_mtime(store.FEATURES_TABLE))
 
-    # Set the first column as the index
-    df.set_index(0, inplace=True)
-    df.index.name = None
+def load_genre_analysis():
+    """
+    Load the genre activations in their stored representation, cached until the table is modified
 
-    # Rename the columns
-    df.rename(columns={11: 'arousal', 12: 'valence'}, inplace=True)
+    Parameters:
+    None
 
-    return df
+    Returns:
+    genre_activations (activations.GenreActivations): The genre activations
+    genre_analysis_styles (list): The style names
+    """
+    return _load_genre_activations(store.table_mtime(store.GENRE_PREDICTIONS_TABLE), os.path.getmtime(METADATA_FILE_PATH))
 
-def load_key_scale_analysis():
+def load_feature_query_table():
+    """
+    Load the features table as a query table (see query.py), shared by all feature pages
 
-    # Read the CSV file
-    df = pd.read_csv(OTHER_FEATURES_PATH, header=None, usecols=[0, 2, 3, 4, 5, 6, 7])
+    Parameters:
+    None
 
-    # Set the first column as the index
-    df.set_index(0, inplace=True)
-    df.index.name = None
+    Returns:
+    table (query.FeatureTable): The features table
+    """
+    return _load_feature_query_table(store.table_mtime(store.FEATURES_TABLE))
 
-    # Combine the key and scale columns
-    df['keyTemperley'] = df[2] + ' ' + df[3]
-    df['keyKrumhansl'] = df[4] + ' ' + df[5]
-    df['keyEdma'] = df[6] + ' ' + df[7]
+def load_genre_query_table():
+    """
+    Load the genre activations as a query table with one column per style
 
-    # Drop the original key and scale columns
-    df.drop(columns=[2, 3, 4, 5, 6, 7], inplace=True)
+    Parameters:
+    None
 
-    return df
+    Returns:
+    table (query.FeatureTable): The genre activations
+    genre_analysis_styles (list): The style names
+    """
+    return _load_genre_query_table(store.table_mtime(store.GENRE_PREDICTIONS_TABLE), os.path.getmtime(METADATA_FILE_PATH))
 
 def display_tracks(mp3s, max_tracks, shuffle, m3u_filepath):
     """
@@ -0,0 +1,298 @@
+"""
+Watch mode: analyze audio files as they are added to the audio directory, instead of running main.py over the whole
+collection.
+
+The directory is watched with inotify on Linux (through ctypes, every subdirectory is watched) and by polling the
+size and modification time of the audio files elsewhere, or with --poll. A new or modified file is only analyzed once
+its size and modification time have not changed for --debounce seconds, so files that are still being copied are not
+analyzed early. Settled files are collected for --batch-window seconds, and for as long as the previous job of the
+watcher is still queued or running, and then sent as one job, so that a folder copied file by file is not analyzed
+as one job per file.
+
+Files are analyzed by the analysis worker (see worker.py), which is started if it is not running and keeps the models
+loaded. It appends the tracks to the store tables in atomically written part files, publishes them together and updates
+the ANN indexes of the similarity app, so the apps show the new tracks as soon as the job is done. On start, the new or modified
+files of the directory since the last analysis are queued as well. Deleted files are left in the store tables until the
+next run of main.py --incremental.
+
+Run from the repository root with: python3 watch.py
+
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import methods as m
+import scan
+import worker
+
+# Set file path
+AUDIOFILES_PATH = "audio"
+
+DEBOUNCE = 2.0
+BATCH_WINDOW = 10.0
+POLL_INTERVAL = 1.0
+
+# inotify flags, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# Header of an inotify event, followed by the name of the file
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Watcher that reports the files written or moved into a directory tree, using inotify
+    """
+
+    def __init__(self, directory):
+        """
+        Initialise the watcher and watch the directory and each of its subdirectories
+
+        Parameters:
+        directory (str): The directory to watch
+
+        Returns:
+        None
+        """
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.directory = directory
+        self.directories = {}
+        self.watch_tree(directory)
+
+    def watch_tree(self, directory):
+        """
+        Watch a directory and its subdirectories
+
+        Parameters:
+        directory (str): The directory
+
+        Returns:
+        paths (list): The files already in the directory tree, which may have been written before it was watched
+        """
+        paths = []
+        for root, _, files in os.walk(directory):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {root}")
+            self.directories[wd] = root
+            paths += [os.path.join(root, file) for file in files]
+
+        return paths
+
+    def changes(self, timeout):
+        """
+        Wait for files to be written or moved into the directory tree
+
+        Parameters:
+        timeout (float): The maximum number of seconds to wait
+
+        Returns:
+        paths (list): The changed files, or the watched directory if events were lost and it has to be searched again
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        paths = []
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                paths.append(self.directory)
+            elif mask & IN_IGNORED:
+                # The directory was deleted or moved away
+                self.directories.pop(wd, None)
+            elif wd in self.directories:
+                path = os.path.join(self.directories[wd], os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    # Watch new directories, files moved in with them do not generate events of their own
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        paths += self.watch_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    paths.append(path)
+
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Watcher that reports the new or modified audio files of a directory tree, by searching it at an interval
+    """
+
+    def __init__(self, directory, interval=POLL_INTERVAL):
+        """
+        Initialise the watcher with the current audio files of the directory
+
+        Parameters:
+        directory (str): The directory to watch
+        interval (float): The number of seconds between two searches
+
+        Returns:
+        None
+        """
+        self.directory = directory
+        self.interval = interval
+        self.signatures = self.search()
+
+    def search(self):
+        return dict(scan.scan_audio_files(self.directory, m.AUDIO_FILE_TYPES))
+
+    def changes(self, timeout):
+        """
+        Search the directory tree again and report the new or modified audio files
+
+        Parameters:
+        timeout (float): The maximum number of seconds to wait, the directory is searched every interval seconds
+
+        Returns:
+        paths (list): The new or modified audio files
+        """
+        time.sleep(min(timeout, self.interval))
+        signatures = self.search()
+        paths = [audio_file for audio_file, signature in signatures.items() if self.signatures.get(audio_file) != signature]
+        self.signatures = signatures
+
+        return paths
+
+    def close(self):
+        pass
+
+
+def create_watcher(directory, poll=False):
+    """
+    Create an inotify watcher, or a polling watcher if inotify is not available
+
+    Parameters:
+    directory (str): The directory to watch
+    poll (bool): Whether to always use a polling watcher
+
+    Returns:
+    watcher (InotifyWatcher or PollingWatcher): The watcher
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError, TypeError) as error:
+            # AttributeError if the C library has no inotify functions, TypeError if there is no C library
+            print(f"inotify is not available ({error}), polling {directory} instead")
+
+    return PollingWatcher(directory)
+
+
+class Debouncer:
+    """
+    Collect changed files until their size and modification time have not changed for some time
+    """
+
+    def __init__(self, debounce=DEBOUNCE):
+        self.debounce = debounce
+        # Signature of each changed file and the time it was last seen changing
+        self.pending = {}
+
+    def add(self, paths):
+        now = time.monotonic()
+        for path in paths:
+            try:
+                self.pending[path] = (m.file_signature(path), now)
+            except FileNotFoundError:
+                self.pending.pop(path, None)
+
+    def settled(self):
+        """
+        Get the changed files that have not changed for the debounce time, and stop tracking them
+
+        Parameters:
+        None
+
+        Returns:
+        paths (list): The settled files
+        """
+        now = time.monotonic()
+        paths = []
+        for path, (signature, changed) in list(self.pending.items()):
+            if now - changed < self.debounce:
+                continue
+            try:
+                current = m.file_signature(path)
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+            # Files still being written are seen changing again
+            if current != signature:
+                self.pending[path] = (current, now)
+            else:
+                paths.append(path)
+                del self.pending[path]
+
+        return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze the audio files added to a directory as they arrive, with the analysis worker")
+    parser.add_argument('directory', nargs='?', default=AUDIOFILES_PATH, help=f"Directory to watch (default: {AUDIOFILES_PATH})")
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE, help=f"Seconds a file has to stay unchanged before it is analyzed (default: {DEBOUNCE})")
+    parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW, help=f"Seconds settled files are collected before they are sent as one job (default: {BATCH_WINDOW})")
+    parser.add_argument('--poll', action='store_true', help="Poll the directory instead of using inotify")
+    args = parser.parse_args()
+
+    directory = os.path.relpath(args.directory)
+    watcher = create_watcher(directory, args.poll)
+    debouncer = Debouncer(args.debounce)
+    service = worker.connect()
+
+    # Catch up with the files added while nothing was watching
+    job_id = service.enqueue_directory(directory)
+    print(f"Watching {directory}, queued job {job_id} for the new or modified files")
+    # Settled files not sent yet, and the time the first of them settled
+    batch, batch_started = [], None
+    try:
+        while True:
+            paths = watcher.changes(timeout=min(args.debounce, POLL_INTERVAL))
+            if directory in paths:
+                job_id = service.enqueue_directory(directory)
+                print(f"Events were lost, queued job {job_id} for the new or modified files")
+            debouncer.add([path for path in paths if path != directory and path.endswith(tuple(m.AUDIO_FILE_TYPES))])
+
+            audio_files = [audio_file for audio_file in debouncer.settled() if audio_file not in batch]
+            if audio_files and not batch:
+                batch_started = time.monotonic()
+            batch += audio_files
+
+            # The files that settle while the previous job is analyzed are sent together once it is done
+            if batch and time.monotonic() - batch_started >= args.batch_window and job_id not in service.status()['pending']:
+                job_id = service.enqueue_files(batch)
+                print(f"Queued job {job_id} for {len(batch)} new audio files")
+                batch = []
+    except KeyboardInterrupt:
+        if batch:
+            print(f"Queued job {service.enqueue_files(batch)} for {len(batch)} new audio files")
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+"""
+Long-lived analysis worker, so that the apps can analyze audio files without starting main.py for every run.
+
+The worker process loads the Essentia algorithms and all models once and keeps them loaded. It serves an
+AnalysisService over a local Unix socket with a multiprocessing manager, which accepts jobs to analyze files or
+directories. Jobs are queued and analyzed one at a time by a background thread, in the same way as main.py: the results
+are appended to the store tables as part files, which are published together for all tables at the end of the job,
+rows of files that are analyzed again are replaced, and the manifest of analyzed files is updated. The tables are only
+compacted once COMPACT_PARTS part files are pending. The saved ANN indexes and quantized embeddings are then updated
+with the appended tracks (see ann.update). Directory jobs only analyze the files that are new or modified since they
+were last analyzed.
+
+Clients poll the progress of a job and the features of the tracks analyzed so far, so the apps never block on an
+analysis. connect starts the worker in the background if it is not running.
+
+Run the worker with: python3 worker.py
+Enqueue files or directories from the command line with: python3 worker.py enqueue audio/new_album
+
+"""
+
+import argparse
+import itertools
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.managers import BaseManager
+from tqdm import tqdm
+import activations
+import ann
+import main
+import methods as m
+import scan
+import store
+
+# Socket of the worker and the key clients authenticate with, only readable by the user running the worker
+SOCKET_PATH = 'data/analysis_worker.sock'
+AUTHKEY_FILE_PATH = 'data/analysis_worker.key'
+WORKER_LOG_PATH = 'data/analysis_worker.log'
+
+# Number of seconds connect waits for a worker it started
+START_TIMEOUT = 30
+POLL_INTERVAL = 0.5
+
+# Number of pending part files of a table after which a job compacts the output tables
+COMPACT_PARTS = 16
+
+# Features returned for each analyzed track of a job
+RESULT_FEATURES = ['tempo', 'keyEdma', 'scaleEdma', 'instrumental', 'danceability', 'arousal', 'valence']
+
+# Methods of the service that clients can call
+EXPOSED = ['enqueue_files', 'enqueue_directory', 'job', 'status']
+
+# Errors raised when connecting while no worker is running, or after it was restarted with a new key
+CONNECTION_ERRORS = (OSError, EOFError, AuthenticationError)
+
+
+class WorkerManager(BaseManager):
+    # Manager of the worker, its service is registered by serve
+    pass
+
+
+class WorkerClient(BaseManager):
+    # Manager of the clients, connected to the manager of the worker
+    pass
+
+
+WorkerClient.register('service', exposed=EXPOSED)
+
+
+class AnalysisService:
+    """
+    Queue of analysis jobs, run one at a time by a background thread that holds the models
+    """
+
+    def __init__(self):
+        """
+        Initialise the service and start loading the models in the background thread
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        self.state = 'loading models'
+        self.error = None
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, kind, paths):
+        with self.lock:
+            job_id = next(self.job_ids)
+            self.jobs[job_id] = {'id': job_id, 'kind': kind, 'paths': list(paths), 'state': 'queued', 'total': None,
+                                 'done': 0, 'current': None, 'results': [], 'failed': {}, 'error': None}
+        self.queue.put(job_id)
+
+        return job_id
+
+    def enqueue_files(self, audio_files):
+        """
+        Queue audio files for analysis, files that were already analyzed are analyzed again
+
+        Parameters:
+        audio_files (list): The paths to the audio files, relative to the repository root
+
+        Returns:
+        job_id (int): The id of the job
+        """
+        return self.enqueue('files', audio_files)
+
+    def enqueue_directory(self, directory):
+        """
+        Queue the new or modified audio files of a directory for analysis
+
+        Parameters:
+        directory (str): The directory, searched recursively
+
+        Returns:
+        job_id (int): The id of the job
+        """
+        return self.enqueue('directory', [directory])
+
+    def job(self, job_id, since=0):
+        """
+        Get the progress of a job
+
+        Parameters:
+        job_id (int): The id of the job
+        since (int): The number of results already received, only the results after them are returned
+
+        Returns:
+        job (dict): The state ('queued', 'scanning', 'running', 'done' or 'failed'), the number of files to analyze
+                    and analyzed, the file being analyzed, the features of the analyzed tracks and the error of each
+                    file that could not be analyzed
+        """
+        with self.lock:
+            job = dict(self.jobs[job_id])
+            job['results'] = job['results'][since:]
+            job['failed'] = dict(job['failed'])
+
+        return job
+
+    def status(self):
+        """
+        Get the state of the worker
+
+        Parameters:
+        None
+
+        Returns:
+        status (dict): The state of the worker ('loading models', 'idle', 'running' or 'failed'), the error if the
+                       models could not be loaded, its process id and the ids of the queued and running jobs
+        """
+        with self.lock:
+            pending = [job['id'] for job in self.jobs.values() if job['state'] not in ('done', 'failed')]
+
+        return {'state': self.state, 'error': self.error, 'pid': os.getpid(), 'pending': pending}
+
+    def update(self, job, **values):
+        with self.lock:
+            job.update(values)
+
+    def run(self):
+        # Load all models now, so that the first job does not wait for them
+        try:
+            main.init_essentia()
+            main.ess.load_extractors(m.EssentiaClasses.extractors)
+        except Exception:
+            self.error = traceback.format_exc()
+            self.state = 'failed'
+            print(self.error, flush=True)
+            return
+        self.state = 'idle'
+
+        while True:
+            job = self.jobs[self.queue.get()]
+            self.state = 'running'
+            try:
+                self.run_job(job)
+                self.update(job, state='done', current=None)
+            except Exception:
+                self.update(job, state='failed', current=None, error=traceback.format_exc())
+            self.state = 'idle' if self.queue.empty() else 'running'
+
+    def run_job(self, job):
+        """
+        Analyze the audio files of a job and write their results to the store tables
+
+        Parameters:
+        job (dict): The job
+
+        Returns:
+        None
+        """
+        self.update(job, state='scanning')
+        manifest = main.load_manifest()
+        if job['kind'] == 'directory':
+            audio_files = sorted(audio_file for audio_file, signature in scan.scan_audio_files(job['paths'][0], m.AUDIO_FILE_TYPES)
+                                 if manifest.get(audio_file) != signature)
+        else:
+            audio_files = [os.path.relpath(audio_file) for audio_file in job['paths']]
+        self.update(job, state='running', total=len(audio_files))
+        if not audio_files:
+            return
+
+        # Drop the rows of files that are analyzed again, the new rows are appended. The stored tracks are read from the
+        # tables, which can hold tracks missing from the manifest, e.g. migrated from the CSV files. The tables are only
+        # rewritten if a file of the job is stored
+        stored = set()
+        for name in main.OUTPUT_TABLES:
+            if store.table_exists(name):
+                stored.update(store.read_table(name, columns=[])[store.INDEX_COLUMN])
+        replaced = stored.intersection(audio_files)
+        if replaced:
+            store.keep_rows(main.OUTPUT_TABLES, stored - replaced)
+
+        genre_activations = activations.table_representation() or 'float32'
+        # The rows are published at the end of the job, so the apps never see a track in only some of the tables
+        writers = {name: store.TableWriter(name, publish=False) for name in main.OUTPUT_TABLES}
+        try:
+            for audio_file in audio_files:
+                self.update(job, current=audio_file)
+                try:
+                    results = main.analyze_audio_file(audio_file)
+                    main.write_results(results, writers, genre_activations)
+                    manifest[audio_file] = m.file_signature(audio_file)
+                    result = {'audio_file': audio_file, 'genre': str(results['genre_predictions']['genre'])}
+                    result.update({feature: results['features'][feature] for feature in RESULT_FEATURES})
+                    # Plain Python values, so that the clients do not need numpy to unpickle them
+                    result = {key: value.item() if hasattr(value, 'item') else value for key, value in result.items()}
+                    with self.lock:
+                        job['results'].append(result)
+                except main.DECODE_ERRORS + main.ANALYSIS_ERRORS as error:
+                    # Only errors of the file are recorded, others such as m.ModelLoadError fail the job, see main.py
+                    with self.lock:
+                        job['failed'][audio_file] = f'{type(error).__name__}: {error}'
+                self.update(job, done=job['done'] + 1)
+        finally:
+            for writer in writers.values():
+                writer.close()
+            # Publish the written rows of all tables together, which also invalidates the caches of the apps
+            store.publish(writers.values())
+            main.write_manifest(manifest)
+
+        # Merge the part files once there are many of them, until then the apps read them after the compacted rows
+        if max(store.pending_parts(name) for name in main.OUTPUT_TABLES) >= COMPACT_PARTS:
+            store.compact(main.OUTPUT_TABLES)
+
+        # Add the new tracks to the saved ANN indexes and quantized embeddings of the similarity app
+        for name in ann.EMBEDDINGS_TABLES:
+            if store.table_exists(name):
+                ann.update(name)
+
+        if store.table_exists(store.GENRE_PREDICTIONS_TABLE):
+            main.write_genre_counts()
+
+
+def read_authkey():
+    with open(AUTHKEY_FILE_PATH, 'rb') as file:
+        return file.read()
+
+
+def serve():
+    """
+    Serve an AnalysisService on the worker socket until interrupted
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    try:
+        connect(start=False)
+        raise SystemExit(f"An analysis worker is already running on {SOCKET_PATH}")
+    except CONNECTION_ERRORS:
+        pass
+
+    # Remove the socket of a worker that did not exit cleanly, and create a new key readable only by the user
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    os.makedirs(os.path.dirname(AUTHKEY_FILE_PATH), exist_ok=True)
+    descriptor = os.open(AUTHKEY_FILE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as file:
+        file.write(os.urandom(32))
+
+    service = AnalysisService()
+    WorkerManager.register('service', callable=lambda: service, exposed=EXPOSED)
+    server = WorkerManager(address=SOCKET_PATH, authkey=read_authkey()).get_server()
+    os.chmod(SOCKET_PATH, 0o600)
+    print(f"Analysis worker {os.getpid()} listening on {SOCKET_PATH}", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+
+
+def connect(start=True, timeout=START_TIMEOUT):
+    """
+    Connect to the analysis worker, starting it in the background if it is not running
+
+    Parameters:
+    start (bool): Whether to start the worker if it is not running
+    timeout (float): The number of seconds to wait for a started worker to accept connections
+
+    Returns:
+    service (AnalysisService): A proxy of the service of the worker
+    """
+    try:
+        manager = WorkerClient(address=SOCKET_PATH, authkey=read_authkey())
+        manager.connect()
+        return manager.service()
+    except CONNECTION_ERRORS:
+        if not start:
+            raise
+
+    # Start the worker in its own session, so that it outlives the app that started it
+    os.makedirs(os.path.dirname(WORKER_LOG_PATH), exist_ok=True)
+    with open(WORKER_LOG_PATH, 'a') as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        time.sleep(POLL_INTERVAL)
+        try:
+            return connect(start=False)
+        except CONNECTION_ERRORS:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"The analysis worker did not start within {timeout} seconds, see {WORKER_LOG_PATH}")
+
+
+def follow(service, job_id):
+    """
+    Print the progress of a job until it is finished
+
+    Parameters:
+    service (AnalysisService): A proxy of the service of the worker
+    job_id (int): The id of the job
+
+    Returns:
+    job (dict): The finished job
+    """
+    with tqdm(unit='track') as pbar:
+        received = 0
+        while True:
+            job = service.job(job_id, since=received)
+            received += len(job['results'])
+            pbar.total = job['total']
+            pbar.set_description(f"Job {job_id} {job['state']}")
+            pbar.update(job['done'] - pbar.n)
+            if job['state'] in ('done', 'failed'):
+                return job
+            time.sleep(POLL_INTERVAL)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Run the analysis worker, or enqueue audio files or directories to it")
+    subparsers = parser.add_subparsers(dest='command')
+    enqueue_parser = subparsers.add_parser('enqueue', help="Analyze audio files, and the new or modified audio files of directories")
+    enqueue_parser.add_argument('paths', nargs='+', help="Audio files or directories")
+    enqueue_parser.add_argument('--no-wait', action='store_true', help="Return once the jobs are queued instead of following their progress")
+    subparsers.add_parser('status', help="Print the state of the worker")
+    args = parser.parse_args()
+
+    if args.command is None:
+        serve()
+        return
+
+    service = connect()
+    if args.command == 'status':
+        print(service.status())
+        return
+
+    files = [path for path in args.paths if not os.path.isdir(path)]
+    job_ids = [service.enqueue_directory(path) for path in args.paths if os.path.isdir(path)]
+    if files:
+        job_ids.append(service.enqueue_files(files))
+    print(f"Queued jobs {job_ids}")
+
+    if not args.no_wait:
+        for job_id in job_ids:
+            job = follow(service, job_id)
+            for audio_file, error in job['failed'].items():
+                print(f"Failed to analyze {audio_file}: {error}")
+            if job['error']:
+                print(job['error'])
+
+
+if __name__ == "__main__":
+    main_cli()